@@ -56,7 +56,9 @@ def make(config,
         modules=modules,
         pipelines=pipelines,
         load_path=load_path,
-        save_path=save_path
+        save_path=save_path,
+        save_epoch_interval=config.get("save_epoch_interval", None),
+        save_step_interval=config.get("save_step_interval", None)
     )
     
     return rg_instance
\ No newline at end of file
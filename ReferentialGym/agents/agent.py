@@ -14,6 +14,34 @@ import numpy as np
 from ..modules import Module
 
 
+def training_only_hook(hook):
+    """
+    Flags :param hook: as only relevant to training, e.g. a regularization loss,
+    so that it is skipped by lean evaluation passes.
+    """
+    hook.training_only = True
+    return hook
+
+def logging_hook(hook):
+    """
+    Flags :param hook: as only logging statistics, so that it is skipped by lean 
+    evaluation passes, unless its name is in `config["lean_evaluation_hooks"]`.
+    """
+    hook.logging_only = True
+    return hook
+
+def is_lean_evaluation_hook(hook, requested_hooks:List[str]=None) -> bool:
+    """
+    :param requested_hooks: None or List of the names of the training-only/logging hooks
+                            to run anyway, e.g. because they compute requested metrics.
+    :returns: boolean stating whether :param hook: is run by lean evaluation passes.
+    """
+    if requested_hooks is not None and getattr(hook, "__name__", None) in requested_hooks:
+        return True
+    return not(getattr(hook, "training_only", False) or getattr(hook, "logging_only", False))
+
+
+@training_only_hook
 def vae_loss_hook(agent,
                   losses_dict,
                   input_streams_dict,
@@ -25,6 +53,7 @@ def vae_loss_hook(agent,
     
     losses_dict[f"repetition{it_rep}/comm_round{it_comm_round}/{agent.role}/VAE_loss"] = [agent.kwargs["VAE_lambda"], agent.VAE_losses]
 
+@training_only_hook
 def maxl1_loss_hook(agent,
                     losses_dict,
                     input_streams_dict,
@@ -86,6 +115,8 @@ class Agent(Module):
             "sample":"current_dataloader:sample",
             "losses_dict":"losses_dict",
             "logs_dict":"logs_dict",
+            "lean_evaluation":"signals:lean_evaluation",
+            "lean_evaluation_hooks":"config:lean_evaluation_hooks",
         }
 
         input_stream_ids["listener"] = {
@@ -108,6 +139,8 @@ class Agent(Module):
             "sample":"current_dataloader:sample",
             "losses_dict":"losses_dict",
             "logs_dict":"logs_dict",
+            "lean_evaluation":"signals:lean_evaluation",
+            "lean_evaluation_hooks":"config:lean_evaluation_hooks",
         }
 
         super(Agent, self).__init__(id=agent_id,
@@ -132,6 +165,9 @@ class Agent(Module):
         self.vocab_stop_idx = 0
         self.vocab_pad_idx = self.vocab_size
         
+        # Features of the current dialogue's experiences, cf. `_cached_sense`:
+        self.sensed_features = None
+
         self.hooks = []
         if self.kwargs["with_weight_maxl1_loss"]:
             self.register_hook(maxl1_loss_hook)
@@ -150,14 +186,23 @@ class Agent(Module):
         self.logger = logger  
         return clone 
 
-    def save(self, path, filename=None):
+    def save(self, path, filename=None, checkpointer=None):
+        """
+        :param checkpointer: None or `Checkpointer` to which the `state_dict` of the agent
+                             is handed, so that it is written in the background.
+                             If None, the whole agent is pickled synchronously.
+        """
+        if checkpointer is not None:
+            if filename is None:
+                filename = self.id+".state_dict"
+            checkpointer.save_state_dict(module=self, filepath=os.path.join(path, filename))
+            return
+
         logger = self.logger
         self.logger = None
         if filename is None:
-            filepath = path+self.id+".agent"
-        else:
-            filepath = os.path.join(path, filename)
-        torch.save(self, filepath)
+            filename = self.id+".agent"
+        torch.save(self, os.path.join(path, filename))
         self.logger = logger 
 
     def _tidyup(self):
@@ -180,6 +225,45 @@ class Agent(Module):
     def register_hook(self, hook):
         self.hooks.append(hook)
 
+    def __getstate__(self):
+        # The cached features, and their graph, are not pickled/deep-copied:
+        state = super(Agent, self).__getstate__()
+        state["sensed_features"] = None
+        return state
+
+    def _reset_sensed_features(self):
+        self.sensed_features = None
+
+    def _cached_sense(self, experiences, sentences=None):
+        """
+        Infers features from the experiences only once per dialogue:
+        in multi-round games, the experiences do not change between communication rounds,
+        thus the features inferred on the first round are reused on the following ones,
+        until the end of the dialogue, when the recurrent states are reset too.
+        The caching can be disabled with `kwargs["cache_sensed_features"]=False`.
+
+        :param experiences: Tensor of shape `(batch_size, *self.obs_shape)`. 
+        :param sentences: None or Tensor of shape `(batch_size, max_sentence_length, vocab_size)` containing the padded sequence of (potentially one-hot-encoded) symbols.
+        
+        :returns:
+            features: Tensor of shape `(batch_size, *(self.obs_shape[:2]), feature_dim).
+        """
+        # The version counter of inference tensors is not tracked, 
+        # thus their in-place modifications cannot be detected:
+        if experiences.is_inference() or not self.kwargs.get("cache_sensed_features", True):
+            return self._sense(experiences=experiences, sentences=sentences)
+
+        # In-place modifications of the experiences, or a change of train/eval mode, invalidate the features:
+        key = (experiences._version, self.training)
+        if self.sensed_features is not None\
+            and self.sensed_features[0] is experiences\
+            and self.sensed_features[1] == key:
+            return self.sensed_features[2]
+
+        features = self._sense(experiences=experiences, sentences=sentences)
+        self.sensed_features = (experiences, key, features)
+        return features
+
     def embed_sentences(self, sentence):
         """
         :param sentences: Tensor of shape `(batch_size, max_sentence_length, vocab_size)` containing the padded sequence of (potentially one-hot-encoded) symbols.
@@ -223,6 +307,8 @@ class Agent(Module):
             - `'config'`: Dict of hyperparameters to the referential game.
             - `'mode'`: String that defines what mode we are in, e.g. 'train' or 'test'. Those keywords are expected.
             - `'it'`: Integer specifying the iteration number of the current function call.
+            - `'lean_evaluation'`: Boolean defining whether to skip the training-only and logging hooks,
+                                   apart from the ones named in `'lean_evaluation_hooks'`.
         """
         config = input_streams_dict["config"]
         mode = input_streams_dict["mode"]
@@ -232,6 +318,8 @@ class Agent(Module):
         
         losses_dict = input_streams_dict["losses_dict"]
         logs_dict = input_streams_dict["logs_dict"]
+        # Lean evaluation passes skip the training-only and logging work:
+        lean_evaluation = input_streams_dict.get("lean_evaluation", False)
         
         input_sentence = input_streams_dict["sentences_widx"]
         if self.use_sentences_one_hot_vectors:
@@ -251,7 +339,8 @@ class Agent(Module):
         outputs_dict["exp_latents"] = input_streams_dict["exp_latents"]
         outputs_dict["exp_latents_values"] = input_streams_dict["exp_latents_values"]
         outputs_dict["exp_latents_one_hot_encoded"] = input_streams_dict["exp_latents_one_hot_encoded"]
-        self._log(outputs_dict, batch_size=batch_size)
+        if not lean_evaluation:
+            self._log(outputs_dict, batch_size=batch_size)
 
         # //------------------------------------------------------------//
         # //------------------------------------------------------------//
@@ -273,6 +362,9 @@ class Agent(Module):
         # //------------------------------------------------------------//
         
         for hook in self.hooks:
+            if lean_evaluation\
+                and not is_lean_evaluation_hook(hook, input_streams_dict.get("lean_evaluation_hooks", None)):
+                continue
             hook(
                 agent=self,
                 losses_dict=losses_dict,
@@ -287,6 +379,7 @@ class Agent(Module):
         
         # Logging:        
         for logname, value in self.log_dict.items():
+            if lean_evaluation: break
             self.logger.add_scalar(f"{mode}/repetition{it_rep}/comm_round{it_comm_round}/{self.role}/{logname}", value.item(), global_it_comm_round)
         self.log_dict = {}
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .discriminative_listener import DiscriminativeListener
+from .agent import logging_hook
 from ..networks import choose_architecture, layer_init, BetaVAE, reg_nan, hasnan
 from ..utils import gumbel_softmax
 
@@ -26,6 +27,7 @@ scale_negative_logit = -1e4
 use_stop_word_in_compute_sentence = False 
 
 
+@logging_hook
 def sentence_length_entropy_logging_hook(agent,
                                  losses_dict,
                                  input_streams_dict,
@@ -685,7 +685,7 @@ class DiscriminativeListener(Listener):
         :param tau0: Float, temperature with which to apply gumbel-softmax estimator.
         """
         batch_size = experiences.size(0)
-        features = self._sense(experiences=experiences, sentences=sentences)
+        features = self._cached_sense(experiences=experiences, sentences=sentences)
         if sentences is not None:
             decision_logits, listener_temporal_features = self._reason(sentences=sentences, features=features)
         else:
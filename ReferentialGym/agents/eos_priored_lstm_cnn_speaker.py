@@ -2,11 +2,13 @@ import torch
 import torch.nn as nn
 
 from .speaker import Speaker
+from .agent import training_only_hook
 from ..networks import choose_architecture, layer_init, hasnan, BetaVAE
 
 import copy
 
 
+@training_only_hook
 def eos_priored_loss_hook(agent,
                           losses_dict,
                           input_streams_dict,
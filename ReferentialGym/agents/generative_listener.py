@@ -158,7 +158,7 @@ class GenerativeListener(Listener):
         :param tau0: Float, temperature with which to apply gumbel-softmax estimator.
         """
         if experiences is not None:
-            features = self._sense(experiences=experiences, sentences=sentences)
+            features = self._cached_sense(experiences=experiences, sentences=sentences)
         else:
             features = None 
 
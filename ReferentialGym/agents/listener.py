@@ -76,6 +76,7 @@ class Listener(Agent):
 
     def _reset_rnn_states(self):
         self.rnn_states = None 
+        self._reset_sensed_features()
 
     def _compute_tau(self, tau0):
         raise NotImplementedError
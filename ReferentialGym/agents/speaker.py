@@ -3,11 +3,12 @@ import torch.nn as nn
 
 from ..networks import layer_init
 from ..utils import gumbel_softmax
-from .agent import Agent 
+from .agent import Agent, training_only_hook, logging_hook
 
 assume_padding_with_eos = True
 
 
+@logging_hook
 def sentence_length_logging_hook(agent,
                                  losses_dict,
                                  input_streams_dict,
@@ -48,6 +49,7 @@ def sentence_length_logging_hook(agent,
     logs_dict[f"{mode}/repetition{it_rep}/comm_round{it_comm_round}/{agent.agent_id}/SentenceLength (/{config['max_sentence_length']})"] = sentence_lengths/config["max_sentence_length"]
 
 
+@logging_hook
 def entropy_logging_hook(agent,
                          losses_dict,
                          input_streams_dict,
@@ -102,6 +104,7 @@ def entropy_logging_hook(agent,
     # (batch_size, )
     logs_dict[f"{mode}/repetition{it_rep}/comm_round{it_comm_round}/{agent.agent_id}/SentenceLengthNormalizedPerplexity"] = perplexities_per_sentence.mean().item()
 
+@training_only_hook
 def entropy_regularization_loss_hook(agent,
                                      losses_dict,
                                      input_streams_dict,
@@ -138,6 +141,7 @@ def entropy_regularization_loss_hook(agent,
     """
 
 
+@training_only_hook
 def mdl_principle_loss_hook(agent,
                             losses_dict,
                             input_streams_dict,
@@ -166,6 +170,7 @@ def mdl_principle_loss_hook(agent,
     ]   
 
 
+@training_only_hook
 def oov_loss_hook(agent,
                   losses_dict,
                   input_streams_dict,
@@ -243,6 +248,7 @@ class Speaker(Agent):
 
     def _reset_rnn_states(self):
         self.rnn_states = None
+        self._reset_sensed_features()
 
     def _compute_tau(self, tau0):
         raise NotImplementedError
@@ -290,7 +296,7 @@ class Speaker(Agent):
         :param tau0: Float, temperature with which to apply gumbel-softmax estimator.
         """
         batch_size = experiences.size(0)
-        features = self._sense(experiences=experiences, sentences=sentences)
+        features = self._cached_sense(experiences=experiences, sentences=sentences)
         utter_outputs = self._utter(features=features, sentences=sentences)
         if len(utter_outputs) == 5:
             next_sentences_hidden_states, next_sentences_widx, next_sentences_logits, next_sentences, temporal_features = utter_outputs
@@ -83,39 +83,45 @@ class CLEVRDataset(Dataset):
             self.vocab_path = os.path.join(self.dataset_path, 'vocab.json') 
             self.image_path = os.path.join(self.dataset_path, 'val_questions.h5.paths.npz')
 
-        self.data = h5py.File(self.data_path, 'r')
-
         with open(self.vocab_path, 'r') as f:
             self.vocab = json.load(f)
 
-        self.image_path_data = np.load(self.image_path)
+        # Lightweight index: the questions and answers are only read from 
+        # the HDF5 file on demand, while the small per-question integer arrays
+        # are read in one vectorized pass.
+        # The HDF5 file is opened lazily, so that each DataLoader worker gets its own handle.
+        self.data = None
+        with h5py.File(self.data_path, 'r') as data:
+            self.nbr_questions = len(data['questions'])
+            self.idx2imageidx = np.asarray(data['image_idxs'], dtype=np.int64)
+            self.idx2question_family = np.asarray(data['question_families'])
+
+        self.image_idx2path = np.load(self.image_path)['paths']
+        if len(self.image_idx2path) != self.nbr_questions:
+            # Paths are stored per image rather than per question:
+            self.image_idx2path = self.image_idx2path[self.idx2imageidx]
 
-        self.idx2question = ToLongTensor(self.data['questions'])
-        self.idx2answer = ToLongTensor(self.data['answers'])
-        self.idx2imageidx = ToLongTensor(self.data['image_idxs'])
-        self.idx2question_family = np.asarray(self.data['question_families'])
-        self.image_idx2path = self.image_path_data['paths']    
+        self.transform = transform 
 
-        dataset = []
-        nbrImage = 0
-        nbrQst = 0
-        for qst_idx in range(len(self.idx2question)):
-            qst = self.idx2question_family[qst_idx]
-            ans = self.idx2answer[qst_idx].item()
-            img_path = os.path.join(self.dataset_path, self.image_idx2path[qst_idx])
+    def _get_data(self):
+        if self.data is None:
+            self.data = h5py.File(self.data_path, 'r')
+        return self.data
 
-            dataset.append((img_path, qst, ans))
-            nbrImage += 1
-            nbrQst += 1
+    def __getstate__(self):
+        # h5py file handles cannot be pickled, e.g. to DataLoader workers:
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
 
-        nbr_unique_ans = max([d[2] for d in dataset])+1
-        #self.dataset = [ (d[0], d[2]+nbr_unique_ans*d[1]) for d in dataset]
-        self.dataset = [ (d[0], d[1]) for d in dataset]
+    def getquestion(self, idx):
+        return ToLongTensor(self._get_data()['questions'][idx])
 
-        self.transform = transform 
+    def getanswer(self, idx):
+        return int(self._get_data()['answers'][idx])
 
     def __len__(self) -> int:
-        return len(self.dataset)
+        return self.nbr_questions
 
     def _check_exists(self):
         return os.path.exists(self.dataset_path) and os.path.exists(os.path.join(self.dataset_path, 'train_questions.h5'))
@@ -139,8 +145,7 @@ class CLEVRDataset(Dataset):
         if idx >= len(self):
             idx = idx%len(self)
 
-        _, target = self.dataset[idx]
-        return target
+        return self.idx2question_family[idx]
 
     def __getitem__(self, idx):
         """
@@ -153,7 +158,8 @@ class CLEVRDataset(Dataset):
         if idx >= len(self):
             idx = idx%len(self)
 
-        img_path, target = self.dataset[idx]
+        img_path = os.path.join(self.dataset_path, self.image_idx2path[idx])
+        target = self.idx2question_family[idx]
 
         img = cv2.imread(img_path)
         img = np.asarray(img, dtype=np.float32)
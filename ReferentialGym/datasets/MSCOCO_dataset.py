@@ -28,45 +28,69 @@ class MSCOCODataset(CocoDetection):
         for idx, cat in enumerate(self.cats):
             self.cats_idx[cat['id']] = idx
         
-        self.latent_values = []
-        self.targets = []
-        nbr_removed_imgs = 0
-        idx = 0
-        while idx < len(self.ids):
-            img_id = self.ids[idx]
-            ann_ids = self.coco.getAnnIds(imgIds=img_id)
-            target = self.coco.loadAnns(ann_ids)
-            if len(target):
-                self.latent_values.append(np.zeros(len(self.cats_names)))
-                for bb in target:
-                    self.latent_values[-1][self.cats_idx[bb['category_id']]] = 1 
-                # The target is simply choosen randomly from all the bounding box' category id...
-                rnd_bbox = np.random.randint(0, len(target))
-                #self.targets.append(np.array([self.cats_idx[target[rnd_bbox]['category_id']]]))
-                self.targets.append(self.cats_idx[target[rnd_bbox]['category_id']])
-                idx += 1
-            else:
-                del self.ids[idx]
-                nbr_removed_imgs += 1
-                if VERBOSE: print(f'WARNING: removing Image ID {img_id}...')
+        self._filter_and_index_images()
 
         print('Dataset loaded : OK.')
-        print(f'Nbr removed image: {nbr_removed_imgs}.')
+        print(f'Nbr removed image: {self.nbr_removed_imgs}.')
 
         self.data_suffix = data_suffix
         self.extract_features = extract_features
-        
+        self.features_path = os.path.join(self.root, 'features.'+self.data_suffix)
+        self.features_ids_path = os.path.join(self.root, 'features_ids.'+self.data_suffix)
+        self.features = None
+        self.features_rows = None
+
         self.transfer_learning = transfer_learning
         if self.extract_features is not None:
             self.make_tl_dataset()
-            
+        if self.transfer_learning and os.path.exists(self.features_ids_path):
+            self._index_features()
+
+    def _filter_and_index_images(self):
+        """
+        Removes the images without annotations and computes, in one vectorized pass
+        over the annotations, the multi-hot `latent_values` of each remaining image,
+        as well as its target, which is simply choosen randomly from all 
+        the bounding box' category id...
+        """
+        id2pos = {img_id: pos for pos, img_id in enumerate(self.ids)}
+        anns = self.coco.dataset.get('annotations', [])
+        ann_pos = np.fromiter((id2pos.get(ann['image_id'], -1) for ann in anns), dtype=np.int64, count=len(anns))
+        ann_cat = np.fromiter((self.cats_idx[ann['category_id']] for ann in anns), dtype=np.int64, count=len(anns))
+        valid = ann_pos >= 0
+        ann_pos, ann_cat = ann_pos[valid], ann_cat[valid]
+
+        latent_values = np.zeros((len(self.ids), len(self.cats_names)))
+        latent_values[ann_pos, ann_cat] = 1
+        
+        # Random bounding box per image: 
+        order = np.argsort(ann_pos, kind='stable')
+        nbr_anns = np.bincount(ann_pos, minlength=len(self.ids))
+        offsets = np.cumsum(nbr_anns)-nbr_anns
+        keep = nbr_anns > 0
+        rnd_bbox = (np.random.rand(keep.sum())*nbr_anns[keep]).astype(np.int64)
+        targets = ann_cat[order][offsets[keep]+rnd_bbox]
+
+        self.nbr_removed_imgs = int((~keep).sum())
+        if VERBOSE:
+            for img_id in np.asarray(self.ids)[~keep]:
+                print(f'WARNING: removing Image ID {img_id}...')
+
+        self.ids = [img_id for img_id, k in zip(self.ids, keep) if k]
+        self.latent_values = latent_values[keep]
+        self.targets = targets.tolist()
+
     def make_tl_dataset(self):
+        """
+        Extracts the features of every image into one memory-mapped array,
+        whose rows are associated with the image ids stored alongside.
+        """
         print("Building Transfer Learning Dataset: ...")
+        features = None
         for idx in tqdm(range(len(self))):
             img_id = self.ids[idx]
 
             path = self.coco.loadImgs(img_id)[0]['file_name']
-            tl_path = path+self.data_suffix
             
             target = self.getclass(idx)
             
@@ -74,10 +98,41 @@ class MSCOCODataset(CocoDetection):
             if self.transforms is not None:
                 img, _ = self.transforms(img, target)
             img = self.extract_features(img).numpy()
-            np.save(os.path.join(self.root, tl_path), img)
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    self.features_path+'.tmp', 
+                    mode='w+', 
+                    dtype=img.dtype, 
+                    shape=(len(self), *img.shape),
+                )
+            features[idx] = img
+        
+        if features is not None:
+            features.flush()
+            del features
+            os.replace(self.features_path+'.tmp', self.features_path)
+            with open(self.features_ids_path, 'wb') as f:
+                np.save(f, np.asarray(self.ids, dtype=np.int64))
             
         self.extract_features = None 
 
+    def _index_features(self):
+        features_ids = np.load(self.features_ids_path)
+        id2row = {img_id: row for row, img_id in enumerate(features_ids.tolist())}
+        self.features_rows = np.asarray([id2row.get(img_id, -1) for img_id in self.ids], dtype=np.int64)
+        # The memory-map is opened lazily, so that each DataLoader worker gets its own:
+        self.features = None
+
+    def _get_features(self, index):
+        if self.features is None:
+            self.features = np.load(self.features_path, mmap_mode='r')
+        return np.array(self.features[self.features_rows[index]])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['features'] = None
+        return state
+
     def __len__(self):
         return len(self.targets)
 
@@ -94,9 +149,12 @@ class MSCOCODataset(CocoDetection):
         latent_value = torch.from_numpy(self.getlatentvalue(index))
         
         path = self.coco.loadImgs(img_id)[0]['file_name']
-        tl_path = path+self.data_suffix
-
-        if self.transfer_learning:
+        
+        if self.transfer_learning and self.features_rows is not None and self.features_rows[index] >= 0:
+            img = torch.from_numpy(self._get_features(index))
+        elif self.transfer_learning:
+            # Legacy per-image feature files:
+            tl_path = path+self.data_suffix
             img = np.load(os.path.join(self.root, tl_path))
             img = torch.from_numpy(img)  
         else:
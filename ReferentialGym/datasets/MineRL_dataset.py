@@ -1,12 +1,14 @@
 from typing import Dict, List, Tuple
 import os
+import json
 import numpy as np
 import random
+from collections import OrderedDict
 from tqdm import tqdm
 
 import torch
 
-import minerl
+import cv2
 from PIL import Image 
 
 from .dataset import Dataset, shuffle
@@ -19,13 +21,27 @@ class MineRLDataset(Dataset):
                        transform=None, 
                        download=False, 
                        experiments=['MineRLObtainDiamond-v0'], 
-                       skip_interval=0):
+                       skip_interval=0,
+                       nbr_trajectories=20,
+                       window_cache_size=64):
+        """
+        The trajectories are only indexed, by (trajectory, frame-window) offsets, at initialisation.
+        The frames of a window are decoded from the trajectory's recording when first requested,
+        and kept in a small LRU cache of decoded windows.
+
+        :param skip_interval: int number of consecutive frames in each window.
+        :param nbr_trajectories: int number of trajectories (per experiment) to split 
+                                 between training and testing, or None to use them all.
+        :param window_cache_size: int maximal number of decoded windows that are kept in memory.
+        """
         super(MineRLDataset, self).__init__(kwargs=kwargs)
         
         self.kwargs = kwargs
         self.root = root
         self.experiments2use = experiments
         self.skip_interval = skip_interval
+        self.window_cache_size = window_cache_size
+        self.window_cache = OrderedDict()
         
         if download:
             self._download()
@@ -33,18 +49,14 @@ class MineRLDataset(Dataset):
         if not self._check_exists():
             raise RuntimeError('Dataset not found. You can use download=True to download it.')
 
+        self.dataset_exp_trajname = { exp: self._get_trajectory_names(exp) for exp in self.experiments2use}
 
-        self.dataset_exp = {exp: minerl.data.make(exp, data_dir=self.root) for exp in self.experiments2use}
-        self.dataset_exp_trajname = { exp: self.dataset_exp[exp].get_trajectory_names() for exp in self.experiments2use}
-        self.dataset_exp_traj_data = {exp: dict() for exp in self.experiments2use}
-
-        nbrTraj = 20
+        nbrTraj = nbr_trajectories
+        if nbrTraj is None: nbrTraj = max([len(names) for names in self.dataset_exp_trajname.values()]+[0])
         nbrTrajTestDivider = 10
-        self.dataset_exptraj_data_loaded = dict()
         self.exptraj2int = dict()
         exptrajIdx = 0 
         for exp in self.experiments2use:
-            self.dataset_exptraj_data_loaded[exp] = dict()
             dataset_exp_trajname = list()
             for idxtraj, trajname in enumerate(self.dataset_exp_trajname[exp][:nbrTraj]):
                 if train:
@@ -53,10 +65,6 @@ class MineRLDataset(Dataset):
                     if idxtraj % 2 == 1 or idxtraj > nbrTraj//nbrTrajTestDivider: continue
 
                 dataset_exp_trajname.append(trajname)
-                self.dataset_exp_traj_data[exp][trajname] = self.dataset_exp[exp].load_data(stream_name=trajname, 
-                                                                                            skip_interval=0,
-                                                                                            include_metadata=False)
-                self.dataset_exptraj_data_loaded[exp+trajname] = True 
                 self.exptraj2int[exp+trajname] = exptrajIdx
                 exptrajIdx += 1
             self.dataset_exp_trajname[exp] = dataset_exp_trajname
@@ -73,18 +81,14 @@ class MineRLDataset(Dataset):
         for exp in self.experiments2use:
             print(f'Experiment:: {exp} :: nbr of trajectories:: {len(self.dataset_exp_trajname[exp])}.')
             for trajname in tqdm(self.dataset_exp_trajname[exp]):
-                self.trajectories[exp+trajname] = self.dataset_exp_traj_data[exp][trajname]
-
-                exptraj_data = []
-                traj = list(self.trajectories[exp+trajname])
-                traj_len = len(traj)
-                traj_seq_len = traj_len // self.skip_interval
-                for idx_traj_seq in range(traj_seq_len):
-                    traj_seq = [t[0]['pov'] for t in traj[idx_traj_seq*self.skip_interval:(idx_traj_seq+1)*self.skip_interval]]
-                    exptraj_data.append(traj_seq)
-                self.trajectories[exp+trajname] = exptraj_data
-
-                self.class2len[exp+trajname] = len(self.trajectories[exp+trajname])
+                traj_dir = os.path.join(self.root, exp, trajname)
+                traj_len, frame_offset = self._index_trajectory(traj_dir)
+                self.trajectories[exp+trajname] = {
+                    'video_path': os.path.join(traj_dir, 'recording.mp4'),
+                    'frame_offset': frame_offset,
+                }
+
+                self.class2len[exp+trajname] = traj_len // self.skip_interval
                 for idx in range(self.class2len[exp+trajname]):
                     self.dataset.append( (idx, exp+trajname))
 
@@ -100,6 +104,12 @@ class MineRLDataset(Dataset):
     def __len__(self) -> int:
         return len(self.dataset)
 
+    def __getstate__(self):
+        # The decoded windows are not shipped to the DataLoader workers:
+        state = self.__dict__.copy()
+        state['window_cache'] = OrderedDict()
+        return state
+
     def getNbrClasses(self) -> int:
         return len(self.trajectories)
     
@@ -117,10 +127,76 @@ class MineRLDataset(Dataset):
         if self._check_exists():
             return
         
+        import minerl
         for exp in self.experiments2use:
             if not self._check_exists(experiments2use=[exp]):
                 minerl.data.download(self.root, experiment=exp)
 
+    def _get_trajectory_names(self, exp):
+        """
+        Lists, in a deterministic order, the trajectories of :param exp: 
+        that hold both a recording and its rendered data, as MineRL's data pipeline does.
+        """
+        exp_dir = os.path.join(self.root, exp)
+        if not os.path.isdir(exp_dir):  return []
+        trajnames = []
+        for trajname in sorted(os.listdir(exp_dir)):
+            traj_dir = os.path.join(exp_dir, trajname)
+            if os.path.isfile(os.path.join(traj_dir, 'recording.mp4'))\
+                and os.path.isfile(os.path.join(traj_dir, 'rendered.npz')):
+                trajnames.append(trajname)
+        return trajnames
+
+    def _index_trajectory(self, traj_dir):
+        """
+        :returns:
+            - traj_len: int number of states (with an action and a reward) in the trajectory.
+            - frame_offset: int index of the video frame of the first state, 
+                            following MineRL's data pipeline alignment.
+        """
+        with np.load(os.path.join(traj_dir, 'rendered.npz'), allow_pickle=True) as rendered:
+            traj_len = len(rendered['reward'])
+        
+        nbr_frames = None
+        meta_path = os.path.join(traj_dir, 'metadata.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                nbr_frames = json.load(f).get('true_video_frame_count', None)
+        if nbr_frames is None:
+            cap = cv2.VideoCapture(os.path.join(traj_dir, 'recording.mp4'))
+            nbr_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+        # The video holds the terminal state too:
+        frame_offset = max(0, nbr_frames-(traj_len+1))
+        return traj_len, frame_offset
+
+    def _decode_window(self, exptraj, idx_in_exptraj):
+        """
+        :returns: List of the skip_interval RGB frames of the window :param idx_in_exptraj:
+                  of the trajectory :param exptraj:, decoded on the first request only.
+        """
+        key = (exptraj, idx_in_exptraj)
+        if key in self.window_cache:
+            self.window_cache.move_to_end(key)
+            return self.window_cache[key]
+
+        traj = self.trajectories[exptraj]
+        cap = cv2.VideoCapture(traj['video_path'])
+        cap.set(cv2.CAP_PROP_POS_FRAMES, traj['frame_offset']+idx_in_exptraj*self.skip_interval)
+        imgs = []
+        for _ in range(self.skip_interval):
+            ret, frame = cap.read()
+            if not ret: break
+            imgs.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        cap.release()
+        if len(imgs) == 0:
+            raise RuntimeError(f"Unable to decode window {idx_in_exptraj} of trajectory {exptraj}.")
+
+        self.window_cache[key] = imgs
+        if len(self.window_cache) > self.window_cache_size:
+            self.window_cache.popitem(last=False)
+        return imgs
+
     def getclass(self, idx):
         if idx >= len(self):
             idx = idx%len(self)
@@ -141,7 +217,7 @@ class MineRLDataset(Dataset):
 
         idx_in_exptraj, exptraj = self.dataset[idx]
 
-        imgs, target = self.trajectories[exptraj][idx_in_exptraj], self.exptraj2int[exptraj]
+        imgs, target = self._decode_window(exptraj, idx_in_exptraj), self.exptraj2int[exptraj]
         
         if focus_on_sides:
             s1 = random.randint(0,len(imgs)//8)
@@ -3,6 +3,8 @@ import torch
 from torch.utils.data import Dataset 
 import os
 import copy
+import hashlib
+import multiprocessing
 
 import numpy as np
 import pybullet as pb 
@@ -16,6 +18,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import pickle 
 
+from .utils import RenderCache, SuperpixelLabelsCache
+from .split_engine import divider_split_indices, combinatorial_split_indices, compositional_split_indices, cached_split
+
 # Reproducing: 
 # http://alumni.media.mit.edu/~wad/color/numbers.html      
 # without white...
@@ -352,6 +357,93 @@ def generate_datapoint(
     return img
 
 
+# Physics client of each rendering worker process:
+_worker_physicsClient = None
+
+def _init_render_worker():
+    global _worker_physicsClient
+    _worker_physicsClient = pb.connect(pb.DIRECT)
+
+
+def _render_chunk(args):
+    indices, latents_one_hot, latents_values, latents_classes, render_kwargs = args
+    physicsClient = _worker_physicsClient
+    if physicsClient is None:
+        physicsClient = pb.connect(pb.DIRECT)
+    imgs = []
+    for one_hot, values, classes in zip(latents_one_hot, latents_values, latents_classes):
+        imgs.append(
+            generate_datapoint(
+                latent_one_hot=one_hot,
+                latent_values=values,
+                latent_classes=classes,
+                physicsClient=physicsClient,
+                **render_kwargs,
+            )
+        )
+    return indices, np.stack(imgs, axis=0)
+
+
+def render_dataset(cache,
+                   indices,
+                   latents_one_hot,
+                   latents_values,
+                   latents_classes,
+                   render_kwargs,
+                   nbr_workers=None,
+                   chunk_size=64):
+    '''
+    Renders the images of :param indices: that are missing from :param cache:,
+    with a pool of worker processes that each own a `pb.DIRECT` physics client.
+    Each rendered chunk is written and flushed to the cache as soon as it is available,
+    so that an interrupted rendering resumes where it stopped.
+
+    :param cache: RenderCache where the images are stored.
+    :param indices: Iterable of int indices of the images to render.
+    :param latents_one_hot: Numpy Array of shape (nb_images, latent_one_hot_size).
+    :param latents_values: Numpy Array of shape (nb_images, nb_latent_attr).
+    :param latents_classes: Numpy Array of shape (nb_images, nb_latent_attr).
+    :param render_kwargs: Dict of the remaining kwargs of `generate_datapoint`, but `physicsClient`.
+    :param nbr_workers: int number of worker processes (default: number of CPUs).
+                        If 0, the images are rendered in the calling process.
+    :param chunk_size: int number of images rendered by a worker in one go.
+    '''
+    missing_indices = cache.missing_indices(indices)
+    if len(missing_indices) == 0:
+        return
+    if nbr_workers is None:
+        nbr_workers = os.cpu_count() or 1
+
+    chunks = [
+        (
+            chunk, 
+            latents_one_hot[chunk], 
+            latents_values[chunk], 
+            latents_classes[chunk], 
+            render_kwargs
+        )
+        for chunk in np.array_split(missing_indices, max(1, int(np.ceil(len(missing_indices)/chunk_size))))
+    ]
+    
+    print(f'Rendering {len(missing_indices)} images with {nbr_workers} worker(s)...')
+    pbar = tqdm(total=len(missing_indices))
+    if nbr_workers == 0:
+        _init_render_worker()
+        results = map(_render_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(processes=nbr_workers, initializer=_init_render_worker)
+        results = pool.imap_unordered(_render_chunk, chunks)
+    try:
+        for chunk, imgs in results:
+            cache.put(chunk, imgs, flush=True)
+            pbar.update(len(chunk))
+    finally:
+        pbar.close()
+        if nbr_workers != 0:
+            pool.terminate()
+            pool.join()
+    
+
 def generate_dataset(root,
                      img_size=32,
                      nb_samples=100,
@@ -460,7 +552,22 @@ class _3DShapesPyBulletDataset(Dataset) :
                  transform=None, 
                  generate=False,
                  split_strategy=None,
+                 offline_rendering=True,
+                 nbr_render_workers=None,
+                 render_chunk_size=64,
+                 with_superpixel_labels=False,
                  ):
+        '''
+        :param offline_rendering: boolean defining whether to render all the images
+                                  of the dataset upon initialisation, in parallel,
+                                  rather than lazily, upon access.
+        :param nbr_render_workers: int number of rendering worker processes (default: number of CPUs).
+        :param render_chunk_size: int number of images rendered by a worker in one go.
+        :param with_superpixel_labels: boolean defining whether to yield the superpixel labels
+                                       of the images, as `'exp_superpixel_labels'`, e.g. for the
+                                       compactness constraint of MONet. They are cached on disk.
+                                       The transform must then preserve the image size.
+        '''
         super(_3DShapesPyBulletDataset, self).__init__()
         
         self.root = root
@@ -475,6 +582,10 @@ class _3DShapesPyBulletDataset(Dataset) :
         self.train = train 
         self.generate = generate
         self.transform = transform 
+        self.offline_rendering = offline_rendering
+        self.nbr_render_workers = nbr_render_workers
+        self.render_chunk_size = render_chunk_size
+        self.with_superpixel_labels = with_superpixel_labels
         
         self.physicsClient = None
         if generate or not self._check_exists():
@@ -699,71 +810,41 @@ class _3DShapesPyBulletDataset(Dataset) :
             self.divider = 1
             self.offset = 0
 
-        self.indices = []
         if self.split_strategy is None or 'divider' in self.split_strategy:
-            for idx in range(len(self.latents_values)):
-                if idx % self.divider == self.offset:
-                    self.indices.append(idx)
-
             self.train_ratio = 0.8
-            # Shuffled:
-            np.random.shuffle(np.asarray(self.indices))
-            
-            end = int(len(self.indices)*self.train_ratio)
-            if self.train:
-                self.indices = self.indices[:end]
-            else:
-                self.indices = self.indices[end:]
+            self.indices = divider_split_indices(
+                nbr_samples=len(self.latents_values),
+                divider=self.divider,
+                offset=self.offset,
+                train=self.train,
+                train_ratio=self.train_ratio,
+            )
 
             print(f"Split Strategy: {self.split_strategy} --> d {self.divider} / o {self.offset}")
             print(f"Dataset Size: {len(self.indices)} out of {len(self.latents_values)}: {100*len(self.indices)/len(self.latents_values)}%.")
         elif 'combinatorial' in self.split_strategy:
-            indices_latents = list(zip(range(self.latents_classes.shape[0]), self.latents_classes))
-            for idx, latent_class in indices_latents:
-                effective_test_threshold = self.counter_test_threshold
-                counter_test = {}
-                skip_it = False
-                filler_forced_training = False
-                for dim_name, dim_dict in self.latent_dims.items():
-                    dim_class = latent_class[dim_dict['position']]
-                    quotient = (dim_class+1)//dim_dict['divider']
-                    remainder = (dim_class+1)%dim_dict['divider']
-                    if remainder!=dim_dict['remainder_use']:
-                        skip_it = True
-                        break
-
-                    if dim_dict['primitive']:
-                        ordinal = quotient
-                        if ordinal > dim_dict['nbr_fillers']:
-                            effective_test_threshold -= 1
-
-                    if 'test_set_divider' in dim_dict and quotient%dim_dict['test_set_divider']==0:
-                        counter_test[dim_name] = 1
-                    elif 'test_set_size_sample_from_end' in dim_dict:
-                        max_quotient = dim_dict['size']//dim_dict['divider']
-                        if quotient > max_quotient-dim_dict['test_set_size_sample_from_end']:
-                            counter_test[dim_name] = 1
-                    elif 'test_set_size_sample_from_start' in dim_dict:
-                        max_quotient = dim_dict['size']//dim_dict['divider']
-                        if quotient <= dim_dict['test_set_size_sample_from_start']:
-                            counter_test[dim_name] = 1
-
-                    if dim_name in counter_test:
-                        self.test_latents_mask[idx, dim_dict['position']] = 1
-                        
-                if skip_it: continue
-
-
-                if self.train:
-                    if len(counter_test) >= effective_test_threshold:#self.counter_test_threshold:
-                        continue
-                    else:
-                        self.indices.append(idx)
-                else:
-                    if len(counter_test) >= effective_test_threshold:#self.counter_test_threshold:
-                        self.indices.append(idx)
-                    else:
-                        continue
+            def compute_split():
+                indices, test_latents_mask = combinatorial_split_indices(
+                    latents_classes=self.latents_classes,
+                    latent_dims=self.latent_dims,
+                    counter_test_threshold=self.counter_test_threshold,
+                    train=self.train,
+                )
+                return {"indices":indices, "test_latents_mask":test_latents_mask}
+            
+            split = cached_split(
+                cache_dir=os.path.join(self.root, "splits"),
+                config={
+                    "split_strategy":self.split_strategy,
+                    "train":self.train,
+                    "latent_dims":self.latent_dims,
+                    "counter_test_threshold":self.counter_test_threshold,
+                },
+                latents_classes=self.latents_classes,
+                compute_fn=compute_split,
+            )
+            self.indices = split["indices"]
+            self.test_latents_mask = split["test_latents_mask"]
 
             print(f"Split Strategy: {self.split_strategy}")
             print(self.latent_dims)
@@ -773,16 +854,15 @@ class _3DShapesPyBulletDataset(Dataset) :
                 "No valid data, maybe try a smaller divider..."
 
         elif 'compositional' in self.split_strategy:
-            self.indices = []
-            for idx in range(self.latents_classes.shape[0]):
-                shape_id = self.latents_classes[idx][1]
-                color_id = self.latents_classes[idx][0]
-
-                color_selection = self.training_shape_2_possible_colors
-                if not(self.train): color_selection = self.testing_shape_2_possible_colors
-                
-                if color_id in color_selection[shape_id]:
-                    self.indices.append(idx)
+            color_selection = self.training_shape_2_possible_colors
+            if not(self.train): color_selection = self.testing_shape_2_possible_colors
+            # (color, shape, sample)
+            self.indices = compositional_split_indices(
+                latents_classes=self.latents_classes,
+                primary_position=1,
+                secondary_position=0,
+                primary_2_possible_secondaries=color_selection,
+            )
 
             print(f"Dataset Size: {len(self.indices)} out of {len(self.latents_values)}: {100*len(self.indices)/len(self.latents_values)}%.")
 
@@ -795,7 +875,10 @@ class _3DShapesPyBulletDataset(Dataset) :
         self.targets = self.targets[self.indices]
         """
 
-        #self._generate_all()
+        self._init_render_cache(legacy_imgs=self.imgs)
+        if self.offline_rendering:
+            self._generate_all()
+
         self.same_color_indices = {}
         self.same_shape_indices = {}
         self.latents_to_possible_indices = {}
@@ -819,64 +902,87 @@ class _3DShapesPyBulletDataset(Dataset) :
 
         print('Dataset loaded : OK.')
     
-    def _save_generated_dataset(self):
-        if self._check_exists():
-            filepath = os.path.join(self.root, self.file)
-            with open(filepath, 'rb') as f:
-              dataset, _, _, _, _, _ = pickle.load(f)
-            
-            dataset["imgs"].update(self.imgs)
-        else:
-            dataset = {
-                "imgs":self.imgs,
-                "latents_values":self.latents_values,
-                "latents_classes":self.latents_classes,
-                "latents_one_hot":self.latents_one_hot,
-            }
-
-        print('saving datasets...')
-        filename = os.path.join(self.root,self.file)
-        with  open(filename, 'wb') as f:
-            pickle.dump((dataset, self.nb_shapes, self.nb_colors, self.nb_samples, self.sampled_positions, self.sampled_orientation), f)
-        print('Datasets saved at {}'.format(filename))
+    def _init_render_cache(self, legacy_imgs=None):
+        """
+        Opens the on-disk cache of the rendered images, which is identified by the
+        generation parameters of the dataset, and migrates into it the images of
+        :param legacy_imgs:, i.e. the ones stored in previous versions of the pickled dataset.
+        """
+        fingerprint = hashlib.sha1()
+        # The z-coordinates of the sampled positions are overwritten upon rendering:
+        fingerprint.update(np.asarray(self.sampled_positions, dtype=np.float64)[:,:2].tobytes())
+        fingerprint.update(np.asarray(self.sampled_orientation, dtype=np.float64).tobytes())
+        fingerprint.update(str((self.img_size, self.nb_shapes, self.nb_colors, self.nb_samples)).encode())
+        fingerprint = fingerprint.hexdigest()[:16]
+
+        self.render_cache = RenderCache(
+            path=os.path.join(self.root, f"3d_shapes_pybullet_renders-{fingerprint}"),
+            nbr_images=len(self.latents_classes),
+            image_shape=(3, self.img_size, self.img_size),
+            dtype=np.uint8,
+            meta={"fingerprint":fingerprint},
+        )
+
+        self.superpixel_labels_cache = None
+        if self.with_superpixel_labels:
+            self.superpixel_labels_cache = SuperpixelLabelsCache(
+                path=os.path.join(self.root, f"3d_shapes_pybullet_superpixels-{fingerprint}"),
+                nbr_images=len(self.latents_classes),
+                image_size=(self.img_size, self.img_size),
+            )
+
+        if legacy_imgs is not None and len(legacy_imgs):
+            legacy_indices = self.render_cache.missing_indices(list(legacy_imgs.keys()))
+            if len(legacy_indices):
+                self.render_cache.put(
+                    legacy_indices, 
+                    np.stack([legacy_imgs[idx] for idx in legacy_indices], axis=0),
+                    flush=True,
+                )
+        self.imgs = None
+
+    def _render_kwargs(self):
+        return {
+            "img_size":self.img_size,
+            "nb_shapes":self.nb_shapes,
+            "nb_colors":self.nb_colors,
+            "nb_samples":self.nb_samples,
+            "sampled_positions":self.sampled_positions,
+            "sampled_orientation":self.sampled_orientation,
+        }
 
     def _generate_all(self):
-        pbar = tqdm(total=len(self.indices))
-        for idx in self.indices:
-            pbar.update(1)
-            if idx in self.imgs:    continue
-            self._generate_datapoint(idx=idx)
+        render_dataset(
+            cache=self.render_cache,
+            indices=self.indices,
+            latents_one_hot=self.latents_one_hot,
+            latents_values=self.latents_values,
+            latents_classes=self.latents_classes,
+            render_kwargs=self._render_kwargs(),
+            nbr_workers=self.nbr_render_workers,
+            chunk_size=self.render_chunk_size,
+        )
 
     def _generate_datapoint(self, idx):
-        latents_values = self.latents_values[idx]
-        latents_one_hot = self.latents_one_hot[idx]
-        latents_classes = self.latents_classes[idx]
-        
         if self.physicsClient is None:
             self.physicsClient = pb.connect(pb.DIRECT)
 
         rgb_img = generate_datapoint(
-            latent_one_hot=latents_one_hot, 
-            latent_values=latents_values,
-            latent_classes=latents_classes,
-            img_size=self.img_size,
-            nb_shapes=self.nb_shapes,
-            nb_colors=self.nb_colors,
-            nb_samples=self.nb_samples,
-            sampled_positions=self.sampled_positions,
-            sampled_orientation=self.sampled_orientation,
+            latent_one_hot=self.latents_one_hot[idx], 
+            latent_values=self.latents_values[idx],
+            latent_classes=self.latents_classes[idx],
             physicsClient=self.physicsClient,
+            **self._render_kwargs(),
         )
 
-        self.imgs[idx] = rgb_img
+        self.render_cache.put(idx, rgb_img)
 
-        if all([(index in self.imgs) for index in self.indices]):
-            self._save_generated_dataset()
-            # will only be called once, when the last element has just been generated, 
-            # since this whole function will never be called again after all elements
-            # are generated...
+    def __getstate__(self):
+        # Physics clients are process-specific:
+        state = self.__dict__.copy()
+        state["physicsClient"] = None
+        return state
 
-        
     def __len__(self) -> int:
         return len(self.indices)
     
@@ -956,14 +1062,17 @@ class _3DShapesPyBulletDataset(Dataset) :
         latent_one_hot = torch.from_numpy(self.getlatentonehot(idx))
         test_latents_mask = torch.from_numpy(self.gettestlatentmask(idx))
 
-        if trueidx not in self.imgs:    
+        if not self.render_cache.is_done(trueidx):    
             self._generate_datapoint(idx=trueidx)
 
-        img = self.imgs[trueidx]
+        img = self.render_cache.get(trueidx)
         target = self.getclass(idx)
                 
         #img = (img*255).astype('uint8').transpose((2,1,0))
         img = img.transpose((2,1,0))
+        superpixel_labels = None
+        if self.superpixel_labels_cache is not None:
+            superpixel_labels = torch.from_numpy(self.superpixel_labels_cache.get(trueidx, img)).long()
         img = Image.fromarray(img, mode='RGB')
 
         if self.transform is not None:
@@ -977,5 +1086,7 @@ class _3DShapesPyBulletDataset(Dataset) :
             "exp_latents_one_hot_encoded":latent_one_hot,
             "exp_test_latents_masks":test_latents_mask,
         }
+        if superpixel_labels is not None:
+            sampled_d["exp_superpixel_labels"] = superpixel_labels
         
         return sampled_d
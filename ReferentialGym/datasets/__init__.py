@@ -1,29 +1,42 @@
+import importlib
+
 from .dataset import Dataset, shuffle
-from .dict_dataset_wrapper import DictDatasetWrapper 
+from .dict_dataset_wrapper import DictDatasetWrapper
 from .labeled_dataset import LabeledDataset
 from .dual_labeled_dataset import DualLabeledDataset
 
-from .CLEVR_dataset import CLEVRDataset
-from .sort_of_CLEVR_dataset import SortOfCLEVRDataset
-from .extended_sort_of_CLEVR_dataset import XSortOfCLEVRDataset
-#from .ah_so_CLEVR_dataset import AhSoCLEVRDataset
-from .spatial_queries_on_object_tuples_dataset import SQOOTDataset 
+from .utils import collate_dict_wrapper, ResizeNormalize, RescaleNormalize, ResumableRandomSampler, RenderCache, SuperpixelLabelsCache
+
+# The concrete datasets, and their (optional) dependencies, e.g. cv2, h5py, pycocotools,
+# pybullet or minerl, are only imported when first accessed:
+_lazy_datasets = {
+	"CLEVRDataset": (".CLEVR_dataset", None),
+	"SortOfCLEVRDataset": (".sort_of_CLEVR_dataset", None),
+	"XSortOfCLEVRDataset": (".extended_sort_of_CLEVR_dataset", None),
+	#"AhSoCLEVRDataset": (".ah_so_CLEVR_dataset", None),
+	"SQOOTDataset": (".spatial_queries_on_object_tuples_dataset", None),
+	"_3DShapesPyBulletDataset": ("._3d_shapes_pybullet_dataset", "pybullet"),
+	"MineRLDataset": (".MineRL_dataset", "minerl"),
+	"dSpritesDataset": (".dSprites_dataset", None),
+	"MSCOCODataset": (".MSCOCO_dataset", None),
+}
+
 
-try:
-	import pybullet 
-	from ._3d_shapes_pybullet_dataset import _3DShapesPyBulletDataset 
-except Exception as e:
-	print(f"During importation of 3DShapesPyBulletDataset:{e}")
-	print("Please install pybullet if you want to use the 3DShapesPyBulletDataset.")
+def __getattr__(name):
+	if name not in _lazy_datasets:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	module_name, requirement = _lazy_datasets[name]
+	try:
+		module = importlib.import_module(module_name, __name__)
+	except Exception as e:
+		if requirement is None:
+			raise
+		raise ImportError(f"During importation of {name[1:] if name.startswith('_') else name}:{e}\n"\
+			f"Please install {requirement} if you want to use the {name}.") from e
+	value = getattr(module, name)
+	globals()[name] = value
+	return value
 
-try:
-	import minerl
-	from .MineRL_dataset import MineRLDataset
-except Exception as e:
-	print(f"During importation of MineRLDataset:{e}")
-	print("Please install minerl if you want to use the MineRLDataset.")
- 
-from .dSprites_dataset import dSpritesDataset
-from .MSCOCO_dataset import MSCOCODataset 
 
-from .utils import collate_dict_wrapper, ResizeNormalize, RescaleNormalize
+def __dir__():
+	return sorted(list(globals().keys())+list(_lazy_datasets.keys()))
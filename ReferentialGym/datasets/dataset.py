@@ -2,9 +2,10 @@ from typing import Dict, List, Tuple
 import torch
 from torch.utils.data.dataset import Dataset as torchDataset
 import numpy as np 
+import random
 import copy
 
-def shuffle(experiences, orders=None):
+def shuffle(experiences, orders=None, generator=None):
     st_size = experiences.shape
     batch_size = st_size[0]
     nbr_distractors_po = st_size[1]
@@ -13,7 +14,7 @@ def shuffle(experiences, orders=None):
     output_order = []
     for b in range(batch_size):
         if orders is None:
-            perm = torch.randperm(nbr_distractors_po)
+            perm = torch.randperm(nbr_distractors_po, generator=generator)
         else: 
             perm = orders[b]
         #if experiences.is_cuda: perm = perm.cuda()
@@ -60,7 +61,8 @@ class Dataset(torchDataset):
                from_class: List[int] = None, 
                excepts: List[int] = None,
                excepts_class: List[int]=None, 
-               target_only: bool = False) -> Dict[str,object]:
+               target_only: bool = False,
+               rng: random.Random = None) -> Dict[str,object]:
         '''
         Sample an experience from the dataset. Along with relevant distractor experiences.
         If :param from_class: is not None, the sampled experiences will belong to the specified class(es).
@@ -69,6 +71,8 @@ class Dataset(torchDataset):
         :param excepts: None, or List of indices (Integers) that are not considered for sampling.
         :param excepts_class: None, or List of keys (Strings or Integers) that corresponds to entries in self.classes.
         :param target_only: bool (default: `False`) defining whether to sample only the target or distractors too.
+        :param rng: None, or `random.Random` instance with which the distractors are sampled,
+                    e.g. from a background thread. If None, the global `random` state is used.
 
         :returns:
             - sample_d: Dict of:
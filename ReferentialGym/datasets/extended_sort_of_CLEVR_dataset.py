@@ -9,6 +9,8 @@ import cv2
 from PIL import Image 
 from tqdm import tqdm
 
+from .split_engine import random_holdout_split_indices
+
 
 def generate_dataset(root,
                      dataset_size=10000,
@@ -466,9 +468,11 @@ class XSortOfCLEVRDataset(Dataset):
         self.relational_as = {idx:np.stack(dataset[f'relational_as_{idx}']) for idx in range(self.nb_r_qs)}
         self.non_relational_as = {idx:np.stack(dataset[f'non_relational_as_{idx}']) for idx in range(self.nb_nr_qs)}
 
-        sampling_indices = np.random.randint(len(self.imgs), size=test_size)
-        if self.train:
-            sampling_indices = [idx for idx in range(len(self.imgs)) if idx not in sampling_indices]
+        sampling_indices = random_holdout_split_indices(
+            nbr_samples=len(self.imgs), 
+            test_size=test_size, 
+            train=self.train,
+        )
 
         self.imgs = self.imgs[sampling_indices]
         self.latents_values = self.latents_values[sampling_indices]
@@ -36,7 +36,8 @@ class LabeledDataset(Dataset):
                from_class: List[int] = None, 
                excepts: List[int] = None,
                excepts_class: List[int]=None, 
-               target_only: bool = False) -> Dict[str,object]:
+               target_only: bool = False,
+               rng: random.Random = None) -> Dict[str,object]:
         '''
         Sample an experience from the dataset. Along with relevant distractor experiences.
         If :param from_class: is not None, the sampled experiences will belong to the specified class(es).
@@ -47,6 +48,8 @@ class LabeledDataset(Dataset):
         :param excepts_class: None, or List of keys (Strings or Integers) that corresponds to entries in self.classes
                             to identifies classes to not sample from.
         :param target_only: bool (default: `False`) defining whether to sample only the target or distractors too.
+        :param rng: None, or `random.Random` instance with which the distractors are sampled,
+                    e.g. from a background thread. If None, the global `random` state is used.
 
         :returns:
             - sample_d: Dict of:
@@ -91,8 +94,9 @@ class LabeledDataset(Dataset):
             else:
                 test = False 
 
+        if rng is None: rng = random
         for choice_idx in range(nbr_samples):
-            chosen = random.choice( list(set_indices))
+            chosen = rng.choice( list(set_indices))
             set_indices.remove(chosen)
             indices.append( chosen)
 
@@ -4,6 +4,7 @@ from torch.utils.data import Dataset
 import os
 import pickle 
 import copy
+import hashlib
 import numpy as np
 import random
 import cv2
@@ -12,6 +13,9 @@ from PIL import Image
 import matplotlib.pyplot as plt 
 from tqdm import tqdm
 
+from .utils import RenderCache
+from .split_engine import divider_split_indices, combinatorial_split_indices, cached_split
+
 # Reproducing: 
 # http://alumni.media.mit.edu/~wad/color/numbers.html      
 # without white...
@@ -90,6 +94,46 @@ shapes = [
 
 
 
+def render_image(
+    latent_values,
+    img_size,
+    object_size,
+    fontScale,
+    thickness,
+    font):
+    '''
+    :param latent_values: Numpy Array of shape (nb_objects, nb_latent_attr). E.g. contains actual pixel positions.
+    :param img_size: Integer pixel size of the squared image.
+    :param object_size: Integer pixel size of the objects.
+    :param fontScale: Float (scale) size of the font used.
+    :param thickness: Integer thickness of the characters/shapes when drawn on the image.
+    :param font: name of the OpenCV font to use.
+    :returns: Numpy Array of shape (3, img_size, img_size) and dtype uint8.
+    '''
+    global colors
+    global shapes 
+
+    img = np.ones((img_size,img_size,3),dtype='uint8') * 255
+    for object_values in latent_values:  
+        color = colors[object_values[0]]
+        shape = shapes[object_values[1]]
+
+        # Draw a white square first, 
+        # to make the drawing clear enough,
+        # in case of overlapping:
+        start = (object_values[2]-object_size//2, object_values[3]-object_size//2)
+        end = (object_values[2]+object_size//2, object_values[3]+object_size//2)
+        img = cv2.rectangle(img, start, end, (255,255,255), -1)
+        
+        lowerLeftCorner = object_values[2:]
+        lowerLeftCorner = (lowerLeftCorner[0]-object_size//2, lowerLeftCorner[1]+object_size//2)   
+        img = cv2.putText(img, shape, lowerLeftCorner, font, fontScale, color, thickness, cv2.LINE_AA)
+
+    #img = (img/255.).transpose((2,0,1))
+    img = (img).astype('uint8').transpose((2,1,0))
+    return img
+
+
 def generate_datapoint(
     latent_one_hot, 
     latent_values, 
@@ -102,7 +146,8 @@ def generate_datapoint(
     nb_shapes,
     fontScale,
     thickness,
-    font):
+    font,
+    render=True):
     '''
     :param latent_one_hot: Numpy Array of shape (nb_objects, latent_one_hot_size)
     :param latent_values: Numpy Array of shape (nb_objects, nb_latent_attr). E.g. contains actual pixel positions.
@@ -116,6 +161,8 @@ def generate_datapoint(
     :param fontScale: Float (scale) size of the font used.
     :param thickness: Integer thickness of the characters/shapes when drawn on the image.
     :param font: name of the OpenCV font to use.
+    :param render: Boolean defining whether to render the image, or only to compute the questions and answers,
+                   in which case the returned image is None.
     '''
     global colors
     global shapes 
@@ -176,25 +223,20 @@ def generate_datapoint(
 
     objects = []
     # [color, shape, xpos, ypos]
-    img = np.ones((img_size,img_size,3),dtype='uint8') * 255
     for color_object_id, object_values in enumerate(latent_values):  
         objects.append(object_values)
-
         assert(color_object_id==object_values[0])
 
-        color = colors[object_values[0]]
-        shape = shapes[object_values[1]]
-
-        # Draw a white square first, 
-        # to make the drawing clear enough,
-        # in case of overlapping:
-        start = (object_values[2]-object_size//2, object_values[3]-object_size//2)
-        end = (object_values[2]+object_size//2, object_values[3]+object_size//2)
-        img = cv2.rectangle(img, start, end, (255,255,255), -1)
-        
-        lowerLeftCorner = object_values[2:]
-        lowerLeftCorner = (lowerLeftCorner[0]-object_size//2, lowerLeftCorner[1]+object_size//2)   
-        img = cv2.putText(img, shape, lowerLeftCorner, font, fontScale, color, thickness, cv2.LINE_AA)
+    img = None
+    if render:
+        img = render_image(
+            latent_values=latent_values,
+            img_size=img_size,
+            object_size=object_size,
+            fontScale=fontScale,
+            thickness=thickness,
+            font=font,
+        )
 
     rel_questions = {st:[] for st in range(nb_r_qs)}
     norel_questions = {st:[] for st in range(nb_nr_qs)}
@@ -602,9 +644,6 @@ def generate_datapoint(
     
     birelations = (birelq_questions, birelq_answers)
     
-    #img = (img/255.).transpose((2,0,1))
-    img = (img).astype('uint8').transpose((2,1,0))
-    
     datapoint = (img, 
         relations, 
         norelations, 
@@ -1018,23 +1057,23 @@ class SQOOTDataset(Dataset):
         self.latents_classes = np.asarray(dataset['latents_classes'])
         self.latents_one_hot = np.asarray(dataset['latents_one_hot'])
         
-        self.imgs = {} #np.asarray(dataset['imgs'])
-        
-        self.relational_qs = {idx:{} for idx in range(self.nb_r_qs)}
-        # nb_r_qs x |D| x nb_ojects x question_size
-        self.relational_as = {idx:{} for idx in range(self.nb_r_qs)}
-        # nb_r_qs x |D| x nb_ojects x 1
-
-        self.non_relational_qs = {idx:{} for idx in range(self.nb_nr_qs)}
-        # nb_nr_qs x |D| x nb_ojects x question_size
-        self.non_relational_as = {idx:{} for idx in range(self.nb_nr_qs)}
-        # nb_nr_qs x |D| x nb_ojects x 1
-
-        self.binary_relational_qs = {idx:{} for idx in range(self.nb_brq_qs)}
-        # nb_brq_qs x |D| x nb_ojects x nb_shapes x question_size
-        self.binary_relational_as = {idx:{} for idx in range(self.nb_brq_qs)}
-        # nb_brq_qs x |D| x nb_ojects x nb_shapes x 1
+        # Images are rendered at most once per machine, 
+        # into a file-backed cache shared by all the processes:
+        fingerprint = hashlib.sha1()
+        fingerprint.update(np.ascontiguousarray(self.latents_values).tobytes())
+        fingerprint.update(str((img_size, nb_objects, nb_shapes, font, fontScale, thickness)).encode())
+        fingerprint = fingerprint.hexdigest()[:16]
+        self.render_cache = RenderCache(
+            path=os.path.join(self.root, f"sqoot_renders-{fingerprint}"),
+            nbr_images=len(self.latents_values),
+            image_shape=(3, self.img_size, self.img_size),
+            dtype=np.uint8,
+            meta={"fingerprint":fingerprint},
+        )
+        self.fingerprint = fingerprint
 
+        textSize, _ = cv2.getTextSize("X", font, fontScale, thickness)
+        self.object_size = max(textSize)
         
         self.targets = np.zeros(len(self.latents_classes))
         for idx, latent_cls in enumerate(self.latents_classes):
@@ -1208,84 +1247,42 @@ class SQOOTDataset(Dataset):
             self.divider = 1
             self.offset = 0
 
-        self.indices = []
         if self.split_strategy is None or 'divider' in self.split_strategy:
-            for idx in range(len(self.latents_values)):
-                if idx % self.divider == self.offset:
-                    self.indices.append(idx)
-
             self.train_ratio = 0.8
-            # Shuffled:
-            np.random.shuffle(np.asarray(self.indices))
-            
-            end = int(len(self.indices)*self.train_ratio)
-            if self.train:
-                self.indices = self.indices[:end]
-            else:
-                self.indices = self.indices[end:]
+            self.indices = divider_split_indices(
+                nbr_samples=len(self.latents_values),
+                divider=self.divider,
+                offset=self.offset,
+                train=self.train,
+                train_ratio=self.train_ratio,
+            )
 
             print(f"Split Strategy: {self.split_strategy} --> d {self.divider} / o {self.offset}")
             print(f"Dataset Size: {len(self.indices)} out of {len(self.latents_values)}: {100*len(self.indices)/len(self.latents_values)}%.")
         elif 'combinatorial' in self.split_strategy:
-            indices_latents = list(zip(range(len(self.latents_classes)), self.latents_classes))
-            for idx, lc in indices_latents:
-                latent_class = lc.reshape((self.nb_objects,-1)).astype(int)
-                # (nb_objects, 4)
-                effective_test_threshold = self.counter_test_threshold
-                #counter_test = {}
-                counter_test = np.zeros((self.nb_objects,1))
-                # (nb_objects, 1)
-                skip_it = False
-                filler_forced_training = False
-                for dim_name, dim_dict in self.latent_dims.items():
-                    dim_class = latent_class[:,dim_dict['position']]
-                    # (nb_objects,)
-                    quotient = (dim_class+1)//dim_dict['divider']
-                    # (nb_objects,)
-                    remainder = (dim_class+1)%dim_dict['divider']
-                    # (nb_objects,)
-                    if any(remainder!=0):
-                        skip_it = True
-                        break
-
-                    if dim_dict['primitive']:
-                        ordinal = quotient
-                        # (nb_objects,)
-                        if any(ordinal > dim_dict['nbr_fillers']):
-                            effective_test_threshold -= 1
-                    elif dim_dict['image_wise_primitive']:
-                        ordinal = quotient
-                        how_many_IWP_values_per_object = (ordinal > dim_dict['nbr_fillers'])
-                        # (nb_objects,)
-                        how_many_primitive_values_in_image = how_many_IWP_values_per_object.sum()
-                        if how_many_primitive_values_in_image >= 2:
-                            effective_test_threshold -= 1
-
-                    if 'test_set_divider' in dim_dict: test1 = (quotient%dim_dict['test_set_divider']==0)
-                    if 'test_set_divider' in dim_dict and any(test1):
-                        counter_test = np.concatenate([counter_test, test1.reshape((-1,1))], axis=1)
-                    elif 'test_set_size_sample_from_end' in dim_dict:
-                        max_quotient = dim_dict['size']//dim_dict['divider']
-                        test2 = (quotient > max_quotient-dim_dict['test_set_size_sample_from_end'])
-                        if any(test2):
-                            counter_test = np.concatenate([counter_test, test2.reshape((-1,1))], axis=1)
-                    elif 'test_set_size_sample_from_start' in dim_dict:
-                        test3 = quotient <= dim_dict['test_set_size_sample_from_start']
-                        if any(test3):
-                            counter_test = np.concatenate([counter_test, test3.reshape((-1,1))], axis=1)
-
-                if skip_it: continue
-
-                if self.train:
-                    if any(counter_test.sum(-1) >= effective_test_threshold):
-                        continue
-                    else:
-                        self.indices.append(idx)
-                else:
-                    if any(counter_test.sum(-1) >= effective_test_threshold):
-                        self.indices.append(idx)
-                    else:
-                        continue
+            def compute_split():
+                indices, _ = combinatorial_split_indices(
+                    latents_classes=self.latents_classes,
+                    latent_dims=self.latent_dims,
+                    counter_test_threshold=self.counter_test_threshold,
+                    train=self.train,
+                    nb_objects=self.nb_objects,
+                )
+                return {"indices":indices}
+            
+            split = cached_split(
+                cache_dir=os.path.join(self.root, "splits"),
+                config={
+                    "split_strategy":self.split_strategy,
+                    "train":self.train,
+                    "latent_dims":self.latent_dims,
+                    "counter_test_threshold":self.counter_test_threshold,
+                    "nb_objects":self.nb_objects,
+                },
+                latents_classes=self.latents_classes,
+                compute_fn=compute_split,
+            )
+            self.indices = split["indices"]
 
             assert len(self.indices),\
                 "No valid data, maybe try a smaller divider..."
@@ -1333,8 +1330,6 @@ class SQOOTDataset(Dataset):
         self.latents_one_hot = self.latents_one_hot[self.indices]
 
         """
-        self.imgs = self.imgs[self.indices]
-        
         self.relational_qs = {k:v[self.indices] for k,v in self.relational_qs.items()}
         self.relational_as = {k:v[self.indices] for k,v in self.relational_as.items()}
         
@@ -1347,15 +1342,122 @@ class SQOOTDataset(Dataset):
 
         self.targets = self.targets[self.indices]
 
+        self._init_questions_answers()
+
         print('Dataset loaded : OK.')
     
+    @property
+    def training_rhs(self):
+        return self._training_rhs
+
+    @training_rhs.setter
+    def training_rhs(self, rhs):
+        self._training_rhs = rhs
+        self.rhs_gather_indices = {}
+
+    @property
+    def testing_rhs(self):
+        return self._testing_rhs
+
+    @testing_rhs.setter
+    def testing_rhs(self, rhs):
+        self._testing_rhs = rhs
+        self.rhs_gather_indices = {}
+
+    def _init_questions_answers(self):
+        """
+        Stacks the questions and answers of the dataset into contiguous tensors.
+        The questions only depend on the object and the subtype (and shape argument),
+        thus they are shared by all the datapoints, whereas the answers are computed
+        once per machine and stored in a file-backed cache alongside the rendered images.
+        """
+        O = self.nb_objects
+        S = self.nb_shapes
+        answer_sizes = [self.nb_r_qs*O, self.nb_nr_qs*O, self.nb_brq_qs*O*S]
+        self.answers_cache = RenderCache(
+            path=os.path.join(self.root, f"sqoot_answers-{self.fingerprint}"),
+            nbr_images=len(self.render_cache),
+            image_shape=(sum(answer_sizes),),
+            dtype=np.int16,
+            meta={"fingerprint":self.fingerprint, "nb_qs":[self.nb_r_qs, self.nb_nr_qs, self.nb_brq_qs]},
+        )
+
+        datapoint = None
+        missing_indices = set(self.answers_cache.missing_indices(self.indices).tolist())
+        if len(missing_indices):
+            print(f'Generating the answers of {len(missing_indices)} datapoints...')
+        for idx in tqdm(range(len(self)), disable=len(missing_indices)==0):
+            if self.indices[idx] not in missing_indices and datapoint is not None:    continue
+            datapoint = self._generate_datapoint(idx=idx)
+            if self.indices[idx] not in missing_indices:    continue
+            answers = np.concatenate([
+                np.asarray([datapoint[1][1][st] for st in range(self.nb_r_qs)]).reshape(-1),
+                np.asarray([datapoint[2][1][st] for st in range(self.nb_nr_qs)]).reshape(-1),
+                np.asarray([datapoint[3][1][st] for st in range(self.nb_brq_qs)]).reshape(-1),
+            ])
+            self.answers_cache.put(self.indices[idx], answers)
+        self.answers_cache.flush()
+
+        self.relational_qs = torch.from_numpy(np.asarray([datapoint[1][0][st] for st in range(self.nb_r_qs)])).float()
+        # nb_r_qs x nb_ojects x question_size
+        self.non_relational_qs = torch.from_numpy(np.asarray([datapoint[2][0][st] for st in range(self.nb_nr_qs)])).float()
+        # nb_nr_qs x nb_ojects x question_size
+        self.binary_relational_qs = torch.from_numpy(np.asarray([datapoint[3][0][st] for st in range(self.nb_brq_qs)])).float()
+        # nb_brq_qs x nb_ojects x nb_shapes x question_size
+
+        answers = torch.from_numpy(self.answers_cache.get(np.asarray(self.indices, dtype=np.int64))).long()
+        relational_as, non_relational_as, binary_relational_as = torch.split(answers, answer_sizes, dim=1)
+        self.relational_as = relational_as.reshape(len(self), self.nb_r_qs, O)
+        # |D| x nb_r_qs x nb_ojects
+        self.non_relational_as = non_relational_as.reshape(len(self), self.nb_nr_qs, O)
+        # |D| x nb_nr_qs x nb_ojects
+        self.binary_relational_as = binary_relational_as.reshape(len(self), self.nb_brq_qs, O, S, 1)
+        # |D| x nb_brq_qs x nb_ojects x nb_shapes x 1
+
+        self.object_indices = torch.arange(O).unsqueeze(-1)
+        # nb_objects x 1
+        self.rhs_gather_indices = {}
+
+    def _get_rhs_gather_indices(self):
+        """
+        :returns: LongTensor of shape (|D|, nb_objects, nb_rhs) of the shape arguments,
+                  among the right-hand-sides of each object's shape, that are used in
+                  the binary relational questions of each datapoint.
+        """
+        if self.train not in self.rhs_gather_indices:
+            rhs_selection = self.training_rhs
+            if not(self.train): rhs_selection = self.testing_rhs
+            rhs_table = np.stack([rhs_selection[shape_id] for shape_id in range(self.nb_shapes)])
+            # nb_shapes x nb_rhs
+            shape_ids = self.latents_classes.reshape(len(self), self.nb_objects, -1)[...,1]
+            # |D| x nb_objects
+            self.rhs_gather_indices[self.train] = torch.from_numpy(rhs_table[shape_ids]).long()
+        return self.rhs_gather_indices[self.train]
+
     def _generate_all(self):
-        pbar = tqdm(total=len(self))
+        missing_indices = set(self.render_cache.missing_indices(self.indices).tolist())
+        pbar = tqdm(total=len(missing_indices))
         for idx in range(len(self)):
+            if self.indices[idx] not in missing_indices:    continue
             pbar.update(1)
-            self._generate_datapoint(idx=idx)
+            self._render_datapoint(idx=idx)
+        self.render_cache.flush()
+
+    def _render_datapoint(self, idx):
+        img = render_image(
+            latent_values=self.latents_values[idx].reshape(self.nb_objects, -1),
+            img_size=self.img_size,
+            object_size=self.object_size,
+            fontScale=self.fontScale,
+            thickness=self.thickness,
+            font=self.font,
+        )
+        self.render_cache.put(self.indices[idx], img)
 
     def _generate_datapoint(self, idx):
+        """
+        :returns: the datapoint, as output by `generate_datapoint`, without its image.
+        """
         latents_values = self.latents_values[idx].reshape(self.nb_objects, -1)
         latents_one_hot = self.latents_one_hot[idx].reshape(self.nb_objects, -1)
         latents_classes = self.latents_classes[idx].reshape(self.nb_objects, -1)
@@ -1373,64 +1475,9 @@ class SQOOTDataset(Dataset):
             font=self.font,
             fontScale=self.fontScale,
             thickness=self.thickness,
+            render=False,
         )
-
-        #(img, relations, norelations, latent_class.reshape(-1), latent_values.reshape(-1))
-        self.imgs[idx] = datapoint[0]
-        
-        for subtype_id in range(self.nb_r_qs):
-            self.relational_qs[subtype_id][idx] = np.stack(datapoint[1][0][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x question_size
-            self.relational_as[subtype_id][idx] = np.stack(datapoint[1][1][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x 1
-
-            """
-            dataset[f"relational_qs_{subtype_id}"].append(np.stack(datapoint[1][0][subtype_id]))
-            # nb_brq_qs x nb_ojects x  question_size
-            dataset[f"relational_as_{subtype_id}"].append(np.stack(datapoint[1][1][subtype_id]))
-            # nb_r_qs x nb_ojects x 1
-            """
-
-        for subtype_id in range(self.nb_nr_qs):
-            self.non_relational_qs[subtype_id][idx] = np.stack(datapoint[2][0][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x question_size
-            self.non_relational_as[subtype_id][idx] = np.stack(datapoint[2][1][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x 1
-
-            """
-            dataset[f"non_relational_qs_{subtype_id}"].append(np.stack(datapoint[2][0][subtype_id]))
-            # nb_brq_qs x nb_ojects x question_size
-            dataset[f"non_relational_as_{subtype_id}"].append(np.stack(datapoint[2][1][subtype_id]))
-            # nb_nr_qs x nb_ojects x 1
-            """
-
-        for subtype_id in range(self.nb_brq_qs):
-            self.binary_relational_qs[subtype_id][idx] = np.stack(datapoint[3][0][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x question_size
-            self.binary_relational_as[subtype_id][idx] = np.stack(datapoint[3][1][subtype_id])
-            # nb_r_qs x |D| x nb_ojects x 1
-
-            """
-            dataset[f"binary_relational_query_qs_{subtype_id}"].append(np.stack(datapoint[3][0][subtype_id]))
-            # nb_brq_qs x nb_ojects x nb_shapes x question_size
-            dataset[f"binary_relational_query_as_{subtype_id}"].append(np.stack(datapoint[3][1][subtype_id]))
-            # nb_brq_qs x nb_ojects x nb_shapes x 1
-            """
-
-        #self.relational_qs = {idx:np.stack(dataset[f'relational_qs_{idx}']) for idx in range(self.nb_r_qs)}
-        # nb_r_qs x |D| x nb_ojects x question_size
-        #self.relational_as = {idx:np.stack(dataset[f'relational_as_{idx}']) for idx in range(self.nb_r_qs)}
-        # nb_r_qs x |D| x nb_ojects x 1
-
-        #self.non_relational_qs = {idx:np.stack(dataset[f'non_relational_qs_{idx}']) for idx in range(self.nb_nr_qs)}
-        # nb_nr_qs x |D| x nb_ojects x question_size
-        #self.non_relational_as = {idx:np.stack(dataset[f'non_relational_as_{idx}']) for idx in range(self.nb_nr_qs)}
-        # nb_nr_qs x |D| x nb_ojects x 1
-
-        #self.binary_relational_qs = {idx:np.stack(dataset[f'binary_relational_query_qs_{idx}']) for idx in range(self.nb_brq_qs)}
-        # nb_brq_qs x |D| x nb_ojects x nb_shapes x question_size
-        #self.binary_relational_as = {idx:np.stack(dataset[f'binary_relational_query_as_{idx}']) for idx in range(self.nb_brq_qs)}
-        # nb_brq_qs x |D| x nb_ojects x nb_shapes x 1
+        return datapoint
 
     def __len__(self) -> int:
         return len(self.indices)
@@ -1509,48 +1556,27 @@ class SQOOTDataset(Dataset):
         latent_class = torch.from_numpy(self.getlatentclass(idx))
         latent_one_hot = torch.from_numpy(self.getlatentonehot(idx))
         
-        if idx not in self.imgs:    
-            self._generate_datapoint(idx=idx)
+        if not self.render_cache.is_done(self.indices[idx]):    
+            self._render_datapoint(idx=idx)
 
-        img = self.imgs[idx]
+        img = self.render_cache.get(self.indices[idx])
         target = self.getclass(idx)
-                
-        relational_questions = {f"relational_questions_{k}":torch.from_numpy(v[idx]).float() for k,v in self.relational_qs.items()}
-        relational_answers = {f"relational_answers_{k}":torch.from_numpy(v[idx]).long() for k,v in self.relational_as.items()}
         
-        non_relational_questions = {f"non_relational_questions_{k}":torch.from_numpy(v[idx]).float() for k,v in self.non_relational_qs.items()}
-        non_relational_answers = {f"non_relational_answers_{k}":torch.from_numpy(v[idx]).long() for k,v in self.non_relational_as.items()}
+        relational_questions = {f"relational_questions_{k}":v for k,v in enumerate(self.relational_qs.unbind(0))}
+        relational_answers = {f"relational_answers_{k}":v for k,v in enumerate(self.relational_as[idx].unbind(0))}
         
-        binary_relational_questions = {f"binary_relational_query_questions_{k}":torch.from_numpy(v[idx]).float() for k,v in self.binary_relational_qs.items()}
-        binary_relational_answers = {f"binary_relational_query_answers_{k}":torch.from_numpy(v[idx]).long() for k,v in self.binary_relational_as.items()}
+        non_relational_questions = {f"non_relational_questions_{k}":v for k,v in enumerate(self.non_relational_qs.unbind(0))}
+        non_relational_answers = {f"non_relational_answers_{k}":v for k,v in enumerate(self.non_relational_as[idx].unbind(0))}
         
-        # Filtering #RHS/#LHS:
-        for (key, vqs), (akey,vas) in zip(binary_relational_questions.items(), binary_relational_answers.items()):
-            # nb_objects x nb_shapes x question_size
-            obj_id2shape_id = [
-                latent_class.reshape(self.nb_objects,-1)[obj_id][1].item() 
-                for obj_id in range(self.nb_objects)
-            ]
-            rhs_selection = self.training_rhs
-            if not(self.train): rhs_selection = self.testing_rhs
-            selected_qs = []
-            selected_as = []
-            for object_id in range(self.nb_objects):
-                objXshape = torch.from_numpy(rhs_selection[obj_id2shape_id[object_id]])
-                selected_qs.append(torch.index_select(
-                        vqs[object_id],
-                        dim=0,
-                        index=objXshape
-                    )
-                )
-                selected_as.append(torch.index_select(
-                        vas[object_id],
-                        dim=0,
-                        index=objXshape
-                    )
-                )
-            binary_relational_questions[key] = torch.stack(selected_qs)
-            binary_relational_answers[akey] = torch.stack(selected_as)
+        # Filtering #RHS/#LHS, with one gather over all the subtypes and objects:
+        rhs_indices = self._get_rhs_gather_indices()[idx]
+        # nb_objects x nb_rhs
+        binary_relational_qs = self.binary_relational_qs[:, self.object_indices, rhs_indices]
+        # nb_brq_qs x nb_objects x nb_rhs x question_size
+        binary_relational_as = self.binary_relational_as[idx][:, self.object_indices, rhs_indices]
+        # nb_brq_qs x nb_objects x nb_rhs x 1
+        binary_relational_questions = {f"binary_relational_query_questions_{k}":v for k,v in enumerate(binary_relational_qs.unbind(0))}
+        binary_relational_answers = {f"binary_relational_query_answers_{k}":v for k,v in enumerate(binary_relational_as.unbind(0))}
 
         #img = (img*255).astype('uint8').transpose((2,1,0))
         img = img.transpose((2,1,0))
@@ -0,0 +1,152 @@
+from typing import Dict, List, Tuple, Callable
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def divider_split_indices(nbr_samples:int, divider:int=1, offset:int=0, train:bool=True, train_ratio:float=0.8) -> np.ndarray:
+    '''
+    Selects every :param divider:-th sample, starting from :param offset:,
+    and splits them into the first :param train_ratio: for training and the rest for testing.
+
+    :returns: Numpy Array of the selected indices.
+    '''
+    indices = np.nonzero(np.arange(nbr_samples) % divider == offset)[0]
+    end = int(len(indices)*train_ratio)
+    return indices[:end] if train else indices[end:]
+
+
+def random_holdout_split_indices(nbr_samples:int, test_size:int, train:bool=True) -> np.ndarray:
+    '''
+    Samples (with replacement) :param test_size: test indices, and keeps the remaining ones,
+    in increasing order, for training.
+
+    :returns: Numpy Array of the selected indices.
+    '''
+    sampling_indices = np.random.randint(nbr_samples, size=test_size)
+    if train:
+        sampling_indices = np.nonzero(~np.isin(np.arange(nbr_samples), sampling_indices))[0]
+    return sampling_indices
+
+
+def compositional_split_indices(latents_classes:np.ndarray,
+                                primary_position:int,
+                                secondary_position:int,
+                                primary_2_possible_secondaries:Dict[int,List[int]]) -> np.ndarray:
+    '''
+    Selects the samples whose secondary latent class (e.g. color) is among the possible ones
+    for their primary latent class (e.g. shape).
+
+    :param latents_classes: Numpy Array of shape (nbr_samples, nbr_latent_dims).
+    :param primary_2_possible_secondaries: Dict of primary latent class and iterable of possible secondary latent classes.
+    :returns: Numpy Array of the selected indices.
+    '''
+    primary = latents_classes[:, primary_position].astype(np.int64)
+    secondary = latents_classes[:, secondary_position].astype(np.int64)
+    allowed = np.zeros((primary.max()+1, secondary.max()+1), dtype=bool)
+    for primary_class, possible_secondaries in primary_2_possible_secondaries.items():
+        if primary_class >= allowed.shape[0]:   continue
+        possible_secondaries = np.asarray(possible_secondaries, dtype=np.int64)
+        possible_secondaries = possible_secondaries[possible_secondaries < allowed.shape[1]]
+        allowed[primary_class, possible_secondaries] = True
+    return np.nonzero(allowed[primary, secondary])[0]
+
+
+def combinatorial_split_indices(latents_classes:np.ndarray,
+                                latent_dims:Dict[str,Dict[str,object]],
+                                counter_test_threshold:int,
+                                train:bool=True,
+                                nb_objects:int=1) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Vectorized combinatorial train/test split over all the samples at once.
+
+    For each latent dimension, only the classes c such that (c+1)%divider==remainder_use
+    are used, where the quotient (c+1)//divider is the effective value, which is a test value
+    depending on the 'test_set_divider', 'test_set_size_sample_from_end' or
+    'test_set_size_sample_from_start' entries of the dimension.
+    A sample is a test sample if (any of its objects) has at least as many test values as
+    the effective test threshold, i.e. :param counter_test_threshold: minus the number of
+    (image-wise) primitive dimensions whose effective value is above its number of fillers.
+
+    :param latents_classes: Numpy Array of shape (nbr_samples, nb_objects*nbr_latent_dims).
+    :param latent_dims: Dict of latent dimension names and Dict describing the dimension,
+                        as parsed from the split strategy by the datasets.
+    :param counter_test_threshold: int number of test values that makes a test sample.
+    :param train: boolean defining whether to return the training or testing indices.
+    :param nb_objects: int number of objects whose latents are concatenated in each sample.
+    :returns:
+        - Numpy Array of the selected indices.
+        - Numpy Array of the same shape as :param latents_classes: that flags the test values.
+    '''
+    nbr_samples = latents_classes.shape[0]
+    latent_class = latents_classes.reshape((nbr_samples, nb_objects, -1)).astype(np.int64)
+    # (nbr_samples, nb_objects, nbr_latent_dims)
+    test_latents_mask = np.zeros_like(latent_class)
+    valid = np.ones(nbr_samples, dtype=bool)
+    effective_test_threshold = np.full(nbr_samples, counter_test_threshold, dtype=np.int64)
+    counter_test = np.zeros((nbr_samples, nb_objects), dtype=np.int64)
+
+    for dim_name, dim_dict in latent_dims.items():
+        dim_class = latent_class[..., dim_dict['position']]
+        # (nbr_samples, nb_objects)
+        quotient = (dim_class+1)//dim_dict['divider']
+        remainder = (dim_class+1)%dim_dict['divider']
+        valid &= (remainder==dim_dict.get('remainder_use', 0)).all(axis=-1)
+
+        if dim_dict['primitive']:
+            effective_test_threshold -= (quotient > dim_dict['nbr_fillers']).any(axis=-1)
+        elif dim_dict.get('image_wise_primitive', False):
+            effective_test_threshold -= (quotient > dim_dict['nbr_fillers']).sum(axis=-1) >= 2
+
+        if 'test_set_divider' in dim_dict:
+            test = quotient%dim_dict['test_set_divider']==0
+        elif 'test_set_size_sample_from_end' in dim_dict:
+            max_quotient = dim_dict['size']//dim_dict['divider']
+            test = quotient > max_quotient-dim_dict['test_set_size_sample_from_end']
+        elif 'test_set_size_sample_from_start' in dim_dict:
+            test = quotient <= dim_dict['test_set_size_sample_from_start']
+        else:
+            test = np.zeros_like(quotient, dtype=bool)
+        counter_test += test
+        # Only the dimensions that have been reached by the sequential checks are flagged:
+        test_latents_mask[..., dim_dict['position']] = test & valid[:, None]
+
+    test_samples = (counter_test >= effective_test_threshold[:, None]).any(axis=-1)
+    selected = valid & (~test_samples if train else test_samples)
+    return np.nonzero(selected)[0], test_latents_mask.reshape(latents_classes.shape)
+
+
+def cached_split(cache_dir:str, config:Dict[str,object], latents_classes:np.ndarray, compute_fn:Callable) -> Dict[str,np.ndarray]:
+    '''
+    Loads the split identified by :param config: and :param latents_classes: from
+    :param cache_dir:, or computes it with :param compute_fn: and stores it there.
+
+    :param config: Dict of json-serializable values, e.g. the split strategy and train flag.
+    :param compute_fn: Callable that returns a Dict of str and Numpy Array.
+    :returns: Dict of str and Numpy Array, as returned by :param compute_fn:.
+    '''
+    key = hashlib.sha1()
+    key.update(json.dumps(config, sort_keys=True, default=str).encode())
+    key.update(np.ascontiguousarray(latents_classes).tobytes())
+    filepath = os.path.join(cache_dir, f"split-{key.hexdigest()[:16]}.npz")
+
+    if os.path.exists(filepath):
+        try:
+            with np.load(filepath) as split:
+                return {k:split[k] for k in split.files}
+        except Exception as e:
+            print(f"WARNING: unable to load cached split {filepath}: {e}")
+
+    split = compute_fn()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written into a temporary file first, so that concurrent runs never read a partial file:
+        tmp_filepath = f"{filepath}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_filepath, **split)
+        os.replace(tmp_filepath, filepath)
+    except OSError as e:
+        print(f"WARNING: unable to cache split {filepath}: {e}")
+    return split
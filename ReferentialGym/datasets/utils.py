@@ -1,7 +1,9 @@
+import os
+import json
+
 import torch
 import torchvision.transforms as T
 import numpy as np
-import cv2
 from PIL import Image 
 
 
@@ -41,6 +43,213 @@ def collate_dict_wrapper(batch):
     return DictBatch(batch)
 
 
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    def __init__(self, data_source, seed=0):
+        """
+        Random sampler whose permutation only depends on the seed and the epoch,
+        and which can be started from any position in that permutation,
+        so that an interrupted epoch can be resumed exactly.
+
+        :param data_source: Dataset to sample from.
+        :param seed: int defining the base seed of the per-epoch permutations.
+        """
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """
+        :param start_index: int number of indices of the current epoch's permutation 
+                            that have already been consumed, and will thus be skipped.
+        """
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed+self.epoch)
+        permutation = torch.randperm(len(self.data_source), generator=generator).tolist()
+        return iter(permutation[self.start_index:])
+
+    def __len__(self):
+        return max(0, len(self.data_source)-self.start_index)
+
+
+class RenderCache(object):
+    def __init__(self, path, nbr_images, image_shape, dtype=np.uint8, meta=None, flush_period=64):
+        """
+        File-backed cache of rendered images, made of a memory-mapped image array
+        and a completion bitmap. Every process that opens the same path, e.g. the
+        DataLoader workers or later runs, shares the cache, so that each image
+        is only rendered once.
+
+        :param path: str path of the directory where the cache is stored.
+        :param nbr_images: int number of images in the dataset.
+        :param image_shape: tuple shape of each image.
+        :param dtype: numpy dtype of the images.
+        :param meta: Dict of json-serializable values that identifies the rendered dataset,
+                     e.g. its generation parameters. The cache is reset if it was built
+                     with a different `meta`.
+        :param flush_period: int number of `put` calls after which the images, and then
+                             their completion bits, are written to disk.
+        """
+        self.path = path
+        self.shape = (nbr_images, *image_shape)
+        self.dtype = np.dtype(dtype)
+        self.meta = dict(meta if meta is not None else {}, shape=list(self.shape), dtype=self.dtype.str)
+        self.images_path = os.path.join(self.path, "images.npy")
+        self.done_path = os.path.join(self.path, "done.npy")
+        self.meta_path = os.path.join(self.path, "meta.json")
+
+        self.flush_period = flush_period
+
+        self.images = None
+        self.done = None
+        # Indices whose images are written but not yet marked as done on disk:
+        self.pending_indices = []
+        self.pending_done = set()
+        self._create()
+
+    def _create(self):
+        if all(os.path.exists(p) for p in [self.images_path, self.done_path, self.meta_path]):
+            with open(self.meta_path, 'r') as f:
+                if json.load(f) == self.meta:
+                    return
+        os.makedirs(self.path, exist_ok=True)
+        # Written into temporary files first, so that the files that other processes
+        # may have mapped are never truncated, but replaced:
+        for filepath, dtype, shape in [
+            (self.images_path, self.dtype, self.shape),
+            (self.done_path, np.bool_, (self.shape[0],)),
+        ]:
+            tmp_filepath = f"{filepath}.{os.getpid()}.tmp.npy"
+            np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=dtype, shape=shape).flush()
+            os.replace(tmp_filepath, filepath)
+        # Written last, so that an interrupted creation is started over:
+        tmp_filepath = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_filepath, self.meta_path)
+
+    def _open(self):
+        if self.images is None:
+            self.images = np.load(self.images_path, mmap_mode='r+')
+            self.done = np.load(self.done_path, mmap_mode='r+')
+
+    def __getstate__(self):
+        # The memory maps are re-opened by each process rather than pickled:
+        self.flush()
+        state = self.__dict__.copy()
+        state["images"] = None
+        state["done"] = None
+        state["pending_indices"] = []
+        state["pending_done"] = set()
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def is_done(self, idx):
+        self._open()
+        return bool(self.done[idx]) or int(idx) in self.pending_done
+
+    def missing_indices(self, indices=None):
+        """
+        :param indices: Iterable of int indices to check, or None to check all of them.
+        :returns: Numpy Array of the indices whose image has not been rendered yet.
+        """
+        self._open()
+        if indices is None:
+            missing = np.nonzero(~self.done)[0]
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            missing = indices[~self.done[indices]]
+        if len(self.pending_done):
+            missing = missing[~np.isin(missing, list(self.pending_done))]
+        return missing
+
+    def get(self, idx):
+        self._open()
+        return np.array(self.images[idx])
+
+    def put(self, idx, images, flush=False):
+        """
+        :param idx: int index, or Numpy Array of indices, of the image(s).
+        :param images: Numpy Array of the image(s), batched if :param idx: is an array.
+        :param flush: boolean defining whether to write the changes to disk right away.
+        """
+        self._open()
+        self.images[idx] = images
+        # The images are only marked as done on disk once they are written,
+        # otherwise an interrupted process could leave done but empty images:
+        indices = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+        self.pending_indices.append(indices)
+        self.pending_done.update(indices.tolist())
+        if flush or len(self.pending_indices) >= self.flush_period:
+            self.flush()
+
+    def flush(self):
+        if self.images is None:  return
+        self.images.flush()
+        if len(self.pending_indices):
+            self.done[np.concatenate(self.pending_indices)] = True
+            self.pending_indices = []
+            self.pending_done = set()
+        self.done.flush()
+
+    def __del__(self):
+        # e.g. DataLoader workers that exit in between two periodic flushes:
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+
+class SuperpixelLabelsCache(object):
+    def __init__(self, path, nbr_images, image_size, compactness=100.0, n_segments=10000):
+        """
+        File-backed cache of the SLIC superpixel labels of the images of a dataset,
+        computed at most once per image, and yielded along with the images, so that
+        the compactness constraint of MONet-like models does not recompute them.
+
+        :param path: str path of the directory where the cache is stored.
+        :param nbr_images: int number of images in the dataset.
+        :param image_size: tuple (H, W) of the images, as seen by the model.
+        """
+        self.compactness = compactness
+        self.n_segments = n_segments
+        self.cache = RenderCache(
+            path=path,
+            nbr_images=nbr_images,
+            image_shape=(int(np.prod(image_size)),),
+            dtype=np.int32,
+            meta={"compactness":compactness, "n_segments":n_segments},
+        )
+
+    def get(self, idx, image):
+        """
+        :param idx: int index of the image in the cache.
+        :param image: Numpy Array of shape (H, W, C), in [0, 255], used if the labels are missing.
+        :returns: Numpy Array of shape (H*W,) of the superpixel label of each pixel.
+        """
+        if self.cache.is_done(idx):
+            return self.cache.get(idx)
+        from ..networks.autoregressive_networks import compute_superpixel_labels
+        labels = compute_superpixel_labels(
+            np.asarray(image, dtype=np.float64)[None], 
+            compactness=self.compactness, 
+            n_segments=self.n_segments,
+        )[0].astype(np.int32)
+        self.cache.put(idx, labels)
+        return labels
+
+    def flush(self):
+        self.cache.flush()
+
+
 class ResizeNormalize(object):
     def __init__(self, size, use_cuda=False, normalize_rgb_values=False, toPIL=False, rgb_scaler=1.0):
         '''
@@ -111,6 +320,7 @@ class Rescale(object) :
     image = sample
     h,w = image.shape[:2]
     new_h, new_w = self.output_size
+    import cv2
     img = cv2.resize(image, (new_h, new_w) )
     return img
 
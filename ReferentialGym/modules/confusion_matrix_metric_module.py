@@ -5,7 +5,6 @@ import torch.nn as nn
 import torch.optim as optim 
 
 import numpy as np 
-from sklearn.metrics import precision_recall_fscore_support
 
 from .module import Module
 
@@ -72,8 +71,12 @@ class ConfusionMatrixMetricModule(Module):
                                                  config=config,
                                                  input_stream_ids=input_stream_ids)
         
-        self.prediction_storages = {}
-        self.groundtruth_storages = {}
+        self.labels = np.asarray(self.config["labels"], dtype=np.int64)
+        self.num_labels = int(self.labels.max())+1
+        
+        # predicted_labels key --> Dict of prediction key --> confusion matrix of counts
+        # (groundtruth labels along the rows, predicted labels along the columns):
+        self.confusion_matrices = {}
 
         self.end_of_ = [key for key,value in input_stream_ids.items() if "end_of_" in key]
         
@@ -92,23 +95,17 @@ class ConfusionMatrixMetricModule(Module):
         groundtruth_labels = {k:v for k,v in input_streams_dict.items() if "groundtruth_labels" in k}
         
         
-        # Store new data:
+        # Accumulate new data:
         for key, value in predicted_labels.items():
-          if key not in self.prediction_storages:
-            self.prediction_storages[key] = {}
+          gt_key = key.replace("predicted_labels", "groundtruth_labels")
+          if key not in self.confusion_matrices:
+            self.confusion_matrices[key] = {}
           for kp, vp in value.items():
-            if kp not in self.prediction_storages[key]:
-              self.prediction_storages[key][kp] = []
-            self.prediction_storages[key][kp].append(vp)
-
-
-        for key, value in groundtruth_labels.items():
-          if key not in self.groundtruth_storages:
-            self.groundtruth_storages[key] = {}
-          for kp, vp in value.items():
-            if kp not in self.groundtruth_storages[key]:
-              self.groundtruth_storages[key][kp] = []
-            self.groundtruth_storages[key][kp].append(vp)
+            counts = self._count(pred=vp, gt=groundtruth_labels[gt_key][kp])
+            if kp not in self.confusion_matrices[key]:
+              self.confusion_matrices[key][kp] = counts
+            else:
+              self.confusion_matrices[key][kp] += counts
         
         # Is it the end of the epoch?
         end_of_epoch = all([
@@ -119,126 +116,111 @@ class ConfusionMatrixMetricModule(Module):
         # If so, let us average over every value and save it:
         if end_of_epoch:
 
-          pc_accuracies= {}
-          precisions = {}
-          recalls = {}
-          f_scores = {}
-          for pkey_idx, key_input in enumerate(self.prediction_storages.keys()):
-            pc_accuracies[key_input] = {}
-            precisions[key_input] = {}
-            recalls[key_input] = {}
-            f_scores[key_input] = {}
-            
-            for key in self.prediction_storages[key_input].keys():
-              # Stack:
-              pv = np.concatenate([el.ravel() for el in self.prediction_storages[key_input][key]])
-              gtv = np.concatenate([el.ravel() for el in self.groundtruth_storages[f"groundtruth_labels_{pkey_idx}"][key]])
-
-              # Compute Precision, Recall, F-Score, 
-              # with inversely proportional weighting to account for imbalanced support:
-              has_support_idx = set(gtv)
-              sample_weights = np.zeros_like(gtv, dtype=float)
-              for sidx in has_support_idx:
-                mask = (gtv == sidx).astype(float)
-                support_size = mask.sum()
-                sample_weights += (1.0/support_size)*mask
-
-              precisions[key_input][f"balanced_{key}"], \
-              recalls[key_input][f"balanced_{key}"], \
-              f_scores[key_input][f"balanced_{key}"], _ = precision_recall_fscore_support(
-                y_true=gtv, 
-                y_pred=pv, 
-                labels=self.config["labels"],
-                average='macro',
-                sample_weight=sample_weights,
-                zero_division=0,
-              )
-              # (1)
-              
-              # Compute Precision, Recall, F-Score, for each class:
-              precisions[key_input][key], \
-              recalls[key_input][key], \
-              f_scores[key_input][key], _ = precision_recall_fscore_support(
-                y_true=gtv, 
-                y_pred=pv, 
-                labels=self.config["labels"],
-                average=None,
-                zero_division=0,
-              )
-              # (nb_class)
-              
-              # Eliminate the classes without support:
-              
-              temp = precisions[key_input][key]
-              precisions[key_input][key] = {}
-              for sidx in has_support_idx:
-                precisions[key_input][key][sidx] = temp[sidx]
-
-              temp = recalls[key_input][key]
-              recalls[key_input][key] = {}
-              for sidx in has_support_idx:
-                recalls[key_input][key][sidx] = temp[sidx]
-
-              temp = f_scores[key_input][key]
-              f_scores[key_input][key] = {}
-              for sidx in has_support_idx:
-                f_scores[key_input][key][sidx] = temp[sidx]
-
-              # Compute Per-Class Accuracies where there is support:
-              pc_accuracies[key_input][key] = {}
-              for sidx in has_support_idx:
-                class_mask = (gtv == sidx)
-                pc_accuracies[key_input][key][sidx] = 100.0*class_mask*(pv==gtv).astype(float)
+          for key_input, matrices in self.confusion_matrices.items():
+            for key, matrix in matrices.items():
+              metrics = self._metrics_from_confusion_matrix(matrix.cpu().numpy())
+              input_label = self.config['input_labels'][key_input]
 
               # Logging:
               logger.add_scalar(
-                f"PerEpoch/{mode}/{self.id}/Precision/{self.config['input_labels'][key_input]}/{key}/balanced", 
-                precisions[key_input][f"balanced_{key}"], 
+                f"PerEpoch/{mode}/{self.id}/Precision/{input_label}/{key}/balanced", 
+                metrics["balanced_precision"], 
                 epoch
               )
 
               logger.add_scalar(
-                f"PerEpoch/{mode}/{self.id}/Recall/{self.config['input_labels'][key_input]}/{key}/balanced", 
-                recalls[key_input][f"balanced_{key}"], 
+                f"PerEpoch/{mode}/{self.id}/Recall/{input_label}/{key}/balanced", 
+                metrics["balanced_recall"], 
                 epoch
               )
 
               logger.add_scalar(
-                f"PerEpoch/{mode}/{self.id}/FScore/{self.config['input_labels'][key_input]}/{key}/balanced", 
-                f_scores[key_input][f"balanced_{key}"], 
+                f"PerEpoch/{mode}/{self.id}/FScore/{input_label}/{key}/balanced", 
+                metrics["balanced_f_score"], 
                 epoch
               )
-              for sidx in has_support_idx:
+              for sidx in metrics["has_support_idx"]:
                 logger.add_scalar(
-                  f"PerEpoch/{mode}/{self.id}/Precision/{self.config['input_labels'][key_input]}/{key}/class_{sidx}", 
-                  precisions[key_input][key][sidx], 
+                  f"PerEpoch/{mode}/{self.id}/Precision/{input_label}/{key}/class_{sidx}", 
+                  metrics["precision"][sidx], 
                   epoch
                 )
 
                 logger.add_scalar(
-                  f"PerEpoch/{mode}/{self.id}/Recall/{self.config['input_labels'][key_input]}/{key}/class_{sidx}", 
-                  recalls[key_input][key][sidx], 
+                  f"PerEpoch/{mode}/{self.id}/Recall/{input_label}/{key}/class_{sidx}", 
+                  metrics["recall"][sidx], 
                   epoch
                 )
 
                 logger.add_scalar(
-                  f"PerEpoch/{mode}/{self.id}/FScore/{self.config['input_labels'][key_input]}/{key}/class_{sidx}", 
-                  f_scores[key_input][key][sidx], 
+                  f"PerEpoch/{mode}/{self.id}/FScore/{input_label}/{key}/class_{sidx}", 
+                  metrics["f_score"][sidx], 
                   epoch
                 )
 
                 logger.add_scalar(
-                  f"PerEpoch/{mode}/{self.id}/PerClassAccuracy/{self.config['input_labels'][key_input]}/{key}/class_{sidx}", 
-                  pc_accuracies[key_input][key][sidx].mean(), 
+                  f"PerEpoch/{mode}/{self.id}/PerClassAccuracy/{input_label}/{key}/class_{sidx}", 
+                  metrics["pc_accuracy"][sidx], 
                   epoch
                 )
               
           # Reset epoch storages:
-          self.prediction_storages = {}
-          self.groundtruth_storages = {}
+          self.confusion_matrices = {}
 
           # Flush data:
           logger.flush()
 
         return {}
-        
\ No newline at end of file
+
+    def _count(self, pred, gt):
+        """
+        :returns: (num_labels, num_labels) torch.Tensor of counts of the (groundtruth, predicted) pairs,
+                  on the device of :param pred:. Labels outside of [0, num_labels) are ignored.
+        """
+        pred = torch.as_tensor(pred).reshape(-1).long()
+        gt = torch.as_tensor(gt, device=pred.device).reshape(-1).long()
+        n = self.num_labels
+        valid = (pred >= 0) & (pred < n) & (gt >= 0) & (gt < n)
+        # Invalid pairs fall in an extra bin, which avoids a synchronizing boolean indexing:
+        indices = torch.where(valid, gt*n+pred, torch.full_like(pred, n*n))
+        return torch.bincount(indices, minlength=n*n+1)[:n*n].reshape(n, n)
+
+    def _metrics_from_confusion_matrix(self, matrix:np.ndarray) -> Dict[str,object]:
+        """
+        Computes the same metrics as `sklearn.metrics.precision_recall_fscore_support`
+        with `zero_division=0`, over `self.config["labels"]`, both per class and 
+        macro-averaged with sample weights inversely proportional to the class supports.
+        """
+        matrix = matrix.astype(np.float64)
+        support = matrix.sum(axis=1)
+        has_support = support > 0
+        
+        def prf(m):
+            tp = np.diag(m)
+            pred_count = m.sum(axis=0)
+            true_count = m.sum(axis=1)
+            precision = np.divide(tp, pred_count, out=np.zeros_like(tp), where=pred_count>0)
+            recall = np.divide(tp, true_count, out=np.zeros_like(tp), where=true_count>0)
+            pr_sum = precision+recall
+            f_score = np.divide(2*precision*recall, pr_sum, out=np.zeros_like(tp), where=pr_sum>0)
+            return precision, recall, f_score
+
+        precision, recall, f_score = prf(matrix)
+        # (num_labels)
+        
+        # Inversely proportional weighting to account for imbalanced support:
+        inv_support = np.divide(1.0, support, out=np.zeros_like(support), where=has_support)
+        b_precision, b_recall, b_f_score = prf(matrix*inv_support[:,None])
+        
+        nbr_samples = max(matrix.sum(), 1.0)
+        return {
+          "has_support_idx": [int(sidx) for sidx in np.nonzero(has_support)[0]],
+          "precision": precision,
+          "recall": recall,
+          "f_score": f_score,
+          "balanced_precision": b_precision[self.labels].mean(),
+          "balanced_recall": b_recall[self.labels].mean(),
+          "balanced_f_score": b_f_score[self.labels].mean(),
+          # Percentage of the samples that are correctly classified and of class sidx:
+          "pc_accuracy": 100.0*np.diag(matrix)/nbr_samples,
+        }
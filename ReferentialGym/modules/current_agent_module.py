@@ -29,9 +29,9 @@ class CurrentAgentModule(Module):
     def clone(self, clone_id="a0"):
         return self.ref_agent.clone()
 
-    def save(self, path):
+    def save(self, path, checkpointer=None):
         if self.ref_agent is not None:
-            self.ref_agent.save(path=path)
+            self.ref_agent.save(path=path, checkpointer=checkpointer)
 
     def _tidyup(self):
         self.ref_agent._tidyup()
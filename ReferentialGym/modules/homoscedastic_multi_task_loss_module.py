@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 
 from .module import Module
+from ..networks.homoscedastic_multitask_loss import HomoscedasticLogVarsMixin, homoscedastic_weighting
 
 
 #TODO:
@@ -20,7 +21,7 @@ def build_HomoscedasticMultiTasksLossModule(id:str,
                                              input_stream_ids=input_stream_ids)
 
 
-class HomoscedasticMultiTasksLossModule(Module):
+class HomoscedasticMultiTasksLossModule(HomoscedasticLogVarsMixin, Module):
     def __init__(self,
                  id:str,
                  config:Dict[str,object],
@@ -47,9 +48,7 @@ class HomoscedasticMultiTasksLossModule(Module):
                                                                 type="HomoscedasticMultiTasksLossModule",
                                                                 config=config,
                                                                 input_stream_ids=input_stream_ids)
-        self.nbr_tasks = 2 #self.config["nbr_tasks"]
-        
-        self.homoscedastic_log_vars = torch.nn.Parameter(torch.zeros(self.nbr_tasks))
+        self._init_log_vars(nbr_tasks=self.config.get("nbr_tasks", 2))
         
         if self.config["use_cuda"]:
             self = self.cuda()
@@ -72,26 +71,16 @@ class HomoscedasticMultiTasksLossModule(Module):
         logs_dict = input_streams_dict["logs_dict"]
         mode = input_streams_dict["mode"]
         
-        nbr_tasks_ineffect = len(loss_dict)
-        k0 = list(loss_dict.keys())[0]
-        batch_size = loss_dict[k0][1].size()[0]
-
-        if nbr_tasks_ineffect > self.nbr_tasks:
-            self.nbr_tasks = nbr_tasks_ineffect
-            self.homoscedastic_log_vars.data = torch.zeros(self.nbr_tasks).to(self.homoscedastic_log_vars.device)
-
-        inv_uncertainty_sq = torch.exp( -self.homoscedastic_log_vars[:self.nbr_tasks])
-        # (nbr_tasks)
-        # (batch_size, self.nbr_tasks)
-        batched_multiloss = {}
-        for idx_loss, (kn, l) in enumerate(loss_dict.items()):
-            batched_multiloss[kn] = inv_uncertainty_sq[idx_loss]*l[1]+self.homoscedastic_log_vars[idx_loss].repeat(l[1].shape[0])
-        
-        for kn in loss_dict:
-            loss_dict[kn].append( batched_multiloss[kn])
+        task_indices = self.get_task_indices(list(loss_dict.keys()), mode=mode)
+        log_vars = self.homoscedastic_log_vars[task_indices]
+        # (nbr_tasks_ineffect)
+
+        batched_multiloss = homoscedastic_weighting([l[1] for l in loss_dict.values()], log_vars)
+        for kn, wl in zip(loss_dict, batched_multiloss):
+            loss_dict[kn].append(wl)
 
-        for (lossname, lossvalues), logvar  in zip(loss_dict.items(), self.homoscedastic_log_vars):
-            logs_dict[f"/{mode}/HomoscedasticLogVar/{lossname}"] = logvar.item()
+        for lossname, logvar in zip(loss_dict, log_vars.detach().unbind(0)):
+            logs_dict[f"/{mode}/HomoscedasticLogVar/{lossname}"] = logvar
         
         return outputs_stream_dict
         
\ No newline at end of file
@@ -6,6 +6,7 @@ import torch.nn as nn
 import copy
 
 from .module import Module
+from ..networks.grouped_heads import plan_grouped_heads, grouped_heads_forward
 
 
 def build_MultiHeadClassificationFromFeatureMapModule(id:str,
@@ -81,6 +82,9 @@ class MultiHeadClassificationFromFeatureMapModule(Module):
                                                             input_stream_ids=input_stream_ids)
         self.heads = heads
         self.final_fn = final_fn
+        self.head_indices = [ih for ih, output_size in enumerate(self.config["heads_output_sizes"]) if isinstance(output_size, int)]
+        # Input shape --> groups of heads that are evaluated together:
+        self.grouped_heads_plans = {}
 
         if self.config["use_cuda"]:
             self = self.cuda()
@@ -107,16 +111,25 @@ class MultiHeadClassificationFromFeatureMapModule(Module):
         if self.config["detach_feat_map"]:
             flatten_input = flatten_input.detach()
 
+        heads = [self.heads[ih] for ih in self.head_indices]
+        if flatten_input.shape not in self.grouped_heads_plans:
+            self.grouped_heads_plans[flatten_input.shape] = plan_grouped_heads(heads, [flatten_input.shape]*len(heads))
+        head_outputs = grouped_heads_forward(
+            heads=heads,
+            inputs=[flatten_input]*len(heads),
+            plan=self.grouped_heads_plans[flatten_input.shape],
+        )
+        head_outputs = dict(zip(self.head_indices, head_outputs))
+
+        criterion = nn.CrossEntropyLoss(reduction="none")
         losses = []
         accuracies = []
-        for ih, head in enumerate(self.heads):
-            if isinstance(self.config["heads_output_sizes"][ih], int):
-                head_output = head(flatten_input)
-                final_output = self.final_fn(head_output)
+        for ih in range(len(self.heads)):
+            if ih in head_outputs:
+                final_output = self.final_fn(head_outputs[ih])
 
                 # Loss:
                 target_idx = input_streams_dict["targets"][..., ih].squeeze()
-                criterion = nn.CrossEntropyLoss(reduction="none")
                 loss = criterion( final_output, target_idx)
 
                 # Accuracy:
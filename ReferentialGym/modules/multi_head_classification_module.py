@@ -6,6 +6,7 @@ import torch.nn as nn
 import copy
 
 from .module import Module
+from ..networks.grouped_heads import plan_grouped_heads, grouped_heads_forward
 
 
 def build_MultiHeadClassificationModule(id:str,
@@ -108,6 +109,8 @@ class MultiHeadClassificationModule(Module):
         
         self.heads = heads
         self.final_fn = final_fn
+        # Input shapes --> groups of heads that are evaluated together:
+        self.grouped_heads_plans = {}
 
         if self.config["use_cuda"]:
             self = self.cuda()
@@ -152,12 +155,22 @@ class MultiHeadClassificationModule(Module):
         predicted_labels = {}
         groundtruth_labels = {}
 
-        for ii, (key,inp) in enumerate(inputs.items()):
-            if self.config["same_head"]:    ih = 0
-            else:   ih = ii
-            head = self.heads[ih]
-
-            head_output = head(inp)
+        keys = list(inputs.keys())
+        if self.config["same_head"]:
+            heads = [self.heads[0] for _ in keys]
+        else:
+            heads = [self.heads[ih] for ih in range(len(keys))]
+        input_shapes = tuple(tuple(inputs[key].shape) for key in keys)
+        if input_shapes not in self.grouped_heads_plans:
+            self.grouped_heads_plans[input_shapes] = plan_grouped_heads(heads, input_shapes)
+        head_outputs = grouped_heads_forward(
+            heads=heads, 
+            inputs=[inputs[key] for key in keys], 
+            plan=self.grouped_heads_plans[input_shapes],
+        )
+
+        criterion = nn.CrossEntropyLoss(reduction="none")
+        for ii, (key, head_output) in enumerate(zip(keys, head_outputs)):
             final_output = self.final_fn(head_output)
 
             # Loss:
@@ -166,7 +179,6 @@ class MultiHeadClassificationModule(Module):
                 # Target indices corresponds to 1 per batch element:
                 target_idx = target_idx.reshape(-1)          
             
-            criterion = nn.CrossEntropyLoss(reduction="none")
             loss = criterion( final_output, target_idx.squeeze().long())
 
             # Accuracy:
@@ -179,8 +191,9 @@ class MultiHeadClassificationModule(Module):
             losses[key] = loss
             accuracies[key] = accuracy
 
-            predicted_labels[self.config['loss_ids'][key]] = argmax_final_output.cpu().detach().numpy()
-            groundtruth_labels[self.config['loss_ids'][key]] = target_idx.cpu().detach().numpy()
+            # Device tensors, which are only transferred to the host by their consumers:
+            predicted_labels[self.config['loss_ids'][key]] = argmax_final_output.detach()
+            groundtruth_labels[self.config['loss_ids'][key]] = target_idx.detach()
 
         losses_dict = input_streams_dict["losses_dict"]
         logs_dict = input_streams_dict["logs_dict"] 
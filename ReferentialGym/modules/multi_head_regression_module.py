@@ -6,6 +6,7 @@ import torch.nn as nn
 import copy
 
 from .module import Module
+from ..networks.grouped_heads import plan_grouped_heads, grouped_heads_forward
 
 
 def build_MultiHeadRegressionModule(id:str,
@@ -80,6 +81,9 @@ class MultiHeadRegressionModule(Module):
                                                         config=config,
                                                         input_stream_ids=input_stream_ids)
         self.heads = heads
+        self.head_indices = [ih for ih, output_size in enumerate(self.config["heads_output_sizes"]) if isinstance(output_size, int)]
+        # Input shape --> groups of heads that are evaluated together:
+        self.grouped_heads_plans = {}
         
         if self.config["use_cuda"]:
             self = self.cuda()
@@ -106,16 +110,26 @@ class MultiHeadRegressionModule(Module):
         if self.config["detach_feat_map"]:
             flatten_input = flatten_input.detach()
 
+        heads = [self.heads[ih] for ih in self.head_indices]
+        if flatten_input.shape not in self.grouped_heads_plans:
+            self.grouped_heads_plans[flatten_input.shape] = plan_grouped_heads(heads, [flatten_input.shape]*len(heads))
+        head_outputs = grouped_heads_forward(
+            heads=heads,
+            inputs=[flatten_input]*len(heads),
+            plan=self.grouped_heads_plans[flatten_input.shape],
+        )
+        head_outputs = dict(zip(self.head_indices, head_outputs))
+
+        reg_criterion = nn.SmoothL1Loss(reduction="none")
         losses = []
-        accuracies = []
-        for ih, head in enumerate(self.heads):
-            if isinstance(self.config["heads_output_sizes"][ih], int):
-                head_output = head(flatten_input)
+        distances = []
+        for ih in range(len(self.heads)):
+            if ih in head_outputs:
+                head_output = head_outputs[ih].reshape(batch_size, -1)
 
                 # Loss:
-                reg_target = inputs_dict["targets"][..., ih].float()
-                reg_criterion = nn.SmoothL1Loss(reduction="none")
-                reg_loss = reg_criterion( head_output, reg_target).squeeze()
+                reg_target = input_streams_dict["targets"][..., ih].float().reshape(batch_size, -1)
+                loss = reg_criterion( head_output, reg_target).mean(-1)
 
                 # Distance:
                 distance = (head_output-reg_target).pow(2).sqrt().mean()
@@ -134,8 +148,8 @@ class MultiHeadRegressionModule(Module):
             losses_dict[f"{self.config['loss_id']}/multi_reg_head_{idx}_loss"] = [1e3, loss]
 
         # MultiHead Reg Distance:
-        for idx, dist in enumerate(reg_distances):
-            log_dict[f"{self.config['loss_id']}/multi_reg_head_{idx}_distance"] = dist
+        for idx, dist in enumerate(distances):
+            logs_dict[f"{self.config['loss_id']}/multi_reg_head_{idx}_distance"] = dist.detach()
 
         outputs_stream_dict["losses"] = losses
         outputs_stream_dict["distances"] = distances
@@ -3,6 +3,9 @@ from typing import Dict, List
 import torch
 import numpy as np
 import copy 
+import random
+import queue
+import threading
 
 from ..modules import Module
 from ..datasets import shuffle, collate_dict_wrapper
@@ -36,6 +39,178 @@ class ObverterDatasamplingModule(Module):
         self.batch_size = self.config["batch_size"]
         self.collate_fn = collate_dict_wrapper
 
+        # Number of batches that are prepared ahead of time on a background thread,
+        # while the agents are being trained (0 means synchronous sampling).
+        # N.B.: the thread samples from the dataset concurrently with the main thread
+        # (e.g. the evaluation DataLoader), thus the dataset must be thread-safe:
+        self.prefetch_size = self.config.get("prefetch_size", 2)
+        self.prefetch_queue = None
+        self.producer = None
+        self.stop_event = None
+
+        # Per-class index arrays of the train dataset, computed once:
+        self.index_arrays = None
+        self.index_arrays_dataset = None
+
+    def __getstate__(self):
+        # Threads and queues cannot be pickled/deepcopied:
+        self._stop_producer()
+        state = self.__dict__.copy()
+        state["index_arrays_dataset"] = None
+        state["index_arrays"] = None
+        return state
+
+    def _build_index_arrays(self, train_dataset):
+        latents_classes = np.stack([
+            np.asarray(train_dataset.getlatentclass(idx)) 
+            for idx in range(len(train_dataset))
+        ])
+        # (nbr_samples, nbr_latents) where the first two latents are the color and shape:
+        color_ids = latents_classes[:,0]
+        shape_ids = latents_classes[:,1]
+        self.index_arrays = {
+            "color_ids": color_ids,
+            "shape_ids": shape_ids,
+            "same_latents": {
+                (color_id, shape_id): np.asarray(indices, dtype=np.int64)
+                for color_id, d in train_dataset.latents_to_possible_indices.items()
+                for shape_id, indices in d.items()
+            },
+            "same_shape": {
+                shape_id: np.asarray(indices, dtype=np.int64)
+                for shape_id, indices in train_dataset.same_shape_indices.items()
+            },
+            "same_color": {
+                color_id: np.asarray(indices, dtype=np.int64)
+                for color_id, indices in train_dataset.same_color_indices.items()
+            },
+        }
+        self.index_arrays_dataset = train_dataset
+
+    @staticmethod
+    def _choice_except(choice_set:np.ndarray, except_idx:int, rng:np.random.RandomState) -> int:
+        candidates = choice_set[choice_set != except_idx]
+        return candidates[rng.randint(len(candidates))]
+
+    def _sample_indices(self, nbr_samples:int, rng:np.random.RandomState) -> List[tuple]:
+        """
+        :returns: List of `batch_size` tuples (speaker_idx, listener_idx, same).
+        """
+        n_same = int(0.25*self.batch_size)
+        n_same_shape = int(0.3*self.batch_size)
+        n_same_color = int(0.2*self.batch_size)
+        n_random = self.batch_size - n_same_shape - n_same_color - n_same
+        
+        color_ids = self.index_arrays["color_ids"]
+        shape_ids = self.index_arrays["shape_ids"]
+        speaker_indices = rng.randint(nbr_samples, size=self.batch_size)
+        
+        pairs = []
+        for speaker_idx in speaker_indices[:n_same]:
+            choice_set = self.index_arrays["same_latents"][(color_ids[speaker_idx], shape_ids[speaker_idx])]
+            pairs.append((speaker_idx, self._choice_except(choice_set, speaker_idx, rng), True))
+
+        for speaker_idx in speaker_indices[n_same:n_same+n_same_shape]:
+            choice_set = self.index_arrays["same_shape"][shape_ids[speaker_idx]]
+            pairs.append((speaker_idx, self._choice_except(choice_set, speaker_idx, rng), False))
+
+        for speaker_idx in speaker_indices[n_same+n_same_shape:n_same+n_same_shape+n_same_color]:
+            choice_set = self.index_arrays["same_color"][color_ids[speaker_idx]]
+            pairs.append((speaker_idx, self._choice_except(choice_set, speaker_idx, rng), False))
+
+        random_speaker_indices = speaker_indices[self.batch_size-n_random:]
+        random_listener_indices = rng.randint(nbr_samples, size=n_random)
+        random_sames = (color_ids[random_speaker_indices] == color_ids[random_listener_indices])\
+            & (shape_ids[random_speaker_indices] == shape_ids[random_listener_indices])
+        for speaker_idx, listener_idx, same in zip(random_speaker_indices, random_listener_indices, random_sames):
+            pairs.append((speaker_idx, listener_idx, bool(same)))
+
+        return pairs
+
+    def _make_batch(self, 
+                    dataset, 
+                    rng:np.random.RandomState, 
+                    py_rng:random.Random=None, 
+                    generator:torch.Generator=None):
+        """
+        :param rng: random state with which the indices of the pairs are sampled.
+        :param py_rng: None, or random state with which the datasets samples the distractors.
+        :param generator: None, or generator with which the listener's experiences are shuffled.
+        If None, the global random states are used.
+        """
+        batch = [
+            self.sample(dataset=dataset, speaker_idx=int(speaker_idx), listener_idx=int(listener_idx), same=same, rng=py_rng, generator=generator)
+            for speaker_idx, listener_idx, same in self._sample_indices(len(dataset), rng)
+        ]
+        return self.collate_fn(batch)
+
+    @staticmethod
+    def _sampling_key(dataset) -> tuple:
+        """
+        :returns: tuple of the dataset attributes that the sampled batches depend on.
+        """
+        return (dataset.mode, dataset.nbr_distractors[dataset.mode])
+
+    def _produce(self, dataset, rngs, stop_event, prefetch_queue):
+        while not stop_event.is_set():
+            start_key = self._sampling_key(dataset)
+            if "train" not in start_key[0]:
+                stop_event.wait(0.01)
+                continue
+            try:
+                batch = self._make_batch(dataset, *rngs)
+            except Exception as e:
+                prefetch_queue.put(e)
+                return
+            if self._sampling_key(dataset) != start_key:
+                # The dataset changed while the batch was being sampled:
+                continue
+            while not stop_event.is_set():
+                try:
+                    prefetch_queue.put((start_key, batch), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def _start_producer(self, dataset):
+        if self.producer is not None and self.producer.is_alive():
+            return
+        self.prefetch_queue = queue.Queue(maxsize=self.prefetch_size)
+        self.stop_event = threading.Event()
+        # Dedicated random states, seeded from the global one for reproducibility,
+        # so that the thread does not consume the global random states concurrently:
+        seed = np.random.randint(2**31-1)
+        rngs = (np.random.RandomState(seed), random.Random(seed), torch.Generator().manual_seed(seed))
+        self.producer = threading.Thread(
+            target=self._produce, 
+            args=(dataset, rngs, self.stop_event, self.prefetch_queue),
+            daemon=True,
+        )
+        self.producer.start()
+
+    def _stop_producer(self):
+        if self.producer is None:
+            return
+        self.stop_event.set()
+        self.producer.join()
+        self.producer = None
+        self.prefetch_queue = None
+        self.stop_event = None
+
+    def _get_prefetched_batch(self, dataset):
+        self._start_producer(dataset)
+        key = self._sampling_key(dataset)
+        while True:
+            item = self.prefetch_queue.get()
+            if isinstance(item, Exception):
+                self._stop_producer()
+                raise item
+            batch_key, batch = item
+            # Batches sampled before a change of the dataset (e.g. of its number of distractors)
+            # are stale and discarded:
+            if batch_key == key:
+                return batch
+
     def compute(self, input_streams_dict:Dict[str,object]) -> Dict[str,object] :
         """
         
@@ -69,80 +244,32 @@ class ObverterDatasamplingModule(Module):
             dataset = input_streams_dict["dataset"]
             # assumes DualLabeledDataset...
             train_dataset = dataset.datasets["train"]
-            latents_to_possible_indices = train_dataset.latents_to_possible_indices
 
             # Make the descriptive ratio no longer effective:
             dataset.kwargs["descriptive"] = False 
 
-            idxconverter = train_dataset.indices
-            
-            batch = []
-            n_same = int(0.25*self.batch_size)
-            n_same_shape = int(0.3*self.batch_size)
-            n_same_color = int(0.2*self.batch_size)
-            n_random = self.batch_size - n_same_shape - n_same_color - n_same
-
-            for i in range(n_same):
-                speaker_idx = np.random.randint(len(dataset))
-                latents_class = train_dataset.getlatentclass(speaker_idx) 
-                color_id = latents_class[0]
-                shape_id = latents_class[1]
-                listener_idx = np.random.choice(
-                    [
-                        idx 
-                        for idx in latents_to_possible_indices[color_id][shape_id]
-                        if idx != speaker_idx
-                    ]
-                )
-                batch.append(self.sample(dataset=dataset, speaker_idx=speaker_idx, listener_idx=listener_idx, same=True))
-
-            for i in range(n_same_shape):
-                speaker_idx = np.random.randint(len(dataset))
-                latents_class = train_dataset.getlatentclass(speaker_idx) 
-                speaker_color_id = latents_class[0]
-                shape_id = latents_class[1]
-                choice_set = copy.deepcopy(train_dataset.same_shape_indices[shape_id])
-                choice_set.remove(speaker_idx)
-                listener_idx = np.random.choice(choice_set)
-                batch.append(self.sample(dataset=dataset, speaker_idx=speaker_idx, listener_idx=listener_idx, same=False))
-
-            for i in range(n_same_color):
-                speaker_idx = np.random.randint(len(dataset))
-                latents_class = train_dataset.getlatentclass(speaker_idx) 
-                color_id = latents_class[0]
-                speaker_shape_id = latents_class[1]
-                choice_set = copy.deepcopy(train_dataset.same_color_indices[color_id])
-                choice_set.remove(speaker_idx)
-                listener_idx = np.random.choice(choice_set)
-                batch.append(self.sample(dataset=dataset, speaker_idx=speaker_idx, listener_idx=listener_idx, same=False))
-
-            for i in range(n_random):
-                speaker_idx = np.random.randint(len(dataset))
-                speaker_latents_class = train_dataset.getlatentclass(speaker_idx) 
-                speaker_color_id = speaker_latents_class[0]
-                speaker_shape_id = speaker_latents_class[1]
-                
-                listener_idx = np.random.randint(len(dataset))
-                listener_latents_class = train_dataset.getlatentclass(listener_idx) 
-                listener_color_id = listener_latents_class[0]
-                listener_shape_id = listener_latents_class[1]
-                
-                same = (speaker_shape_id == listener_shape_id) and (speaker_color_id == listener_color_id)
-                
-                batch.append(self.sample(dataset=dataset, speaker_idx=speaker_idx, listener_idx=listener_idx, same=same))
-
-            new_sample = self.collate_fn(batch)
+            if self.index_arrays_dataset is not train_dataset:
+                self._stop_producer()
+                self._build_index_arrays(train_dataset)
+
+            if self.prefetch_size > 0:
+                new_sample = self._get_prefetched_batch(dataset)
+            else:
+                new_sample = self._make_batch(dataset, np.random)
             
             if input_streams_dict["use_cuda"]:
                 new_sample = new_sample.cuda()
 
             outputs_dict["current_dataloader:sample"] = new_sample
+        elif "train" not in mode:
+            # Do not sample from the dataset concurrently with the evaluation:
+            self._stop_producer()
 
         return outputs_dict
 
-    def sample(self, dataset, speaker_idx, listener_idx, same:bool=True):
+    def sample(self, dataset, speaker_idx, listener_idx, same:bool=True, rng:random.Random=None, generator:torch.Generator=None):
         # Creating speaker's dictionnary:
-        speaker_sample_d = dataset.sample(idx=speaker_idx)
+        speaker_sample_d = dataset.sample(idx=speaker_idx, rng=rng)
         
         # Adding batch dimension:
         for k,v in speaker_sample_d.items():
@@ -158,7 +285,7 @@ class ObverterDatasamplingModule(Module):
         ##--------------------------------------------------------------
 
         # Creating listener's dictionnary:
-        listener_sample_d = dataset.sample(idx=listener_idx)
+        listener_sample_d = dataset.sample(idx=listener_idx, rng=rng)
         
         # Adding batch dimension:
         for k,v in listener_sample_d.items():
@@ -167,7 +294,7 @@ class ObverterDatasamplingModule(Module):
             listener_sample_d[k] = v.unsqueeze(0)
 
         
-        listener_sample_d["experiences"], target_decision_idx, orders = shuffle(listener_sample_d["experiences"])
+        listener_sample_d["experiences"], target_decision_idx, orders = shuffle(listener_sample_d["experiences"], generator=generator)
         if not same:
             # The target_decision_idx is set to `nbr_experiences`:
             target_decision_idx = (dataset.nbr_distractors[dataset.mode]+1)*torch.ones(1).long()
@@ -7,7 +7,9 @@ import torch.nn as nn
 import torch.optim as optim 
 
 from .module import Module
-from ..networks import handle_nan
+from ..networks import handle_nan_foreach
+from ..networks.homoscedastic_multitask_loss import HomoscedasticLogVarsMixin
+from ..utils import mark_updated
 
 #TODO:
 """
@@ -64,21 +66,63 @@ class OptimizationModule(Module):
                                                  type="OptimizationModule",
                                                  config=config,
                                                  input_stream_ids=input_stream_ids)
-        parameters = []
+        # Parameter groups, one per module, where shared parameters
+        # (e.g. between agents) only appear in the first group:
+        self.param_groups = []
+        # (tensors are hashed by identity)
+        seen_params = set()
         for k,m in self.config["modules"].items():
-            parameters += m.parameters()
-
+            group_params = []
+            for p in m.parameters():
+                if p in seen_params: continue
+                seen_params.add(p)
+                group_params.append(p)
+            if len(group_params) == 0: continue
+            self.param_groups.append({"params":group_params, "name":k})
+        self.optimized_parameters = [p for group in self.param_groups for p in group["params"]]
+        # Parameters that grow during training, e.g. with new tasks:
+        self.resizable_parameters = [
+            sm.homoscedastic_log_vars
+            for m in self.config["modules"].values()
+            for sm in m.modules()
+            if isinstance(sm, HomoscedasticLogVarsMixin)
+        ]
+
+        self.optimizer = self._build_optimizer(self.param_groups)
+
+        # Cache of the device-side tensors of (python scalar) loss weights:
+        self.weights_cache = {}
+
+    def _build_optimizer(self, param_groups):
         if "sgd" in self.config["optimizer_type"].lower():
-          self.optimizer = optim.SGD(parameters, 
-                                      lr=self.config["learning_rate"])
+            optimizer_class = optim.SGD
+            kwargs = {"lr":self.config["learning_rate"]}
         else:
-          self.optimizer = optim.Adam(parameters, 
-                                      lr=self.config["learning_rate"], 
-                                      betas=(0.9, 0.999), 
-                                      eps=self.config["adam_eps"])
+            optimizer_class = optim.Adam
+            kwargs = {
+                "lr":self.config["learning_rate"], 
+                "betas":(0.9, 0.999), 
+                "eps":self.config["adam_eps"],
+            }
 
-    def save(self, path):
-      torch.save(self.optimizer.state_dict(), os.path.join(path, self.id+".module"))
+        # Multi-tensor (foreach) update, or fully-fused kernels if requested and supported:
+        use_fused = self.config.get("use_fused_optimizer", False)\
+            and len(self.optimized_parameters) > 0\
+            and all(p.is_cuda for p in self.optimized_parameters)
+        for implementation_kwargs in [{"fused":True}, {"foreach":True}]:
+            if "fused" in implementation_kwargs and not use_fused: continue
+            try:
+                return optimizer_class(param_groups, **kwargs, **implementation_kwargs)
+            except (TypeError, RuntimeError):
+                # Older versions of torch do not support these kwargs:
+                continue
+        return optimizer_class(param_groups, **kwargs)
+
+    def save(self, path, checkpointer=None):
+      if checkpointer is not None:
+        checkpointer.save_object(self.optimizer.state_dict(), os.path.join(path, self.id+".module"), use_torch=True)
+      else:
+        torch.save(self.optimizer.state_dict(), os.path.join(path, self.id+".module"))
 
     def load(self, path):
       self.optimizer.load_state_dict(torch.load(os.path.join(path, self.id+".module")))
@@ -104,26 +148,69 @@ class OptimizationModule(Module):
         it_rep = input_streams_dict["it_sample"]
         it_comm_round = input_streams_dict["it_step"]
 
-        for l_name, l in losses_dict.items():
-            logs_dict[f"{mode}/{l_name}"] = l[-1]
-        
-        for l_name, l in losses_dict.items():
-            losses_dict[l_name] = l[0]*l[-1]
+        if len(losses_dict) == 0:
+            return outputs_stream_dict
+
+        loss_names = list(losses_dict.keys())
+        weights = [losses_dict[l_name][0] for l_name in loss_names]
+        losses = [losses_dict[l_name][-1] for l_name in loss_names]
+
+        # Detached device tensors, which the logger transfers to the host in one go:
+        for l_name, l in zip(loss_names, losses):
+            logs_dict[f"{mode}/{l_name}"] = l.detach()
         
-        loss = sum([l.mean() for l in losses_dict.values()])
+        stacked_weights = self._stack_weights(weights, device=losses[0].device, dtype=losses[0].dtype)
+        if all(l.shape == losses[0].shape for l in losses):
+            stacked_losses = torch.stack(losses, dim=0)
+            # (nbr_losses, *loss_shape)
+            weighted_losses = stacked_weights.view(-1, *[1]*losses[0].dim())*stacked_losses
+            loss = weighted_losses.reshape(len(losses), -1).mean(dim=-1).sum()
+            for l_name, wl in zip(loss_names, weighted_losses.unbind(0)):
+                losses_dict[l_name] = wl
+        else:
+            loss_means = torch.stack([l.mean() for l in losses], dim=0)
+            # (nbr_losses, )
+            loss = (stacked_weights*loss_means).sum()
+            for l_name, w, l in zip(loss_names, stacked_weights.unbind(0), losses):
+                losses_dict[l_name] = w*l
 
         if "train" in mode:
             self.optimizer.zero_grad()
             loss.backward()
             
-            for k,m in self.config["modules"].items():
-                m.apply(handle_nan)
-                if self.config["with_gradient_clip"]:
-                    nn.utils.clip_grad_value_(m.parameters(), self.config["gradient_clip"])
+            handle_nan_foreach(self.optimized_parameters, verbose=self.config.get("verbose_nan", True))
+            if self.config["with_gradient_clip"]:
+                if self.config.get("gradient_clip_type", "value") == "norm":
+                    nn.utils.clip_grad_norm_(self.optimized_parameters, self.config["gradient_clip"])
+                else:
+                    nn.utils.clip_grad_value_(self.optimized_parameters, self.config["gradient_clip"])
             
+            if len(self.resizable_parameters):
+                self._reset_resized_parameters_state()
             self.optimizer.step()
+            # Flags the parameters as modified for the `Checkpointer`:
+            mark_updated(self.optimized_parameters)
 
-        logs_dict[f"{mode}/repetition{it_rep}/comm_round{it_comm_round}/Loss"] = loss
+        logs_dict[f"{mode}/repetition{it_rep}/comm_round{it_comm_round}/Loss"] = loss.detach()
         
         return outputs_stream_dict
+
+    def _reset_resized_parameters_state(self):
+        for p in self.resizable_parameters:
+            state = self.optimizer.state.get(p, None)
+            if state is None: continue
+            if any(isinstance(v, torch.Tensor) and v.dim() > 0 and v.shape != p.shape for v in state.values()):
+                # The running statistics of the previous shape cannot be updated:
+                del self.optimizer.state[p]
+
+    def _stack_weights(self, weights, device, dtype):
+        if all(isinstance(w, (int, float)) for w in weights):
+            key = (tuple(weights), device, dtype)
+            if key not in self.weights_cache:
+                if len(self.weights_cache) >= 64:
+                    # e.g. annealed weights:
+                    self.weights_cache = {}
+                self.weights_cache[key] =  torch.tensor(weights, device=device, dtype=dtype)
+            return self.weights_cache[key]
+        return torch.stack([torch.as_tensor(w, device=device, dtype=dtype).reshape(()) for w in weights], dim=0)
         
\ No newline at end of file
@@ -7,6 +7,7 @@ import torch.optim as optim
 import numpy as np 
 
 from .module import Module
+from ..utils import StreamingSummary, batched_to_host
 
 def build_PerEpochLoggerModule(id:str,
                                config:Dict[str,object]=None,
@@ -72,7 +73,21 @@ class PerEpochLoggerModule(Module):
                                                  config=config,
                                                  input_stream_ids=input_stream_ids)
         
+        # Constant-memory summary of the values of each key over the current epoch:
         self.storages = {}
+        # Keys whose values are tensors rather than python scalars:
+        self.tensor_keys = set()
+        self.sketch_size = 256
+        if self.config is not None and "sketch_size" in self.config:
+            self.sketch_size = self.config["sketch_size"]
+        
+        # The logs are kept on their devices and transferred to the host in one go
+        # at the end of each epoch, and every `flush_period` steps if it is not None, 
+        # e.g. to bound the device memory of long epochs (1 transfers them at every step):
+        self.flush_period = None
+        if self.config is not None and "flush_period" in self.config:
+            self.flush_period = self.config["flush_period"]
+        self.pending_logs = []
 
         self.end_of_ = [key for key,value in input_stream_ids.items() if "end_of_" in key]
         
@@ -91,81 +106,85 @@ class PerEpochLoggerModule(Module):
         logger = input_streams_dict["logger"]
 
         # Store new data:
+        pending_logs_dict = {}
         for key,value in logs_dict.items():
-          if key not in self.storages:
-            self.storages[key] = []
           if isinstance(value, torch.Tensor):
-            value = value.cpu().detach()
-          self.storages[key].append(value)
-        
+            value = value.detach()
+          elif not(isinstance(value, float) or isinstance(value, int)):
+            continue
+          pending_logs_dict[key] = value
+        self.pending_logs.append((global_it_step, pending_logs_dict))
+
         # Is it the end of the epoch?
         end_of_epoch = all([
           input_streams_dict[key]
           for key in self.end_of_]
         )
         
-        # If so, let us average over every value and save it:
+        if not(end_of_epoch)\
+          and (self.flush_period is None or len(self.pending_logs) < self.flush_period):
+          return {}
+        
+        host_logs = self._pending_logs_to_host()
+        self.pending_logs = []
+        for _, step_logs_dict in host_logs:
+          for key, value in step_logs_dict.items():
+            if key not in self.storages:
+              self.storages[key] = StreamingSummary(k=self.sketch_size)
+              if isinstance(value, np.ndarray):
+                self.tensor_keys.add(key)
+            self.storages[key].update(value)
+        
+        # If so, let us log the summary statistics of every key:
         if end_of_epoch:
-          for key, valuelist in self.storages.items():
-            need_stats = False
-            if isinstance(valuelist[0], torch.Tensor):# and len(valuelist[0].shape)>=1:
-              values = torch.cat([vl.cpu().detach().reshape(-1) for vl in valuelist], dim=0).numpy()
-              need_stats = True
-            elif isinstance(valuelist[0], float) or isinstance(valuelist[0], int):
-              values = np.asarray(valuelist).reshape(-1)
-              if len(valuelist)>1:
-                need_stats = True
-            else:
-              continue
+          for key, summary in self.storages.items():
+            need_stats = key in self.tensor_keys or len(summary)>1
 
             if need_stats:
-              averaged_value = values.mean()
-              std_value = values.std()
-              logger.add_scalar(f"PerEpoch/{key}/Mean", averaged_value, epoch)
-              logger.add_scalar(f"PerEpoch/{key}/Std", std_value, epoch)
+              logger.add_scalar(f"PerEpoch/{key}/Mean", summary.get_mean(), epoch)
+              logger.add_scalar(f"PerEpoch/{key}/Std", summary.get_std(), epoch)
               
-              median_value = np.nanpercentile(
-                values,
-                q=50,
-                axis=None,
-                interpolation="nearest"
-              )
-              q1_value = np.nanpercentile(
-                values,
-                q=25,
-                axis=None,
-                interpolation="lower"
-              )
-              q3_value = np.nanpercentile(
-                values,
-                q=75,
-                axis=None,
-                interpolation="higher"
-              )
+              q1_value, median_value, q3_value = summary.get_quantile([0.25, 0.5, 0.75])
               iqr = q3_value-q1_value
               logger.add_scalar(f"PerEpoch/{key}/Median", median_value, epoch)
               logger.add_scalar(f"PerEpoch/{key}/Q1", q1_value, epoch)
               logger.add_scalar(f"PerEpoch/{key}/Q3", q3_value, epoch)
               logger.add_scalar(f"PerEpoch/{key}/IQR", iqr, epoch)
-              
-              #logger.add_histogram(f"PerEpoch/{key}", values, epoch)
             else:
-              logger.add_scalar(f"PerEpoch/{key}", valuelist[-1], epoch)
+              logger.add_scalar(f"PerEpoch/{key}", summary.last, epoch)
               # Remove the value form the logs_dict if it is present:
               logs_dict.pop(key, None)
+              host_logs[-1][1].pop(key, None)
 
           # Reset epoch storages:
           self.storages = {}
+          self.tensor_keys = set()
 
           # Flush data:
           logger.flush()
 
 
         # Log new (rectified) data:
-        for key,value in logs_dict.items():
-          if isinstance(value, torch.Tensor): 
-              value = value.mean().item()
-          logger.add_scalar(key, value, global_it_step)
+        for step, step_logs_dict in host_logs:
+          for key,value in step_logs_dict.items():
+            if isinstance(value, np.ndarray): 
+                value = value.mean()
+            logger.add_scalar(key, value, step)
 
         return {}
-        
\ No newline at end of file
+
+    def _pending_logs_to_host(self):
+        tensors = [
+          value 
+          for _, step_logs_dict in self.pending_logs 
+          for value in step_logs_dict.values() 
+          if isinstance(value, torch.Tensor)
+        ]
+        arrays = iter(batched_to_host(tensors))
+        host_logs = []
+        for step, step_logs_dict in self.pending_logs:
+          host_logs.append((step, {
+            key: next(arrays) if isinstance(value, torch.Tensor) else value
+            for key, value in step_logs_dict.items()
+          }))
+        return host_logs
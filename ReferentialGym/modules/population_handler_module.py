@@ -10,6 +10,7 @@ import random
 import glob
 
 from .module import Module
+from ..utils import Checkpointer, mark_updated
 
 
 def build_PopulationHandlerModule(id:str,
@@ -100,41 +101,49 @@ class PopulationHandlerModule(Module):
         self.previous_global_it_datasample = -1
         self.counterGames = 0
 
-    def save(self, path):
+        # Per-epoch agent checkpoints are written in the background,
+        # and only for the agents that have changed since their last checkpoint:
+        self.checkpointer = Checkpointer(verbose=self.verbose)
+
+    def save(self, path, checkpointer=None):
+        if checkpointer is None:
+            checkpointer = self.checkpointer
+
         path = os.path.join(path, self.id)
         os.makedirs(path, exist_ok=True)
 
         if 'cultural_reset_strategy' in self.config\
             and 'meta' in self.config['cultural_reset_strategy']:
-            meta_agents_optimizers = self.meta_agents_optimizers
-            self.meta_agents_optimizers = None
-            meta_agents_optimizers_state_dicts = {k: v.state_dict() for k, v in meta_agents_optimizers.items()}
-            torch.save(meta_agents_optimizers_state_dicts, path+".optimizers_state_dict")
-            self.meta_agents_optimizers = meta_agents_optimizers
+            meta_agents_optimizers_state_dicts = {k: v.state_dict() for k, v in self.meta_agents_optimizers.items()}
+            checkpointer.save_object(meta_agents_optimizers_state_dicts, path+".optimizers_state_dict", use_torch=True)
             
             meta_path = os.path.join(path, "meta_agents")
-            os.makedirs(meta_path, exist_ok=True)
-
-            for name, meta_agent in self.meta_agents:
-                meta_agent.save(meta_path, filename=meta_agent.id+".agent")
+            for name, meta_agent in self.meta_agents.items():
+                meta_agent.save(meta_path, filename=meta_agent.id+".state_dict", checkpointer=checkpointer)
         
         speakers_path = os.path.join(path, "speakers")
-        os.makedirs(speakers_path, exist_ok=True)
         for speaker in self.speakers:
-            speaker.save(speakers_path, filename=speaker.id+".agent")
+            speaker.save(speakers_path, filename=speaker.id+".state_dict", checkpointer=checkpointer)
         
         listeners_path = os.path.join(path, "listeners")
-        os.makedirs(listeners_path, exist_ok=True)
         for listener in self.listeners:
-            listener.save(listeners_path, filename=listener.id+".agent")
+            listener.save(listeners_path, filename=listener.id+".state_dict", checkpointer=checkpointer)
 
         try:
-            with open(path+"agent_stats.dict", 'wb') as f:
-                pickle.dump(self.agents_stats, f, protocol=pickle.HIGHEST_PROTOCOL)
+            checkpointer.save_object(self.agents_stats, path+"agent_stats.dict")
         except Exception as e:
             print(f"Exception caught while trying to save agents stats: {e}")
 
-            
+    def _load_agents_state_dicts(self, path, dagents):
+        for agent_path in glob.glob(os.path.join(path, "*.state_dict")):
+            agent_id = os.path.basename(agent_path)[:-len(".state_dict")]
+            try:
+                if agent_id not in dagents.keys():
+                    raise ValueError(f"loading an agent that was not there previously...: {agent_id}.")
+                dagents[agent_id].load_state_dict(torch.load(agent_path, map_location="cpu"))
+            except Exception as e:
+                print(f"WARNING: exception caught when trying to load agent {agent_id}: {e}")
+
     def load(self, path):
         mpath = os.path.join(path, self.id)
 
@@ -144,34 +153,13 @@ class PopulationHandlerModule(Module):
         except Exception as e:
             print(f"Exception caught while trying to load agents stats: {e}")
 
-        listeners_path = os.path.join(mpath, "listeners")
-        listeners_paths = glob.glob(os.path.join(listeners_path, "*.agent"))
-        for listener_idx, listener_path in enumerate(listener_paths):
-            try:
-                listener = torch.load(listener_path)
-                listener_id = listener.id 
-                if listener_id not in self.dlisteners.keys():
-                    print(f"WARNING: loading a listener that was not there previously...: {listener_id}.")
-                    raise
-                self.dlisteners[meta_agent_id] = listener
-                self.listeners[listener_idx] = listener
-            except Exception as e:
-                print(f"WARNING: exception caught when trying to load listener {listener_id}: {e}")
-
-        speakers_path = os.path.join(mpath, "speakers")
-        speakers_paths = glob.glob(os.path.join(speakers_path, "*.agent"))
-        for speaker_idx, speaker_path in enumerate(speaker_paths):
-            try:
-                speaker = torch.load(speaker_path)
-                speaker_id = speaker.id 
-                if speaker_id not in self.dspeakers.keys():
-                    print(f"WARNING: loading a speaker that was not there previously...: {speaker_id}.")
-                    raise
-                self.dspeakers[meta_agent_id] = speaker
-                self.speakers[speaker_idx] = speaker
-            except Exception as e:
-                print(f"WARNING: exception caught when trying to load speaker {speaker_id}: {e}")
-
+        dagents = dict()
+        dagents.update({agent.id: agent for agent in self.speakers})
+        dagents.update({agent.id: agent for agent in self.listeners})
+        # The roles may have been swapped since the save (e.g. obverter):
+        self._load_agents_state_dicts(os.path.join(mpath, "listeners"), dagents)
+        self._load_agents_state_dicts(os.path.join(mpath, "speakers"), dagents)
+        
         if 'cultural_reset_strategy' in self.config\
             and 'meta' in self.config['cultural_reset_strategy']:
             meta_agents_optimizers_state_dicts = torch.load(mpath+".optimizers_state_dict")
@@ -181,18 +169,10 @@ class PopulationHandlerModule(Module):
                 except Exception as e:
                     print(f"WARNING: exception caught when trying to load meta agent optimizer {k}: {e}")
 
-            meta_path = os.path.join(mpath, "meta_agents")
-            meta_agents_paths = glob.glob(os.path.join(meta_path, "*.agent"))
-            
-            for meta_agent_path in meta_agents_paths:
-                try:
-                    meta_agent = torch.load(meta_path)
-                    meta_agent_id = meta_agent.id 
-                    if meta_agent_id not in self.meta_agents.keys():
-                        print(f"WARNING: loading a meta agent that was not there previously...: {meta_agent_id}.")
-                    self.meta_agents[meta_agent_id] = meta_agent
-                except Exception as e:
-                    print(f"WARNING: exception caught when trying to load meta agent {meta_agent_id}: {e}")
+            self._load_agents_state_dicts(
+                os.path.join(mpath, "meta_agents"),
+                {meta_agent.id: meta_agent for meta_agent in self.meta_agents.values()}
+            )
 
     def _select_agents(self):
         idx_speaker = random.randint(0,len(self.speakers)-1)
@@ -212,15 +192,16 @@ class PopulationHandlerModule(Module):
         if epoch != self.previous_epoch:
             self.previous_epoch = epoch
             # Save agent:
-            for agent in self.speakers:
-                agent.save(path=os.path.join(self.config['save_path'],'{}_{}.pt'.format(agent.kwargs['architecture'], agent.agent_id)))
-            for agent in self.listeners:
-                agent.save(path=os.path.join(self.config['save_path'],'{}_{}.pt'.format(agent.kwargs['architecture'], agent.agent_id)))
-            
+            agents = list(self.speakers)+list(self.listeners)
             if 'cultural_reset_strategy' in self.config\
                 and 'meta' in self.config['cultural_reset_strategy']:
-                for agent in self.meta_agents.values():
-                    agent.save(path=os.path.join(self.config['save_path'],'{}_{}.pt'.format(agent.kwargs['architecture'], agent.agent_id)))
+                agents += list(self.meta_agents.values())
+            for agent in agents:
+                agent.save(
+                    path=self.config['save_path'],
+                    filename='{}_{}.pt'.format(agent.kwargs['architecture'], agent.agent_id),
+                    checkpointer=self.checkpointer
+                )
 
         # Reset agent(s):
         if 'train' in mode \
@@ -307,6 +288,7 @@ class PopulationHandlerModule(Module):
         meta_learner.zero_grad()
         self._reptile_step(learner=learner, reptile_learner=meta_learner)
         meta_optimizer.step()
+        mark_updated(list(meta_learner.parameters()))
         learner.load_state_dict( meta_learner.state_dict())
         return 
 
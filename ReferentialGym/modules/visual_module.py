@@ -5,6 +5,7 @@ import torch.nn as nn
 
 from .module import Module
 from ..networks import choose_architecture, BetaVAE
+from ..networks.autoregressive_networks import CompactnessConstraintMixin
 
 def build_VisualModule(id:str,
                        config:Dict[str,object],
@@ -128,6 +129,9 @@ class VisualModule(Module):
         experiences = input_streams_dict["inputs"]
         losses_dict = input_streams_dict["losses_dict"]
         logs_dict = input_streams_dict["logs_dict"]
+        # Optional stream, e.g. "current_dataloader:sample:speaker_exp_superpixel_labels",
+        # of the superpixel labels of the experiences, provided by the dataset:
+        superpixel_labels = input_streams_dict.get("superpixel_labels", None)
 
         batch_size = experiences.size(0)
         nbr_distractors_po = experiences.size(1)
@@ -136,9 +140,16 @@ class VisualModule(Module):
         feat_maps = []
         total_size = experiences.size(0)
         mini_batch_size = min(self.config["cnn_encoder_mini_batch_size"], total_size)
-        for stin in torch.split(experiences, split_size_or_sections=mini_batch_size, dim=0):
+        if superpixel_labels is not None and isinstance(self.encoder, CompactnessConstraintMixin):
+            superpixel_labels = torch.split(superpixel_labels.reshape(total_size, -1), split_size_or_sections=mini_batch_size, dim=0)
+        else:
+            superpixel_labels = None
+        for idx_stin, stin in enumerate(torch.split(experiences, split_size_or_sections=mini_batch_size, dim=0)):
             if isinstance(self.encoder, BetaVAE):
-                cnn_output_dict  = self.encoder.compute_loss(stin)
+                if superpixel_labels is not None:
+                    cnn_output_dict  = self.encoder.compute_loss(stin, superpixel_labels=superpixel_labels[idx_stin])
+                else:
+                    cnn_output_dict  = self.encoder.compute_loss(stin)
                 if "VAE_loss" in cnn_output_dict:
                     self.VAE_losses.append(cnn_output_dict["VAE_loss"])
                 
@@ -1,15 +1,16 @@
-from .networks import FCBody, LSTMBody, GRUBody, MHDPA_RN 
+from .networks import FCBody, LSTMBody, GRUBody, MHDPA_RN, entity_attention
 from .networks import ConvolutionalBody, EntityPrioredConvolutionalBody, ConvolutionalLstmBody, ConvolutionalGruBody, ConvolutionalMHDPABody
 from .residual_networks import ModelResNet18, ModelResNet18AvgPooled, ResNet18MHDPA, ResNet18AvgPooledMHDPA, ExtractorResNet18
 from .networks import ModelVGG16, ExtractorVGG16
 
-from .networks import layer_init, hasnan, handle_nan, reg_nan
+from .networks import layer_init, hasnan, handle_nan, handle_nan_foreach, reg_nan
 
 from .autoregressive_networks import DeconvolutionalBody
 from .autoregressive_networks import ResNetEncoder, ResNetAvgPooledEncoder, BroadcastingDecoder, ResNetParallelAttentionEncoder, ParallelAttentionBroadcastingDeconvDecoder
 from .autoregressive_networks import BetaVAE, MONet, ParallelMONet
 
 from .homoscedastic_multitask_loss import HomoscedasticMultiTasksLoss 
+from .grouped_heads import plan_grouped_heads, grouped_heads_forward
 
 import torch.nn as nn 
 import torch.nn.functional as F 
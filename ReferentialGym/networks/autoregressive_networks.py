@@ -8,12 +8,12 @@ import torchvision
 
 import copy
 import math
+import hashlib
 from numbers import Number 
+from collections import OrderedDict
 from functools import partial
 
 import numpy as np 
-from skimage import segmentation
-import cv2
 
 from .networks import FCBody, ConvolutionalBody, MHDPA_RN, layer_init, ConvolutionalMHDPABody
 from .residual_networks import ModelResNet18, ModelResNet18AvgPooled
@@ -1193,29 +1193,208 @@ class ParallelAttentionNetwork(nn.Module):
         xin = torch.cat([x, logscope], dim=1)
         xout = self.net(xin)
 
-        logmasks = torch.empty(batch_size, self.nbr_attention_slot, *self.input_shape[-2:]).to(x.device)
-        logscopes = torch.empty(batch_size, self.nbr_attention_slot, *self.input_shape[-2:]).to(x.device)
-        logscopes[:,0:] = logscope 
-
-        for slot in range(self.nbr_attention_slot):
-            if slot < self.nbr_attention_slot-1:
-                x = xout[:,slot:slot+1,...]
-                ls = logscopes[:,slot:slot+1,...]  
-                # log( m_k ) = log( s_{k-1} * sigmoid(unet(xin)) )
-                #logmask = logscope+F.logsigmoid(xout)
-                logmask = ls+F.logsigmoid(x)
-                # log( s_k ) = log( s_{k-1} * (1-sigmoid(unet(xin))) ) = log(s_{k-1}) + log( 1-sigmoid(unet(xin))) (==sigmoid(-unet(xin)))
-                #nlogscope = logscope+F.logsigmoid(-xout)
-                nls = ls+F.logsigmoid(-x)
-
-                logmasks[:,slot:slot+1] = logmask
-                logscopes[:,slot:slot+1] = nls
-            else:
-                logmasks[:,slot:slot+1] = logscopes[:,slot:slot+1]
+        # All the slots but the last one are computed at once:
+        # log( m_k ) = log( s_{k-1} * sigmoid(unet(xin)) )
+        logmasks = logscope+F.logsigmoid(xout)
+        # log( s_k ) = log( s_{k-1} * (1-sigmoid(unet(xin))) ) = log(s_{k-1}) + log( 1-sigmoid(unet(xin))) (==sigmoid(-unet(xin)))
+        logscopes = logscope+F.logsigmoid(-xout)
+        # The last slot takes the remaining scope:
+        logmasks = torch.cat([logmasks, logscope], dim=1)
+        logscopes = torch.cat([logscopes, logscope], dim=1)
         return logmasks, logscopes
 
 
-class MONet(BetaVAE):
+class SlotBatchedCVAEMixin(object):
+    """
+    Runs the component VAE of MONet-like models on all the attention slots 
+    in one call, by folding the slots into the batch dimension.
+    Only the attention network's scope recursion remains sequential.
+    """
+    def _forward_slots(self, x, log_masks):
+        """
+        :param x: Tensor of shape (batch_size, *input_shape).
+        :param log_masks: Tensor of shape (batch_size, nbr_attention_slot, 1, *input_shape[-2:]).
+        :returns:
+            - logprobs: Tensor of shape (batch_size, nbr_attention_slot, *input_shape).
+            - per_slot_kls: Tensor of shape (batch_size, nbr_attention_slot, latent_dim).
+        """
+        batch_size = x.size(0)
+        nbr_slots = self.nbr_attention_slot
+
+        vae_in = torch.cat((x.unsqueeze(1).expand(-1, nbr_slots, *x.shape[1:]), log_masks), dim=2)
+        # batch_size x nbr_attention_slot x (input_shape[0]+1) x H x W
+        mu, logvar, cvae_out = self._forward(vae_in.reshape(batch_size*nbr_slots, *vae_in.shape[2:]))
+        mu = mu.reshape(batch_size, nbr_slots, -1)
+        logvar = logvar.reshape(batch_size, nbr_slots, -1)
+        # batch_size x nbr_attention_slot x latent_dim
+        cvae_out = cvae_out.reshape(batch_size, nbr_slots, *cvae_out.shape[1:])
+        self.mus = list(mu.unbind(1))
+        self.logvars = list(logvar.unbind(1))
+
+        # Reconstructions Distributions:
+        x_rec, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=2)
+        # The first slot, i.e. the background, has a smaller observation scale:
+        slot_scales = torch.full((1, nbr_slots, 1, 1, 1), self.observation_sigma, dtype=x.dtype, device=x.device)
+        slot_scales[:, 0] *= 0.9
+        rec_dist = torch.distributions.Normal(x_rec, slot_scales.expand_as(x_rec))
+        logprobs = log_masks + rec_dist.log_prob(x.unsqueeze(1))
+
+        # KL divergence with latent prior:
+        per_slot_kls = -0.5 * (1 + logvar - mu.pow(2) - logvar.exp())
+        
+        self.masks = torch.clamp_min(log_masks.exp(), min=1e-9)
+        self.reconstructions = x_rec
+        self.log_mask_reconstructions = log_mask_rec
+
+        self.mu = mu.reshape(batch_size, -1)
+        self.logvar = logvar.reshape(batch_size, -1)
+        self.z = self.reparameterize(self.mu, self.logvar)
+
+        return logprobs, per_slot_kls
+
+    def decode(self, z):
+        batch_size = z.size(0)
+        cvae_out = self.decoder(z.reshape(batch_size*self.nbr_attention_slot, -1))
+        cvae_out = cvae_out.reshape(batch_size, self.nbr_attention_slot, *cvae_out.shape[1:])
+        reconstructions, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=2)
+        mask_reconstructions = torch.clamp_min(log_mask_rec.exp(), min=1e-9)
+
+        reconstructions = torch.sum( mask_reconstructions * reconstructions, dim=1)
+        return reconstructions
+
+
+def compute_superpixel_labels(images:np.ndarray, compactness:float=100.0, n_segments:int=10000) -> np.ndarray:
+    """
+    :param images: Numpy Array of shape (batch_size, H, W, C), in [0, 255].
+    :returns: Numpy Array of shape (batch_size, H*W) of the SLIC superpixel label of each pixel,
+              relabelled contiguously from 0 for each image.
+    """
+    # Optional dependency, only imported when the constraint is used:
+    from skimage import segmentation
+    labels = []
+    for image in images:
+        image_labels = segmentation.slic(image, compactness=compactness, n_segments=n_segments).reshape(-1)
+        labels.append(np.unique(image_labels, return_inverse=True)[1].reshape(-1))
+    return np.stack(labels, axis=0).astype(np.int64)
+
+
+def superpixel_majority_vote(targets:torch.Tensor, superpixel_labels:torch.Tensor, nbr_classes:int) -> torch.Tensor:
+    """
+    Relabels each pixel with the most frequent target among the pixels of its superpixel.
+    Ties are broken in favour of the smallest target.
+
+    :param targets: LongTensor of shape (batch_size, nbr_pixels) with values in [0, nbr_classes).
+    :param superpixel_labels: LongTensor of shape (batch_size, nbr_pixels) with values in [0, nbr_pixels).
+    :returns: LongTensor of shape (batch_size, nbr_pixels).
+    """
+    batch_size, nbr_pixels = targets.shape
+    batch_offsets = torch.arange(batch_size, device=targets.device).unsqueeze(-1)*nbr_pixels
+    keys = (batch_offsets+superpixel_labels)*nbr_classes+targets
+    counts = torch.bincount(keys.reshape(-1), minlength=batch_size*nbr_pixels*nbr_classes)
+    majority = counts.reshape(batch_size, nbr_pixels, nbr_classes).argmax(dim=-1)
+    # batch_size x nbr_superpixels(<=nbr_pixels)
+    return torch.gather(majority, dim=1, index=superpixel_labels)
+
+
+class CompactnessConstraintMixin(object):
+    """
+    Unsupervised segmentation constraint that pushes the attention masks of 
+    MONet-like models towards being constant over the superpixels of the stimuli.
+    Adapted from: 
+    https://github.com/kanezaki/pytorch-unsupervised-segmentation/blob/master/demo.py
+
+    The superpixel labels of the stimuli are preferably provided along with them,
+    e.g. by a dataset that stores them on disk, cf. `datasets.SuperpixelLabelsCache`.
+    Otherwise, they are computed on the fly and kept in a bounded LRU cache.
+    """
+    def _init_compactness_constraint(self, 
+                                     compactness_factor=None,
+                                     superpixel_cache_size=4096,
+                                     visualization_path=None,
+                                     visualization_period=1000):
+        """
+        :param superpixel_cache_size: int maximal number of stimuli whose superpixel labels are cached
+                                      in memory, when they are not provided along with the stimuli.
+        :param visualization_path: str path of the image file where the slot labels are visualized,
+                                   or None to disable the visualization.
+        :param visualization_period: int number of constrained forward passes between two visualizations.
+        """
+        self.compactness_factor = compactness_factor
+        self.use_compactness_constraint = self.compactness_factor is not None
+        self.superpixel_cache_size = superpixel_cache_size
+        self.superpixel_labels_cache = OrderedDict()
+        self.compactness_visualization_path = visualization_path
+        self.compactness_visualization_period = visualization_period
+        self.compactness_nbr_calls = 0
+
+    def get_superpixel_labels(self, x:torch.Tensor) -> torch.Tensor:
+        """
+        :param x: Tensor of shape (batch_size, *input_shape), with values in [0, 1].
+        :returns: LongTensor of shape (batch_size, H*W) on the device of :param x:.
+        """
+        nx = x.detach().cpu().numpy()
+        keys = [hashlib.blake2b(image.tobytes(), digest_size=16).digest() for image in nx]
+        labels = [None]*len(keys)
+        missing = []
+        for idx, key in enumerate(keys):
+            if key in self.superpixel_labels_cache:
+                self.superpixel_labels_cache.move_to_end(key)
+                labels[idx] = self.superpixel_labels_cache[key]
+            else:
+                missing.append(idx)
+        if len(missing):
+            images = nx[missing].astype('double').transpose((0, 2, 3, 1))*255.
+            for idx, image_labels in zip(missing, compute_superpixel_labels(images).astype(np.int32)):
+                labels[idx] = image_labels
+                self.superpixel_labels_cache[keys[idx]] = image_labels
+                if len(self.superpixel_labels_cache) > self.superpixel_cache_size:
+                    self.superpixel_labels_cache.popitem(last=False)
+        return torch.from_numpy(np.stack(labels, axis=0)).to(x.device)
+
+    def _compactness_losses(self, x, superpixel_labels=None):
+        """
+        :param superpixel_labels: LongTensor of shape (batch_size, H*W) of precomputed superpixel labels,
+                                  e.g. cached alongside the dataset, or None to compute/fetch them from the cache.
+        :returns: Tensor of shape (batch_size,).
+        """
+        batch_size = x.size(0)
+        if superpixel_labels is None:
+            superpixel_labels = self.get_superpixel_labels(x)
+        superpixel_labels = superpixel_labels.reshape(batch_size, -1).long().to(x.device)
+
+        slot_logits_ppx = self.masks.permute(0, 3, 4, 1, 2).reshape(batch_size, -1, self.nbr_attention_slot)
+        # batch x dim**2 x nbr_attention_slots
+        target = slot_logits_ppx.detach().argmax(dim=-1)
+        # batch x dim**2
+        target = superpixel_majority_vote(target, superpixel_labels, nbr_classes=self.nbr_attention_slot)
+
+        self.compactness_nbr_calls += 1
+        if self.compactness_visualization_path is not None\
+            and (self.compactness_nbr_calls-1) % self.compactness_visualization_period == 0:
+            self._visualize_compactness(x, target)
+
+        compactness_losses = F.cross_entropy(
+            slot_logits_ppx.reshape(-1, self.nbr_attention_slot),
+            target.reshape(-1),
+            reduction='none',
+        ).reshape(batch_size, -1).mean(-1)
+        # batch
+        return compactness_losses
+
+    def _visualize_compactness(self, x, target):
+        # Optional dependency, only imported when visualizing:
+        import cv2
+        im_vis = target[0].cpu().numpy()
+        # dim**2
+        label_colours = np.random.randint(255,size=(100,3))
+        im_vis_rgb = label_colours[ im_vis % 100 ]
+        im_vis_rgb = im_vis_rgb.reshape(*self.input_shape[-2:], 3).astype( np.uint8 )
+        im_input_rgb = (x[0].detach().cpu().numpy().transpose((1, 2, 0))*255.).astype( np.uint8 )
+        im_vis_rgb = np.concatenate([im_vis_rgb, im_input_rgb], axis=1)
+        cv2.imwrite( self.compactness_visualization_path, im_vis_rgb )
+
+
+class MONet(CompactnessConstraintMixin, SlotBatchedCVAEMixin, BetaVAE):
     def __init__(self,
                  gamma=0.5,
                  input_shape=[3, 64, 64], 
@@ -1234,7 +1413,9 @@ class MONet(BetaVAE):
                  cvae_nbrEpochTillMaxEncodingCapacity=4,
                  cvae_constrainedEncoding=True,
                  cvae_observation_sigma=0.05,
-                 compactness_factor=None):
+                 compactness_factor=None,
+                 compactness_visualization_path=None,
+                 compactness_visualization_period=1000):
         cvae_input_shape = copy.deepcopy(input_shape)
         cvae_input_shape[0] += 1
         super(MONet, self).__init__(beta=cvae_beta, 
@@ -1269,11 +1450,11 @@ class MONet(BetaVAE):
 
         self.nbr_attention_slot = nbr_attention_slot
 
-        self.compactness_factor = compactness_factor
-        if self.compactness_factor is not None:
-            self.use_compactness_constraint = True
-        else:
-            self.use_compactness_constraint = False
+        self._init_compactness_constraint(
+            compactness_factor=compactness_factor,
+            visualization_path=compactness_visualization_path,
+            visualization_period=compactness_visualization_period,
+        )
 
     def get_feature_shape(self):
         return self.latent_dim*self.nbr_attention_slot
@@ -1282,28 +1463,11 @@ class MONet(BetaVAE):
         self.forward(x) 
         return self.z, self.mu, self.logvar
 
-    def decode(self, z):
-        batch_size = z.size(0)
-        reconstructions = torch.empty(batch_size,
-                                      self.nbr_attention_slot,
-                                      *self.input_shape).to(z.device)
-        mask_reconstructions = torch.empty(batch_size, 
-                                           self.nbr_attention_slot, 
-                                           1,
-                                           *self.input_shape[-2:]).to(z.device)
-        for slot, slot_z in zip(range(self.nbr_attention_slot), torch.chunk(z, self.nbr_attention_slot, dim=1)):
-            cvae_out = self.decoder(slot_z)
-            x_rec, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=1)
-            reconstructions[:,slot] = x_rec
-            mask_reconstructions[:,slot] = torch.clamp_min(log_mask_rec.exp(), min=1e-9)
-
-        reconstructions = torch.sum( mask_reconstructions * reconstructions, dim=1)
-        return reconstructions
-
     def forward(self, 
                 x,
                 observation_sigma=None,
-                compute_loss=False):
+                compute_loss=False,
+                superpixel_labels=None):
         if observation_sigma is None:
             observation_sigma = self.observation_sigma
 
@@ -1312,61 +1476,21 @@ class MONet(BetaVAE):
         initial_scope = torch.zeros(1, 1, *self.input_shape[-2:])
         log_scope = initial_scope.repeat(batch_size, 1 ,1, 1).to(x.device)
 
-        logprobs = torch.empty(batch_size, 
-                               self.nbr_attention_slot, 
-                               *self.input_shape).to(x.device)
-        self.reconstructions = torch.empty_like(logprobs)
-        self.masks = torch.empty(batch_size, 
-                                 self.nbr_attention_slot, 
-                                 1,
-                                 *self.input_shape[-2:]).to(x.device)
-        self.log_mask_reconstructions = torch.empty_like(self.masks)
-
-        scale = torch.empty((1,1,1,1)).fill_(self.observation_sigma).expand_as(x).to(x.device)
-
-        per_slot_kls = list()
-        self.mus = list()
-        self.logvars = list()
-
-        log_masks = self.attention_network(x=x, logscope=log_scope)
+        # The scope recursion is sequential:
+        log_masks = list()
         for slot in range(self.nbr_attention_slot):
             if slot < self.nbr_attention_slot-1:
                 log_mask, log_scope = self.attention_network(x=x, logscope=log_scope)
             else:
                 log_mask = log_scope
+            log_masks.append(log_mask)
+        log_masks = torch.stack(log_masks, dim=1)
+        # batch_size x nbr_attention_slot x 1 x H x W
 
-            vae_in = torch.cat((x, log_mask), dim=1)
-            mu, logvar, cvae_out = self._forward(vae_in)
-            self.mus.append(mu)
-            self.logvars.append(logvar)
-
-            # Reconstructions Distributions:
-            x_rec, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=1)
-            #rec_dist = Normal(x_rec, scale)
-            if slot == 0:
-                rec_dist = torch.distributions.Normal(x_rec, 0.9*scale)
-            else:
-                rec_dist = torch.distributions.Normal(x_rec, scale)
-
-            logprobs[:, slot] = log_mask + rec_dist.log_prob(x)
-
-            # KL divergence with latent prior:
-            kl = -0.5 * (1 + logvar - mu.pow(2) - logvar.exp())
-            per_slot_kls.append(kl.unsqueeze(1))
-
-            mask_probs = torch.clamp_min(log_mask.exp(), min=1e-9)
-            
-            self.masks[:, slot] = mask_probs
-            self.reconstructions[:, slot] = x_rec
-            self.log_mask_reconstructions[:, slot] = log_mask_rec
-
-        per_slot_kls = torch.cat(per_slot_kls, dim=1)
+        # whereas the component VAE is run on all the slots at once:
+        logprobs, per_slot_kls = self._forward_slots(x=x, log_masks=log_masks)
         # batch_size x nbr_attention_slot x latent_dim
 
-        self.mu = torch.cat(self.mus, dim=-1)
-        self.logvar = torch.cat(self.logvars, dim=-1)
-        self.z = self.reparameterize(self.mu, self.logvar)
-
         setattr(self.encoder, 'attention_weights', self.masks.data)
         setattr(self.encoder, 'attention_reconstructions', self.reconstructions.data)
 
@@ -1397,60 +1521,8 @@ class MONet(BetaVAE):
         # batch_size, 1
 
         if self.use_compactness_constraint:
-            #
-            # Adapted from: 
-            # https://github.com/kanezaki/pytorch-unsupervised-segmentation/blob/master/demo.py
-            #
-            nx = x.cpu().numpy().astype('double')*255.
-            nx = nx.transpose((0, 2, 3, 1))
-            b_nx = [nx[i] for i in range(len(nx))]
-            b_labels = [segmentation.slic(nx, compactness=100.0, n_segments=10000) for nx in b_nx]
-            b_labels = [labels.reshape(self.input_shape[-1]**2) for labels in b_labels]#nx.shape[0]*nx.shape[1])
-            u_b_labels = [np.unique(labels) for labels in b_labels]
-            l_b_inds = []
-            for idx_u, u_labels in enumerate(u_b_labels):
-                l_inds = []
-                for i in range(len(u_labels)):
-                    l_inds.append( np.where( b_labels[idx_u] == u_b_labels[idx_u][ i ] )[ 0 ] )
-                l_b_inds.append(l_inds)
-
-            compactness_loss_fn = torch.nn.CrossEntropyLoss()
-
-            slot_logits_ppx = self.masks.permute(0, 3, 4, 1, 2).contiguous().view(batch_size, -1, self.nbr_attention_slot)
-            # batch x dim**2 x nbr_attention_slots
-            slot_probs_ppx = torch.softmax(slot_logits_ppx, dim=-1)
-            # batch x dim**2 x nbr_attention_slots
-            _, target = torch.max( slot_probs_ppx, -1 )
-            # batch x dim**2 x 1
-            im_target = target.data.cpu().numpy()
-            # batch x dim**2 x nbr_attention_slots
-
-            im_vis = target[0].data.cpu().numpy()
-            # dim**2 x 1
-            nLabels = len(np.unique(im_vis))
-            label_colours = np.random.randint(255,size=(100,3))
-            im_vis_rgb = np.array([label_colours[ c % 100 ] for c in im_vis])
-            im_vis_rgb = im_vis_rgb.reshape(*self.input_shape[-2:], 3).astype( np.uint8 )
-            im_input_rgb = nx[0].reshape(*self.input_shape[-2:], 3).astype( np.uint8 )
-            im_vis_rgb = np.concatenate([im_vis_rgb, im_input_rgb], axis=1)
-            cv2.imwrite( "./mrl_rep_labels.png", im_vis_rgb )
-
-            compactness_losses = []
-            for idx_b in range(len(b_nx)):
-                for i in range(len(l_inds)):
-                    labels_per_sp = im_target[idx_b][ l_b_inds[idx_b][i] ]
-                    u_labels_per_sp = np.unique( labels_per_sp )
-                    hist = np.zeros( len(u_labels_per_sp) )
-                    for j in range(len(hist)):
-                        hist[ j ] = len( np.where( labels_per_sp == u_labels_per_sp[ j ] )[ 0 ] )
-                    im_target[idx_b][l_b_inds[idx_b][i]] = u_labels_per_sp[ np.argmax( hist ) ]
-                target = torch.from_numpy(im_target[idx_b])
-                target = target.to(x.device)
-                compactness_losses.append(compactness_loss_fn(slot_logits_ppx[idx_b], target).sum().unsqueeze(0))
-            compactness_losses = torch.cat(compactness_losses, dim=0)
-            # batch x 1
-            #
-            #
+            compactness_losses = self._compactness_losses(x=x, superpixel_labels=superpixel_labels)
+            # batch
         else:
             compactness_losses = None
 
@@ -1458,7 +1530,8 @@ class MONet(BetaVAE):
 
     def compute_loss(self,
                      x=None,
-                     observation_sigma=None):
+                     observation_sigma=None,
+                     superpixel_labels=None):
         self.reconstructions, \
         self.mask_reconstructions, \
         self.neg_log_lik, \
@@ -1466,7 +1539,8 @@ class MONet(BetaVAE):
         self.mask_reconstruction_loss, \
         self.compactness_losses = self.forward(x=x,
                                               observation_sigma=observation_sigma,
-                                              compute_loss=True)
+                                              compute_loss=True,
+                                              superpixel_labels=superpixel_labels)
         
         #--------------------------------------------------------------------------------------------------------------
         # Reconstruction loss :
@@ -1501,7 +1575,7 @@ class MONet(BetaVAE):
         return self.MONet_loss, self.neg_log_lik, self.kl_divergence_regularized, self.true_kl_divergence
 
 
-class ParallelMONet(BetaVAE):
+class ParallelMONet(CompactnessConstraintMixin, SlotBatchedCVAEMixin, BetaVAE):
     def __init__(self,
                  gamma=0.5,
                  input_shape=[3, 64, 64], 
@@ -1520,7 +1594,9 @@ class ParallelMONet(BetaVAE):
                  cvae_nbrEpochTillMaxEncodingCapacity=4,
                  cvae_constrainedEncoding=True,
                  cvae_observation_sigma=0.05,
-                 compactness_factor=None):
+                 compactness_factor=None,
+                 compactness_visualization_path=None,
+                 compactness_visualization_period=1000):
         cvae_input_shape = copy.deepcopy(input_shape)
         cvae_input_shape[0] += 1
         super(ParallelMONet, self).__init__(beta=cvae_beta, 
@@ -1556,11 +1632,11 @@ class ParallelMONet(BetaVAE):
                                                           attention_block_depth=anet_block_depth)
 
 
-        self.compactness_factor = compactness_factor
-        if self.compactness_factor is not None:
-            self.use_compactness_constraint = True
-        else:
-            self.use_compactness_constraint = False
+        self._init_compactness_constraint(
+            compactness_factor=compactness_factor,
+            visualization_path=compactness_visualization_path,
+            visualization_period=compactness_visualization_period,
+        )
 
     def get_feature_shape(self):
         return self.latent_dim*self.nbr_attention_slot
@@ -1569,28 +1645,11 @@ class ParallelMONet(BetaVAE):
         self.forward(x) 
         return self.z, self.mu, self.logvar
 
-    def decode(self, z):
-        batch_size = z.size(0)
-        reconstructions = torch.empty(batch_size,
-                                      self.nbr_attention_slot,
-                                      *self.input_shape).to(z.device)
-        mask_reconstructions = torch.empty(batch_size, 
-                                           self.nbr_attention_slot, 
-                                           1,
-                                           *self.input_shape[-2:]).to(z.device)
-        for slot, slot_z in zip(range(self.nbr_attention_slot), torch.chunk(z, self.nbr_attention_slot, dim=1)):
-            cvae_out = self.decoder(slot_z)
-            x_rec, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=1)
-            reconstructions[:,slot] = x_rec
-            mask_reconstructions[:,slot] = torch.clamp_min(log_mask_rec.exp(), min=1e-9)
-
-        reconstructions = torch.sum( mask_reconstructions * reconstructions, dim=1)
-        return reconstructions
-
     def forward(self, 
                 x,
                 observation_sigma=None,
-                compute_loss=False):
+                compute_loss=False,
+                superpixel_labels=None):
         if observation_sigma is None:
             observation_sigma = self.observation_sigma
 
@@ -1599,58 +1658,11 @@ class ParallelMONet(BetaVAE):
         initial_scope = torch.zeros(1, 1, *self.input_shape[-2:])
         log_scope = initial_scope.repeat(batch_size, 1 ,1, 1).to(x.device)
 
-        logprobs = torch.empty(batch_size, 
-                               self.nbr_attention_slot, 
-                               *self.input_shape).to(x.device)
-        self.reconstructions = torch.empty_like(logprobs)
-        self.masks = torch.empty(batch_size, 
-                                 self.nbr_attention_slot, 
-                                 1,
-                                 *self.input_shape[-2:]).to(x.device)
-        self.log_mask_reconstructions = torch.empty_like(self.masks)
-
-        scale = torch.empty((1,1,1,1)).fill_(self.observation_sigma).expand_as(x).to(x.device)
-
-        per_slot_kls = list()
-        self.mus = list()
-        self.logvars = list()
-
         log_masks, log_scopes = self.attention_network(x=x, logscope=log_scope)
-        for slot in range(self.nbr_attention_slot):
-            log_mask = log_masks[:,slot:slot+1]
-
-            vae_in = torch.cat((x, log_mask), dim=1)
-            mu, logvar, cvae_out = self._forward(vae_in)
-            self.mus.append(mu)
-            self.logvars.append(logvar)
-
-            # Reconstructions Distributions:
-            x_rec, log_mask_rec = torch.split(cvae_out, self.input_shape[0], dim=1)
-            #rec_dist = Normal(x_rec, scale)
-            if slot == 0:
-                rec_dist = torch.distributions.Normal(x_rec, 0.9*scale)
-            else:
-                rec_dist = torch.distributions.Normal(x_rec, scale)
-
-            logprobs[:, slot] = log_mask + rec_dist.log_prob(x)
-
-            # KL divergence with latent prior:
-            kl = -0.5 * (1 + logvar - mu.pow(2) - logvar.exp())
-            per_slot_kls.append(kl.unsqueeze(1))
-
-            mask_probs = torch.clamp_min(log_mask.exp(), min=1e-9)
-            
-            self.masks[:, slot] = mask_probs
-            self.reconstructions[:, slot] = x_rec
-            self.log_mask_reconstructions[:, slot] = log_mask_rec
-
-        per_slot_kls = torch.cat(per_slot_kls, dim=1)
+        # batch_size x nbr_attention_slot x H x W
+        logprobs, per_slot_kls = self._forward_slots(x=x, log_masks=log_masks.unsqueeze(2))
         # batch_size x nbr_attention_slot x latent_dim
 
-        self.mu = torch.cat(self.mus, dim=-1)
-        self.logvar = torch.cat(self.logvars, dim=-1)
-        self.z = self.reparameterize(self.mu, self.logvar)
-
         setattr(self.encoder, 'attention_weights', self.masks.data)
         setattr(self.encoder, 'attention_reconstructions', self.reconstructions.data)
 
@@ -1681,60 +1693,8 @@ class ParallelMONet(BetaVAE):
         # batch_size, 1
 
         if self.use_compactness_constraint:
-            #
-            # Adapted from: 
-            # https://github.com/kanezaki/pytorch-unsupervised-segmentation/blob/master/demo.py
-            #
-            nx = x.cpu().numpy().astype('double')*255.
-            nx = nx.transpose((0, 2, 3, 1))
-            b_nx = [nx[i] for i in range(len(nx))]
-            b_labels = [segmentation.slic(nx, compactness=100.0, n_segments=10000) for nx in b_nx]
-            b_labels = [labels.reshape(self.input_shape[-1]**2) for labels in b_labels]#nx.shape[0]*nx.shape[1])
-            u_b_labels = [np.unique(labels) for labels in b_labels]
-            l_b_inds = []
-            for idx_u, u_labels in enumerate(u_b_labels):
-                l_inds = []
-                for i in range(len(u_labels)):
-                    l_inds.append( np.where( b_labels[idx_u] == u_b_labels[idx_u][ i ] )[ 0 ] )
-                l_b_inds.append(l_inds)
-
-            compactness_loss_fn = torch.nn.CrossEntropyLoss()
-
-            slot_logits_ppx = self.masks.permute(0, 3, 4, 1, 2).contiguous().view(batch_size, -1, self.nbr_attention_slot)
-            # batch x dim**2 x nbr_attention_slots
-            slot_probs_ppx = torch.softmax(slot_logits_ppx, dim=-1)
-            # batch x dim**2 x nbr_attention_slots
-            _, target = torch.max( slot_probs_ppx, -1 )
-            # batch x dim**2 x 1
-            im_target = target.data.cpu().numpy()
-            # batch x dim**2 x nbr_attention_slots
-
-            im_vis = target[0].data.cpu().numpy()
-            # dim**2 x 1
-            nLabels = len(np.unique(im_vis))
-            label_colours = np.random.randint(255,size=(100,3))
-            im_vis_rgb = np.array([label_colours[ c % 100 ] for c in im_vis])
-            im_vis_rgb = im_vis_rgb.reshape(*self.input_shape[-2:], 3).astype( np.uint8 )
-            im_input_rgb = nx[0].reshape(*self.input_shape[-2:], 3).astype( np.uint8 )
-            im_vis_rgb = np.concatenate([im_vis_rgb, im_input_rgb], axis=1)
-            cv2.imwrite( "./mrl_rep_parallel_labels.png", im_vis_rgb )
-
-            compactness_losses = []
-            for idx_b in range(len(b_nx)):
-                for i in range(len(l_inds)):
-                    labels_per_sp = im_target[idx_b][ l_b_inds[idx_b][i] ]
-                    u_labels_per_sp = np.unique( labels_per_sp )
-                    hist = np.zeros( len(u_labels_per_sp) )
-                    for j in range(len(hist)):
-                        hist[ j ] = len( np.where( labels_per_sp == u_labels_per_sp[ j ] )[ 0 ] )
-                    im_target[idx_b][l_b_inds[idx_b][i]] = u_labels_per_sp[ np.argmax( hist ) ]
-                target = torch.from_numpy(im_target[idx_b])
-                target = target.to(x.device)
-                compactness_losses.append(compactness_loss_fn(slot_logits_ppx[idx_b], target).sum().unsqueeze(0))
-            compactness_losses = torch.cat(compactness_losses, dim=0)
-            # batch x 1
-            #
-            #
+            compactness_losses = self._compactness_losses(x=x, superpixel_labels=superpixel_labels)
+            # batch
         else:
             compactness_losses = None
 
@@ -1742,7 +1702,8 @@ class ParallelMONet(BetaVAE):
 
     def compute_loss(self,
                      x=None,
-                     observation_sigma=None):
+                     observation_sigma=None,
+                     superpixel_labels=None):
         self.reconstructions, \
         self.mask_reconstructions, \
         self.neg_log_lik, \
@@ -1750,7 +1711,8 @@ class ParallelMONet(BetaVAE):
         self.mask_reconstruction_loss, \
         self.compactness_losses = self.forward(x=x,
                                               observation_sigma=observation_sigma,
-                                              compute_loss=True)
+                                              compute_loss=True,
+                                              superpixel_labels=superpixel_labels)
         
         #--------------------------------------------------------------------------------------------------------------
         # Reconstruction loss :
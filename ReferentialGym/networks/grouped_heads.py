@@ -0,0 +1,93 @@
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def head_signature(head:nn.Module):
+    '''
+    :returns: tuple describing the layers of :param head: if it is an nn.Sequential
+              of nn.Linear, nn.ReLU and nn.Dropout layers, otherwise None.
+    '''
+    if not isinstance(head, nn.Sequential):
+        return None
+    signature = []
+    for layer in head:
+        if isinstance(layer, nn.Linear):
+            signature.append(("linear", layer.in_features, layer.out_features, layer.bias is not None))
+        elif isinstance(layer, nn.ReLU):
+            signature.append(("relu",))
+        elif isinstance(layer, nn.Dropout):
+            signature.append(("dropout", layer.p))
+        else:
+            return None
+    return tuple(signature)
+
+
+def plan_grouped_heads(heads:List[nn.Module], input_shapes:List[torch.Size]) -> List[List[int]]:
+    '''
+    Groups the indices of the heads that share the same architecture and
+    whose inputs share the same shape, so that they can be evaluated together.
+    Heads with an unsupported architecture are put in their own group.
+
+    :param heads: List of nbr_heads heads, possibly with repetitions.
+    :param input_shapes: List of the nbr_heads shapes of the inputs of each head.
+    :returns: List of groups of head indices.
+    '''
+    groups = {}
+    for idx, (head, input_shape) in enumerate(zip(heads, input_shapes)):
+        signature = head_signature(head)
+        key = (signature, tuple(input_shape)) if signature is not None else ("unsupported", idx)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(idx)
+    return list(groups.values())
+
+
+def grouped_heads_forward(heads:List[nn.Module],
+                          inputs:List[torch.Tensor],
+                          plan:List[List[int]]=None) -> List[torch.Tensor]:
+    '''
+    Evaluates each head on its input, where each group of heads is evaluated
+    as a single batched linear layer per layer of the architecture:
+    the weights of the heads are stacked into a (nbr_heads, out, in) tensor
+    and applied with one batched matrix multiplication.
+
+    :param heads: List of nbr_heads heads, possibly with repetitions (e.g. shared head).
+    :param inputs: List of nbr_heads input tensors of shape (batch_size, in).
+    :param plan: List of groups of head indices, as output by `plan_grouped_heads`.
+    :returns: List of the nbr_heads output tensors.
+    '''
+    if plan is None:
+        plan = plan_grouped_heads(heads, [inp.shape for inp in inputs])
+
+    outputs = [None]*len(heads)
+    for group in plan:
+        if len(group) == 1:
+            outputs[group[0]] = heads[group[0]](inputs[group[0]])
+            continue
+
+        x = torch.stack([inputs[idx] for idx in group], dim=0)
+        # (nbr_heads, batch_size, in)
+        group_heads = [heads[idx] for idx in group]
+        for layers in zip(*group_heads):
+            layer = layers[0]
+            if isinstance(layer, nn.Linear):
+                weight = torch.stack([l.weight for l in layers], dim=0).transpose(1,2)
+                # (nbr_heads, in, out)
+                if layer.bias is not None:
+                    bias = torch.stack([l.bias for l in layers], dim=0).unsqueeze(1)
+                    # (nbr_heads, 1, out)
+                    x = torch.baddbmm(bias, x, weight)
+                else:
+                    x = torch.bmm(x, weight)
+            elif isinstance(layer, nn.ReLU):
+                x = F.relu(x)
+            elif isinstance(layer, nn.Dropout):
+                x = F.dropout(x, p=layer.p, training=layer.training)
+
+        for idx, out in zip(group, x.unbind(0)):
+            outputs[idx] = out
+
+    return outputs
@@ -1,15 +1,92 @@
+from typing import Dict, List
+
 import torch
 import torch.nn as nn
 
 
-class HomoscedasticMultiTasksLoss(nn.Module):
+def homoscedastic_weighting(losses:List[torch.Tensor], log_vars:torch.Tensor) -> List[torch.Tensor]:
+    '''
+    Weights each loss with its homoscedastic uncertainty: exp(-log_var)*loss+log_var.
+    If all the losses share the same shape, they are weighted in one broadcasted
+    operation over their stacked tensor of shape (nbr_tasks, batch_size, ...).
+
+    :param losses: List of nbr_tasks batched losses.
+    :param log_vars: Tensor of shape (nbr_tasks,) of the log variances of the corresponding tasks.
+    :returns: List of the nbr_tasks weighted losses.
+    '''
+    inv_uncertainty_sq = torch.exp(-log_vars)
+    # (nbr_tasks)
+    if all(l.shape == losses[0].shape for l in losses):
+        stacked_losses = torch.stack(losses, dim=0)
+        # (nbr_tasks, batch_size, ...)
+        broadcast_shape = (-1, *[1]*losses[0].dim())
+        weighted_losses = inv_uncertainty_sq.view(broadcast_shape)*stacked_losses+log_vars.view(broadcast_shape)
+        return list(weighted_losses.unbind(0))
+    return [ w*l+lv for w, l, lv in zip(inv_uncertainty_sq.unbind(0), losses, log_vars.unbind(0))]
+
+
+class HomoscedasticLogVarsMixin(object):
+    '''
+    Maintains a stable task-name-to-index mapping into `self.homoscedastic_log_vars`,
+    so that the learned log variances are kept, rather than reset, when new tasks appear.
+    The losses of a given task share their log variance across modes, i.e. the names
+    are stripped of their mode prefix, so that the parameter only grows with new tasks.
+    Whenever it grows, the `OptimizationModule` resets its optimizer state.
+    '''
+    def _init_log_vars(self, nbr_tasks):
+        self.nbr_tasks = nbr_tasks
+        self.homoscedastic_log_vars = torch.nn.Parameter(torch.zeros(self.nbr_tasks))
+        self.task_indices = {}
+        self.task_indices_cache = {}
+
+    def get_task_indices(self, task_names:List[str], mode:str=None) -> torch.Tensor:
+        key = (tuple(task_names), mode)
+        device = self.homoscedastic_log_vars.device
+        if key in self.task_indices_cache and self.task_indices_cache[key].device == device:
+            return self.task_indices_cache[key]
+
+        if mode is not None:
+            # e.g. 'train/VisualModule/VAE_loss' and 'test/VisualModule/VAE_loss' are the same task:
+            prefix = f"{mode}/"
+            task_names = [name[len(prefix):] if name.startswith(prefix) else name for name in task_names]
+
+        for name in task_names:
+            if name not in self.task_indices:
+                self.task_indices[name] = len(self.task_indices)
+        if len(self.task_indices) > self.nbr_tasks:
+            # Grow the log variances while preserving the learned ones:
+            nbr_new_tasks = len(self.task_indices)-self.nbr_tasks
+            self.nbr_tasks = len(self.task_indices)
+            self.homoscedastic_log_vars.data = torch.cat([
+                self.homoscedastic_log_vars.data,
+                torch.zeros(nbr_new_tasks).to(self.homoscedastic_log_vars.device),
+            ])
+
+        self.task_indices_cache[key] = torch.tensor([self.task_indices[name] for name in task_names], device=device)
+        return self.task_indices_cache[key]
+
+    def get_extra_state(self):
+        return {"task_indices":dict(self.task_indices)}
+
+    def set_extra_state(self, state):
+        self.task_indices = dict(state["task_indices"])
+        self.task_indices_cache = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix+"homoscedastic_log_vars"
+        if key in state_dict and state_dict[key].shape != self.homoscedastic_log_vars.shape:
+            self.nbr_tasks = state_dict[key].shape[0]
+            self.homoscedastic_log_vars.data = torch.zeros_like(state_dict[key]).to(self.homoscedastic_log_vars.device)
+        super(HomoscedasticLogVarsMixin, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class HomoscedasticMultiTasksLoss(HomoscedasticLogVarsMixin, nn.Module):
     def __init__(self, nbr_tasks=2, use_cuda=False):
         super(HomoscedasticMultiTasksLoss,self).__init__()
 
-        self.nbr_tasks = nbr_tasks
         self.use_cuda = use_cuda
-        self.homoscedastic_log_vars = torch.nn.Parameter(torch.zeros(self.nbr_tasks))
-        
+        self._init_log_vars(nbr_tasks)
+
         if use_cuda:
             self = self.cuda()
 
@@ -19,23 +96,13 @@ class HomoscedasticMultiTasksLoss(nn.Module):
                             with their pair of (linear coefficient, loss), where the loss
                             is in batched shape: (batch_size, 1)
         '''
-        nbr_tasks_ineffect = len(loss_dict)
-        k0 = list(loss_dict.keys())[0]
-        batch_size = loss_dict[k0][1].size()[0]
-
-        if nbr_tasks_ineffect > self.nbr_tasks:
-            self.nbr_tasks = nbr_tasks_ineffect
-            self.homoscedastic_log_vars.data = torch.zeros(self.nbr_tasks).to(self.homoscedastic_log_vars.device)
-
-        inv_uncertainty2 = torch.exp( -self.homoscedastic_log_vars[:self.nbr_tasks])
-        # (nbr_tasks)
-        # (batch_size, self.nbr_tasks)
-        batched_multiloss = {}
-        for idx_loss, (kn, l) in enumerate(loss_dict.items()):
-            batched_multiloss[kn] = inv_uncertainty2[idx_loss]*l[1]+self.homoscedastic_log_vars[idx_loss].repeat(l[1].shape[0])
-        
-        for kn in loss_dict:
-            loss_dict[kn].append( batched_multiloss[kn])
+        task_indices = self.get_task_indices(list(loss_dict.keys()))
+        log_vars = self.homoscedastic_log_vars[task_indices]
+        # (nbr_tasks_ineffect)
+
+        batched_multiloss = homoscedastic_weighting([l[1] for l in loss_dict.values()], log_vars)
+        for kn, wl in zip(loss_dict, batched_multiloss):
+            loss_dict[kn].append(wl)
 
         return loss_dict
-        
\ No newline at end of file
+
@@ -49,6 +49,27 @@ def handle_nan(layer, verbose=True):
             print("WARNING: NaN found in the GRADIENT of {} of {}.".format(name, layer))
         layer._parameters[name].grad.data[nan_indices] = 0
         
+def handle_nan_foreach(parameters, verbose=True):
+    """
+    Multi-tensor counterpart of `handle_nan`: zeroes the NaN entries of
+    the parameters and of their gradients, without walking the submodules.
+    A single multi-tensor norm pass, and host synchronization, detects the
+    tensors containing NaNs, which are the only ones to be sanitized.
+
+    :param parameters: List of torch.nn.Parameter.
+    """
+    tensors = [p.data for p in parameters]
+    tensors += [p.grad.data for p in parameters if p.grad is not None]
+    if len(tensors) == 0: return
+    # The norm of a tensor is NaN iff one of its entries is:
+    nan_flags = torch.isnan(torch.stack(torch._foreach_norm(tensors))).tolist()
+    if not any(nan_flags): return
+    if verbose:
+        print("WARNING: NaN found in the parameters or their GRADIENTS.")
+    for t, found_nan in zip(tensors, nan_flags):
+        if found_nan:
+            torch.nan_to_num_(t, nan=0.0, posinf=float("inf"), neginf=-float("inf"))
+        
 def layer_init(layer, w_scale=1.0):
     for name, param in layer._parameters.items():
         if param is None or param.data is None: continue
@@ -102,43 +123,42 @@ def layer_init(layer, w_scale=1.0):
     return layer
 
 
+def _xy_grids(sizeX, sizeY):
+    """
+    :returns: pair of tensors of shape (1, 1, sizeX, sizeY) containing the 
+              coordinates, in [-1,1], of the centers of the cells along X and Y.
+    """
+    vx = (torch.arange(sizeX, dtype=torch.float32)+0.5)*(2.0/sizeX)-1
+    vy = (torch.arange(sizeY, dtype=torch.float32)+0.5)*(2.0/sizeY)-1
+    fxy = vx.view(1,1,sizeX,1).expand(1,1,sizeX,sizeY)
+    fyx = vy.view(1,1,1,sizeY).expand(1,1,sizeX,sizeY)
+    return fxy, fyx
+
+
 class addXYfeatures(nn.Module) :
     def __init__(self) :
         super(addXYfeatures,self).__init__() 
-        self.fXY = None
+        # Non-persistent buffer, built once per spatial shape,
+        # that follows the module across devices:
+        self.register_buffer("fXY", None, persistent=False)
+        self.sizeX = None
+        self.sizeY = None
 
     def forward(self,x, outputFsizes=False) :
         xsize = x.size()
         batch = xsize[0]
-        if self.fXY is None:
+        if self.fXY is None or (self.sizeX, self.sizeY) != tuple(xsize[2:4]):
             # batch x depth x X x Y
-            depth = xsize[1]
             sizeX = xsize[2]
             sizeY = xsize[3]
-            stepX = 2.0/sizeX
-            stepY = 2.0/sizeY
-
-            fx = torch.zeros((1,1,sizeX,1))
-            fy = torch.zeros((1,1,1,sizeY))
-            
-            vx = -1+0.5*stepX
-            for i in range(sizeX):
-                fx[:,:,i,:] = vx 
-                vx += stepX
-            vy = -1+0.5*stepY
-            for i in range(sizeY):
-                fy[:,:,:,i] = vy 
-                vy += stepY
-            fxy = fx.repeat(1,1,1,sizeY)
-            fyx = fy.repeat(1,1,sizeX,1)
-            self.fXY = torch.cat( [fxy,fyx], dim=1)
+            fxy, fyx = _xy_grids(sizeX, sizeY)
+            self.fXY = torch.cat( [fxy,fyx], dim=1).to(device=x.device, dtype=x.dtype)
             self.sizeX = sizeX
             self.sizeY = sizeY
+        elif self.fXY.device != x.device or self.fXY.dtype != x.dtype:
+            self.fXY = self.fXY.to(device=x.device, dtype=x.dtype)
             
-        fXY = self.fXY.repeat(batch,1,1,1)
-        if x.is_cuda : fXY = fXY.cuda()
-            
-        out = torch.cat( [x,fXY], dim=1)
+        out = torch.cat( [x,self.fXY.expand(batch,-1,-1,-1)], dim=1)
 
         if outputFsizes:
             return out, self.sizeX, self.sizeY
@@ -148,52 +168,39 @@ class addXYfeatures(nn.Module) :
 class addXYRhoThetaFeatures(nn.Module) :
     def __init__(self) :
         super(addXYRhoThetaFeatures,self).__init__() 
-        self.fXYRhoTheta = None
+        # Non-persistent buffer, built once per spatial shape,
+        # that follows the module across devices:
+        self.register_buffer("fXYRhoTheta", None, persistent=False)
+        self.sizeX = None
+        self.sizeY = None
 
     def forward(self,x, outputFsizes=False) :
         xsize = x.size()
         batch = xsize[0]
-        if self.fXYRhoTheta is None:
+        if self.fXYRhoTheta is None or (self.sizeX, self.sizeY) != tuple(xsize[2:4]):
             # batch x depth x X x Y
-            depth = xsize[1]
             sizeX = xsize[2]
             sizeY = xsize[3]
-            stepX = 2.0/sizeX
-            stepY = 2.0/sizeY
 
             midX = sizeX/2
             midY = sizeY/2
             sizeRho = math.sqrt(midX**2+midY**2)
-            sizeTheta = 2*math.pi
-            stepX = 2.0/sizeX
-            stepY = 2.0/sizeY
-
-            fx = torch.zeros((1,1,sizeX,1))
-            fy = torch.zeros((1,1,1,sizeY))
             
-            vx = -1+0.5*stepX
-            for i in range(sizeX):
-                fx[:,:,i,:] = vx 
-                vx += stepX
-            vy = -1+0.5*stepY
-            for i in range(sizeY):
-                fy[:,:,:,i] = vy 
-                vy += stepY
-
-            fxy = fx.repeat(1,1,1,sizeY).transpose(-1,-2)
-            fyx = -fy.repeat(1,1,sizeX,1).transpose(-1,-2)
+            fx, fy = _xy_grids(sizeX, sizeY)
+            # (the grids are transposed, like in the original loop-based construction)
+            fxy = fx.transpose(-1,-2)
+            fyx = -fy.transpose(-1,-2)
             
             fRho = (fxy**2+fyx**2).sqrt()/sizeRho
             fTheta = torch.atan2(fyx, fxy)/math.pi
             
-            self.fXYRhoTheta = torch.cat( [fxy,fyx, fRho, fTheta], dim=1)
+            self.fXYRhoTheta = torch.cat( [fxy,fyx, fRho, fTheta], dim=1).to(device=x.device, dtype=x.dtype)
             self.sizeX = sizeX
             self.sizeY = sizeY
+        elif self.fXYRhoTheta.device != x.device or self.fXYRhoTheta.dtype != x.dtype:
+            self.fXYRhoTheta = self.fXYRhoTheta.to(device=x.device, dtype=x.dtype)
 
-        fXYRhoTheta = self.fXYRhoTheta.repeat(batch,1,1,1)
-        if x.is_cuda : fXYRhoTheta = fXYRhoTheta.cuda()
-            
-        out = torch.cat( [x,fXYRhoTheta], dim=1)
+        out = torch.cat( [x,self.fXYRhoTheta.expand(batch,-1,-1,-1)], dim=1)
 
         if outputFsizes:
             return out, self.sizeX, self.sizeY
@@ -930,11 +937,107 @@ class GRUBody(nn.Module):
         return self.feature_dim
 
 
+def entity_attention(query, 
+                     key, 
+                     value, 
+                     entity_mask=None, 
+                     attention_impl="matmul", 
+                     softmax_over_keys=False, 
+                     chunk_size=1024):
+    """
+    Scaled dot-product attention between entities.
+
+    :param query, key, value: Tensors of shape (batch, *, nbr_entities, interactions_dim),
+                              where * are optional extra dimensions, e.g. heads.
+    :param entity_mask: None or boolean Tensor of shape (batch, nbr_entities),
+                        where True identifies the valid (non-padding) entities.
+    :param attention_impl: str in ["matmul", "sdpa", "chunked"]:
+                           - "matmul": explicit attention matrix.
+                           - "sdpa": fused `F.scaled_dot_product_attention` kernel.
+                           - "chunked": memory-efficient evaluation by chunks of 
+                           `chunk_size` queries, which never materializes the full
+                           attention matrix.
+    :param softmax_over_keys: boolean defining whether the attention weights are normalized
+                              over the keys, like in standard attention, or over the queries
+                              (default), as it has always been done in `MHDPA`. 
+                              The "sdpa" implementation requires the former.
+    :returns: Tensor of shape (batch, *, nbr_entities, interactions_dim).
+    """
+    batch_size = query.shape[0]
+    nbr_entities = query.shape[-2]
+    scale = 1.0/math.sqrt(query.shape[-1])
+    
+    key_mask = None
+    query_mask = None
+    if entity_mask is not None:
+        extra_dims = [1]*(query.dim()-3)
+        key_mask = entity_mask.view(batch_size, *extra_dims, 1, nbr_entities)
+        query_mask = entity_mask.view(batch_size, *extra_dims, nbr_entities, 1)
+
+    if attention_impl == "sdpa":
+        assert softmax_over_keys, "The fused attention kernel normalizes over the keys."
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=key_mask)
+
+    if softmax_over_keys:
+        if attention_impl == "chunked":
+            return torch.cat([
+                F.scaled_dot_product_attention(query[...,start:start+chunk_size,:], key, value, attn_mask=key_mask)
+                for start in range(0, nbr_entities, chunk_size)
+            ], dim=-2)
+        att = torch.matmul(query, key.transpose(-2,-1))*scale
+        if key_mask is not None:
+            att = att.masked_fill(~key_mask, -float("inf"))
+        return torch.matmul(F.softmax(att, dim=-1), value)
+    
+    # Normalization over the queries:
+    if attention_impl == "chunked":
+        def chunk_att(start):
+            att = torch.matmul(query[...,start:start+chunk_size,:], key.transpose(-2,-1))*scale
+            if query_mask is not None:
+                att = att.masked_fill(~query_mask[...,start:start+chunk_size,:], -float("inf"))
+            return att
+        # First pass: log-normalizer of each key, over all the queries:
+        lse = None
+        for start in range(0, nbr_entities, chunk_size):
+            chunk_lse = torch.logsumexp(chunk_att(start), dim=-2, keepdim=True)
+            lse = chunk_lse if lse is None else torch.logaddexp(lse, chunk_lse)
+        # Second pass: normalized weights of each chunk of queries:
+        outputs = []
+        for start in range(0, nbr_entities, chunk_size):
+            weights = torch.exp(chunk_att(start)-lse)
+            if key_mask is not None:
+                weights = weights.masked_fill(~key_mask, 0.0)
+            outputs.append(torch.matmul(weights, value))
+        return torch.cat(outputs, dim=-2)
+
+    att = torch.matmul(query, key.transpose(-2,-1))*scale
+    if query_mask is not None:
+        att = att.masked_fill(~query_mask, -float("inf"))
+    weights = F.softmax(att, dim=-2)
+    if key_mask is not None:
+        weights = weights.masked_fill(~key_mask, 0.0)
+    return torch.matmul(weights, value)
+
+
 class MHDPA(nn.Module):
     def __init__(self,depth_dim=24+11+2,
                     interactions_dim=64, 
-                    hidden_size=256):
+                    hidden_size=256,
+                    attention_impl="matmul",
+                    softmax_over_keys=False,
+                    chunk_size=1024):
+        """
+        :param attention_impl: str in ["matmul", "sdpa", "chunked"], cf. `entity_attention`.
+        :param softmax_over_keys: boolean, cf. `entity_attention`.
+        :param chunk_size: Int, number of queries per chunk when `attention_impl=="chunked"`.
+        """
         super(MHDPA,self).__init__()
+        assert attention_impl != "sdpa" or softmax_over_keys,\
+               "MHDPA's 'sdpa' attention implementation requires softmax_over_keys=True."
+
+        self.attention_impl = attention_impl
+        self.softmax_over_keys = softmax_over_keys
+        self.chunk_size = chunk_size
 
         self.depth_dim = depth_dim
         self.interactions_dim = interactions_dim
@@ -988,8 +1091,9 @@ class MHDPA(nn.Module):
         return out 
     '''
 
-    def forward(self,x, usef=False):
+    def forward(self,x, usef=False, entity_mask=None):
         # input: b x d x f
+        # entity_mask: None or b x f boolean mask of the valid entities.
         batchsize = x.size()[0]
         depth_dim = x.size()[1]
         featuresize = x.size()[2]
@@ -1016,11 +1120,16 @@ class MHDPA(nn.Module):
         value = value.view((batchsize, featuresize, self.interactions_dim))
         # b x f x interactions_dim
         
-        att = torch.matmul(query, key.transpose(-2,-1) ) / math.sqrt(self.interactions_dim)
-        weights = F.softmax( att, dim=1 )
-        # b x f x i * b x i x f --> b x f x f
-        sdpa_out = torch.matmul( weights, value)
-        # b x f x f * b x f x i = b x f x i 
+        sdpa_out = entity_attention(
+            query, 
+            key, 
+            value, 
+            entity_mask=entity_mask, 
+            attention_impl=self.attention_impl,
+            softmax_over_keys=self.softmax_over_keys,
+            chunk_size=self.chunk_size,
+        )
+        # b x f x i 
         return sdpa_out 
     
     def save(self,path):
@@ -1047,7 +1156,15 @@ class MHDPA_RN(nn.Module):
                  interactions_dim=128,
                  output_dim=None,
                  dropout_prob=0.0,
-                 use_coord4=False):
+                 use_coord4=False,
+                 attention_impl="matmul",
+                 softmax_over_keys=False,
+                 chunk_size=1024):
+        """
+        :param attention_impl: str in ["matmul", "sdpa", "chunked"], cf. `entity_attention`.
+        :param softmax_over_keys: boolean, cf. `entity_attention`.
+        :param chunk_size: Int, number of queries per chunk when `attention_impl=="chunked"`.
+        """
         super(MHDPA_RN,self).__init__()
 
         self.nbrEntity = nbrEntity
@@ -1072,7 +1189,11 @@ class MHDPA_RN(nn.Module):
 
         self.MHDPAs = nn.ModuleList()
         for i in range(self.nbrHead):
-            self.MHDPAs.append(MHDPA(depth_dim=self.depth_dim,interactions_dim=self.interactions_dim))
+            self.MHDPAs.append(MHDPA(depth_dim=self.depth_dim,
+                                     interactions_dim=self.interactions_dim,
+                                     attention_impl=attention_impl,
+                                     softmax_over_keys=softmax_over_keys,
+                                     chunk_size=chunk_size))
 
         self.nonLinearModule = nn.LeakyReLU
         
@@ -1099,13 +1220,43 @@ class MHDPA_RN(nn.Module):
         # batch x f x i or batch x output_dim
         return output 
 
-    def forwardStackedMHDPA(self, augx):
+    def forwardFusedMHDPAheads(self, augx, entity_mask=None):
+        """
+        Evaluates all the heads at once: the query/key/value generators of every head 
+        are applied as a single linear layer, and the attention is batched over the heads.
+        
+        :param augx: Tensor of shape (batch x d x f).
+        :param entity_mask: None or boolean Tensor of shape (batch x f).
+        :returns: Tensor of shape (batch x f x nbr_head*interaction_dim).
+        """
+        batchsize, _, featuresize = augx.size()
+        weight = torch.cat([
+            torch.cat([mhdpa.queryGenerator.weight, mhdpa.keyGenerator.weight, mhdpa.valueGenerator.weight], dim=0)
+            for mhdpa in self.MHDPAs
+        ], dim=0)
+        # (nbr_head*3*interaction_dim x d)
+        qkv = F.linear(augx.transpose(1,2), weight)
+        qkv = qkv.view(batchsize, featuresize, self.nbrHead, 3, self.interactions_dim)
+        qkv = F.layer_norm(qkv, (self.interactions_dim,), eps=self.MHDPAs[0].queryGenerator_layerNorm.eps)
+        qkv = qkv.permute(3, 0, 2, 1, 4)
+        # 3 x batch x nbr_head x f x interaction_dim
+        
+        mhdpa = self.MHDPAs[0]
+        out = entity_attention(
+            qkv[0], 
+            qkv[1], 
+            qkv[2], 
+            entity_mask=entity_mask,
+            attention_impl=mhdpa.attention_impl,
+            softmax_over_keys=mhdpa.softmax_over_keys,
+            chunk_size=mhdpa.chunk_size,
+        )
+        # batch x nbr_head x f x interaction_dim
+        return out.transpose(1,2).reshape(batchsize, featuresize, -1)
+
+    def forwardStackedMHDPA(self, augx, entity_mask=None):
         # input: b x d x f
-        MHDPAouts = []
-        for i in range(self.nbrHead):
-            MHDPAouts.append( self.forwardScaledDPAhead(augx,head=i) )
-            # head x [ batch x f x i ]
-        concatOverHeads = torch.cat( MHDPAouts, dim=2)
+        concatOverHeads = self.forwardFusedMHDPAheads(augx, entity_mask=entity_mask)
         # (batch x f x nbr_head*interaction_dim)
         
         input4f = concatOverHeads.view((self.batchsize*self.featuresize, -1))
@@ -1122,7 +1273,11 @@ class MHDPA_RN(nn.Module):
         # (batch x depth_dim x f )
         return res_updated_entities
 
-    def forward(self, x=None, augx=None):
+    def forward(self, x=None, augx=None, entity_mask=None):
+        """
+        :param entity_mask: None or boolean Tensor of shape (batch x f),
+                            where True identifies the valid (non-padding) entities.
+        """
         if x is None:
             if augx is not None:
                 x = augx 
@@ -1145,7 +1300,7 @@ class MHDPA_RN(nn.Module):
         self.outputRec = [augx]
         for i in range(self.nbrRecurrentSharedLayers):
             # input/output: b x d x f
-            self.outputRec.append(self.forwardStackedMHDPA(self.outputRec[i]))
+            self.outputRec.append(self.forwardStackedMHDPA(self.outputRec[i], entity_mask=entity_mask))
         
         # Retrieve the (hopefully) converged representation:    
         intermediateOutput = self.outputRec[-1]
@@ -5,25 +5,38 @@ import random
 import time
 import pickle 
 import glob
+import contextlib
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
-from tensorboardX import SummaryWriter
 from tqdm import tqdm
 
 from .agents import Speaker, Listener, ObverterAgent
 from .networks import handle_nan, hasnan
 
-from .datasets import collate_dict_wrapper
-from .utils import cardinality, query_vae_latent_space
+from .datasets import collate_dict_wrapper, ResumableRandomSampler
+from .utils import cardinality, query_vae_latent_space, get_background_image_writer
 
 from .utils import StreamHandler
+from .utils import Checkpointer
+
+# `torch.inference_mode` is only available from torch 1.9:
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
 
 VERBOSE = False 
 
+# Types of the modules that only matter to training, and that lean evaluation passes skip:
+LEAN_EVALUATION_SKIPPED_MODULE_TYPES = [
+    "OptimizationModule",
+    "GradRecorderModule",
+    "HomoscedasticMultiTasksLossModule",
+    "VocabularyGroundingLossModule",
+]
+
 
 class ReferentialGame(object):
     def __init__(self, 
@@ -34,18 +47,26 @@ class ReferentialGame(object):
                  load_path=None, 
                  save_path=None,
                  verbose=False,
-                 save_epoch_interval=None):
+                 save_epoch_interval=None,
+                 save_step_interval=None):
         '''
-
+        :param save_epoch_interval: None or int defining the period, in epochs, with which to save the game.
+        :param save_step_interval: None or int defining the period, in training datasamples/batches, 
+                                   with which to save the game, so that preempted runs can resume mid-epoch.
         '''
         self.verbose = verbose
         self.save_epoch_interval = save_epoch_interval
+        self.save_step_interval = save_step_interval
 
         self.load_path= load_path
         self.save_path = save_path
 
         self.datasets = datasets
         self.config = config
+        self.checkpointer = Checkpointer(verbose=verbose)
+        # Everything else that is needed to resume the training loop exactly:
+        self.training_state = None
+        self.logger = None
         if load_path is not None:
             self.load_config(load_path)
         
@@ -53,8 +74,11 @@ class ReferentialGame(object):
         self.stream_handler.register("losses_dict")
         self.stream_handler.register("logs_dict")
         self.stream_handler.register("signals")
+        if self.config.get("profile_pipelines", False):
+            self.stream_handler.enable_profiling()
         if load_path is not None:
             self.load_signals(load_path)
+            self.load_training_state(load_path)
         
         # Register hyperparameters:
         for k,v in self.config.items():
@@ -71,7 +95,16 @@ class ReferentialGame(object):
         if load_path is not None:
             self.load_pipelines(load_path)
 
-    def save(self, path=None):
+    def save(self, path=None, blocking=False):
+        """
+        Snapshots the config, modules, pipelines and signals and hands them
+        to the background checkpointer, so that the disk I/O is kept off the
+        training loop. Modules that have not changed since their last
+        checkpoint are not written again.
+
+        :param path: str path of the folder where to save.
+        :param blocking: boolean defining whether to wait for the writes to be completed.
+        """
         if path is None:
             print("WARNING: no path provided for save. Saving in './temp_save/'.")
             path = './temp_save/'
@@ -82,47 +115,56 @@ class ReferentialGame(object):
         self.save_modules(path)
         self.save_pipelines(path)
         self.save_signals(path)
+        self.save_training_state(path)
+
+        if blocking:
+            self.checkpointer.flush()
 
         if self.verbose:
             print(f"Saving at {path}: OK.")
 
     def save_config(self, path):
         try:
-            with open(os.path.join(path, "config.conf"), 'wb') as f:
-                pickle.dump(self.config, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.checkpointer.save_object(self.config, os.path.join(path, "config.conf"))
         except Exception as e:
             print(f"Exception caught while trying to save config: {e}")
 
     def save_modules(self, path):
         for module_id, module in self.modules.items():
-            #try:
             if hasattr(module, "save"):
-                module.save(path=path)
+                module.save(path=path, checkpointer=self.checkpointer)
             else:
-                torch.save(module, os.path.join(path,module_id+".pth"))
-            #except Exception as e:
-            #    print(f"Exception caught will trying to save module {module_id}: {e}")
-                 
+                self.checkpointer.save_state_dict(
+                    module=module,
+                    filepath=os.path.join(path,module_id+".state_dict")
+                )
 
     def save_pipelines(self, path):
         try:
-            with open(os.path.join(path, "pipelines.pipe"), 'wb') as f:
-                pickle.dump(self.pipelines, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.checkpointer.save_object(self.pipelines, os.path.join(path, "pipelines.pipe"))
         except Exception as e:
             print(f"Exception caught while trying to save pipelines: {e}")
 
     def save_signals(self, path):
         try:
-            with open(os.path.join(path, "signals.conf"), 'wb') as f:
-                pickle.dump(self.stream_handler["signals"], f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.checkpointer.save_object(self.stream_handler["signals"], os.path.join(path, "signals.conf"))
         except Exception as e:
             print(f"Exception caught while trying to save signals: {e}")
 
+    def save_training_state(self, path):
+        if self.training_state is None:
+            return
+        try:
+            self.checkpointer.save_object(self.training_state, os.path.join(path, "training_state.conf"))
+        except Exception as e:
+            print(f"Exception caught while trying to save training state: {e}")
+
     def load(self, path):
         self.load_config(path)
         self.load_modules(path)
         self.load_pipelines(path)
         self.load_signals(path)
+        self.load_training_state(path)
 
         if self.verbose:
             print(f"Loading from {path}: OK.")
@@ -139,6 +181,7 @@ class ReferentialGame(object):
             print(f"Loading config: OK.")
 
     def load_modules(self, path):
+        # Legacy checkpoints of whole modules:
         modules_paths = glob.glob(os.path.join(path, "*.pth"))
         
         for module_path in modules_paths:
@@ -148,6 +191,17 @@ class ReferentialGame(object):
             except Exception as e:
                 print(f"Exception caught will trying to load module {module_path}: {e}")
         
+        for module_id, module in self.modules.items():
+            try:
+                if hasattr(module, "load"):
+                    module.load(path=path)
+                    continue
+                module_path = os.path.join(path, module_id+".state_dict")
+                if os.path.exists(module_path):
+                    module.load_state_dict(torch.load(module_path, map_location="cpu"))
+            except Exception as e:
+                print(f"Exception caught will trying to load module {module_id}: {e}")
+
         if self.verbose:
             print(f"Loading modules: OK.")
     
@@ -171,9 +225,84 @@ class ReferentialGame(object):
         if self.verbose:
             print(f"Loading signals: OK.")
 
-    def train(self, nbr_epoch: int = 10, logger: SummaryWriter = None, verbose_period=None):
-        '''
+    def load_training_state(self, path):
+        training_state_path = os.path.join(path, "training_state.conf")
+        if not os.path.exists(training_state_path):
+            return
+        try:
+            with open(training_state_path, 'rb') as f:
+                self.training_state = pickle.load(f)
+        except Exception as e:
+            print(f"Exception caught while trying to load training state: {e}")
 
+        if self.verbose:
+            print(f"Loading training state: OK.")
+
+    def _get_rng_states(self):
+        rng_states = {
+            "python":random.getstate(),
+            "numpy":np.random.get_state(),
+            "torch":torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_states["torch_cuda"] = torch.cuda.get_rng_state_all()
+        return rng_states
+
+    def _set_rng_states(self, rng_states):
+        random.setstate(rng_states["python"])
+        np.random.set_state(rng_states["numpy"])
+        torch.set_rng_state(rng_states["torch"])
+        if "torch_cuda" in rng_states and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_states["torch_cuda"])
+
+    def _update_training_state(self, 
+                               epoch, 
+                               it_dataset, 
+                               nbr_consumed_batches, 
+                               windowed_accuracy=0.0, 
+                               window_count=0):
+        '''
+        Records the position of the training loop, i.e. the next batch to be sampled,
+        along with the RNG states and curriculum/logger counters at that point.
+        '''
+        logger = self.logger
+        self.training_state = {
+            "epoch":epoch,
+            "it_dataset":it_dataset,
+            "nbr_consumed_batches":nbr_consumed_batches,
+            "sampler_seed":self.sampler_seed,
+            "rng_states":self._get_rng_states(),
+            "nbr_distractors":{
+                mode:copy.deepcopy(dataset.nbr_distractors) 
+                for mode, dataset in self.datasets.items()
+                if hasattr(dataset, "nbr_distractors")
+            },
+            "windowed_accuracy":windowed_accuracy,
+            "window_count":window_count,
+            "logger":logger.state_dict() if hasattr(logger, "state_dict") else None,
+        }
+
+    def _get_lean_pipelines(self):
+        '''
+        :returns: Dict of the pipelines without the modules whose type is in 
+                  `config["lean_evaluation_skipped_module_types"]` 
+                  (default: `LEAN_EVALUATION_SKIPPED_MODULE_TYPES`).
+        '''
+        skipped_types = self.config.get("lean_evaluation_skipped_module_types", LEAN_EVALUATION_SKIPPED_MODULE_TYPES)
+        lean_pipelines = {}
+        for pipe_id, pipeline in self.pipelines.items():
+            lean_pipelines[pipe_id] = [
+                module_id for module_id in pipeline
+                if getattr(self.stream_handler[f"modules:{module_id}:ref"], "type", None) not in skipped_types
+            ]
+        return lean_pipelines
+
+    def train(self, nbr_epoch: int = 10, logger: 'SummaryWriter' = None, verbose_period=None):
+        '''
+        If `config["lean_evaluation"]` is True, the non-training modes are run through a lean path:
+        under `torch.inference_mode` (`torch.no_grad` on torch<1.9), without the training-only modules (e.g. optimization, 
+        gradient recorder), the training-only and logging hooks of the agents (unless requested
+        in `config["lean_evaluation_hooks"]`), and the per-step work that only matters to training.
         '''
         # Dataset:
         if 'batch_size' not in self.config:
@@ -183,12 +312,29 @@ class ReferentialGame(object):
 
         print("Create dataloader: ...")
         
+        training_state = self.training_state
+        # The loaded training state is only resumed from once,
+        # further calls to `train` start afresh:
+        self.training_state = None
+        if training_state is not None:
+            self.sampler_seed = training_state["sampler_seed"]
+        elif "seed" in self.config:
+            self.sampler_seed = self.config["seed"]
+        else:
+            self.sampler_seed = int(torch.randint(0, 2**31-1, size=(1,)).item())
+
+        # The samplers and the loaders' generators are independent from the global RNGs,
+        # so that the data order only depends on the seed, the epoch, and the position in the epoch:
+        samplers = {mode:ResumableRandomSampler(dataset, seed=self.sampler_seed)
+                    for mode, dataset in self.datasets.items()
+                    }
         data_loaders = {mode:torch.utils.data.DataLoader(dataset,
                                                             batch_size=self.config['batch_size'],
-                                                            shuffle=True,
+                                                            sampler=samplers[mode],
                                                             collate_fn=collate_dict_wrapper,
                                                             pin_memory=True,
-                                                            num_workers=self.config['dataloader_num_worker'])
+                                                            num_workers=self.config['dataloader_num_worker'],
+                                                            generator=torch.Generator().manual_seed(self.sampler_seed))
                         for mode, dataset in self.datasets.items()
                         }
         
@@ -206,20 +352,37 @@ class ReferentialGame(object):
         init_curriculum_nbr_distractors = self.stream_handler["signals:curriculum_nbr_distractors"]
         if init_curriculum_nbr_distractors is None:
             init_curriculum_nbr_distractors = 1
+        windowed_accuracy = 0.0
+        window_count = 0
         if 'use_curriculum_nbr_distractors' in self.config\
             and self.config['use_curriculum_nbr_distractors']:
-            windowed_accuracy = 0.0
-            window_count = 0
             for mode in self.datasets:
                 self.datasets[mode].setNbrDistractors(init_curriculum_nbr_distractors,mode=mode)
             
         pbar = tqdm(total=nbr_epoch)
+        self.logger = logger
         if logger is not None:
             self.stream_handler.update("modules:logger:ref", logger)
         
         self.stream_handler.update("signals:use_cuda", self.config['use_cuda'])
         
         init_epoch = self.stream_handler["signals:epoch"]
+        init_it_dataset = 0
+        init_nbr_consumed_batches = 0
+        if training_state is not None:
+            # Resuming exactly where the training loop was interrupted:
+            init_epoch = training_state["epoch"]
+            init_it_dataset = training_state["it_dataset"]
+            init_nbr_consumed_batches = training_state["nbr_consumed_batches"]
+            windowed_accuracy = training_state["windowed_accuracy"]
+            window_count = training_state["window_count"]
+            for mode, nbr_distractors in training_state["nbr_distractors"].items():
+                if mode in self.datasets:
+                    self.datasets[mode].nbr_distractors = nbr_distractors
+            if logger is not None and training_state["logger"] is not None:
+                logger.load_state_dict(training_state["logger"])
+            self._set_rng_states(training_state["rng_states"])
+        
         if init_epoch is None: 
             init_epoch = 0
         else:
@@ -229,8 +392,24 @@ class ReferentialGame(object):
             self.stream_handler.update("signals:epoch", epoch)
             pbar.update(1)
             for it_dataset, (mode, data_loader) in enumerate(data_loaders.items()):
+                start_idx_stimulus = 0
+                if epoch == init_epoch:
+                    if it_dataset < init_it_dataset:
+                        continue
+                    if it_dataset == init_it_dataset:
+                        start_idx_stimulus = init_nbr_consumed_batches
+                samplers[mode].set_epoch(epoch)
+                samplers[mode].set_start_index(start_idx_stimulus*self.config['batch_size'])
+                nbr_batches = start_idx_stimulus+len(data_loader)
+
                 self.stream_handler.update("current_dataset:ref", self.datasets[mode])
                 self.stream_handler.update("signals:mode", mode)
+
+                lean_evaluation = self.config.get("lean_evaluation", False) and 'train' not in mode
+                self.stream_handler.update("signals:lean_evaluation", lean_evaluation)
+                pipelines = self._get_lean_pipelines() if lean_evaluation else self.pipelines
+                # Grad mode is left untouched outside of the lean evaluation (no-op context):
+                lean_context = inference_mode if lean_evaluation else contextlib.ExitStack
                 
                 end_of_epoch_dataset = (it_dataset==len(data_loaders)-1)
                 self.stream_handler.update("signals:end_of_epoch_dataset", end_of_epoch_dataset)
@@ -240,8 +419,8 @@ class ReferentialGame(object):
                     and 'train' in mode:
                     nbr_experience_repetition = self.config['nbr_experience_repetition']
 
-                for idx_stimulus, sample in enumerate(data_loader):
-                    end_of_dataset = (idx_stimulus==len(data_loader)-1)
+                for idx_stimulus, sample in enumerate(data_loader, start=start_idx_stimulus):
+                    end_of_dataset = (idx_stimulus==nbr_batches-1)
                     self.stream_handler.update("signals:end_of_dataset", end_of_dataset)
                     it_datasamples[mode] += 1
                     it_datasample = it_datasamples[mode]
@@ -285,28 +464,32 @@ class ReferentialGame(object):
                             self.stream_handler.update("signals:multi_round", multi_round)
                             self.stream_handler.update('current_dataloader:sample', sample)
 
-                            for pipe_id, pipeline in self.pipelines.items():
-                                if "referential_game" in pipe_id: 
-                                    self.stream_handler.serve(pipeline)
+                            with lean_context():
+                                for pipe_id, pipeline in pipelines.items():
+                                    if "referential_game" in pipe_id: 
+                                        self.stream_handler.serve(pipeline, pipeline_id=pipe_id)
 
                         # //------------------------------------------------------------//
                         # //------------------------------------------------------------//
                         # //------------------------------------------------------------//
                         
-                        for pipe_id, pipeline in self.pipelines.items():
-                            if "referential_game" not in pipe_id:
-                                self.stream_handler.serve(pipeline)
+                        with lean_context():
+                            for pipe_id, pipeline in pipelines.items():
+                                if "referential_game" not in pipe_id:
+                                    self.stream_handler.serve(pipeline, pipeline_id=pipe_id)
                         
                         
-                        losses = self.stream_handler["losses_dict"]
-                        loss = sum( [l[-1] for l in losses.values()])
-                        logs_dict = self.stream_handler["logs_dict"]
-                        acc_keys = [k for k in logs_dict.keys() if '/referential_game_accuracy' in k]
-                        if len(acc_keys):
-                            acc = logs_dict[acc_keys[-1]].mean()
-
-                        if verbose_period is not None and idx_stimulus % verbose_period == 0:
-                            descr = 'Epoch {} :: {} Iteration {}/{} :: Loss {} = {}'.format(epoch+1, mode, idx_stimulus+1, len(data_loader), it+1, loss.item())
+                        if not lean_evaluation:
+                            losses = self.stream_handler["losses_dict"]
+                            loss = sum( [l[-1] for l in losses.values()])
+                            logs_dict = self.stream_handler["logs_dict"]
+                            acc_keys = [k for k in logs_dict.keys() if '/referential_game_accuracy' in k]
+                            if len(acc_keys):
+                                acc = logs_dict[acc_keys[-1]].mean()
+
+                        if not lean_evaluation\
+                            and verbose_period is not None and idx_stimulus % verbose_period == 0:
+                            descr = 'Epoch {} :: {} Iteration {}/{} :: Loss {} = {}'.format(epoch+1, mode, idx_stimulus+1, nbr_batches, it+1, loss.item())
                             pbar.set_description_str(descr)
                         
                         self.stream_handler.reset("losses_dict")
@@ -328,7 +511,8 @@ class ReferentialGame(object):
                         # //------------------------------------------------------------//
                         
                         # TODO: CURRICULUM ON DISTRATORS as a module that handles the current dataloader reference....!!
-                        if 'use_curriculum_nbr_distractors' in self.config\
+                        if not lean_evaluation\
+                            and 'use_curriculum_nbr_distractors' in self.config\
                             and self.config['use_curriculum_nbr_distractors']:
                             nbr_distractors = self.datasets[mode].getNbrDistractors(mode=mode)
                             self.stream_handler.update("signals:curriculum_nbr_distractors", nbr_distractors)
@@ -337,7 +521,8 @@ class ReferentialGame(object):
                         
                         
                         # TODO: make this a logger module:
-                        if 'current_speaker' in self.modules and 'current_listener' in self.modules:
+                        if not lean_evaluation\
+                            and 'current_speaker' in self.modules and 'current_listener' in self.modules:
                             prototype_speaker = self.stream_handler["modules:current_speaker:ref_agent"]
                             prototype_listener = self.stream_handler["modules:current_listener:ref_agent"]
                             image_save_path = logger.path 
@@ -349,7 +534,9 @@ class ReferentialGame(object):
                                                        full=('test' in mode),
                                                        idxoffset=it_rep+idx_stimulus*self.config['nbr_experience_repetition'],
                                                        suffix='speaker',
-                                                       use_cuda=True)
+                                                       use_cuda=True,
+                                                       logger=logger,
+                                                       global_step=it_step)
                                 
                             if prototype_listener is not None and hasattr(prototype_listener,'VAE') and idx_stimulus % 4 == 0:
                                 query_vae_latent_space(prototype_listener.VAE, 
@@ -358,7 +545,9 @@ class ReferentialGame(object):
                                                        test=('test' in mode),
                                                        full=('test' in mode),
                                                        idxoffset=idx_stimulus,
-                                                       suffix='listener')
+                                                       suffix='listener',
+                                                       logger=logger,
+                                                       global_step=it_step)
                                 
                     # //------------------------------------------------------------//
                     # //------------------------------------------------------------//
@@ -375,8 +564,20 @@ class ReferentialGame(object):
                         if windowed_accuracy > 75 and window_count > self.config['curriculum_distractors_window_size'] and nbr_distractors < self.config['nbr_distractors'][mode]:
                             windowed_accuracy = 0
                             window_count = 0
-                            for mode in self.datasets:
-                                self.datasets[mode].setNbrDistractors(self.datasets[mode].getNbrDistractors(mode=mode)+1, mode=mode)
+                            for dmode in self.datasets:
+                                self.datasets[dmode].setNbrDistractors(self.datasets[dmode].getNbrDistractors(mode=dmode)+1, mode=dmode)
+                    
+                    if 'train' in mode\
+                        and self.save_step_interval is not None\
+                        and it_datasample % self.save_step_interval == 0:
+                        self._update_training_state(
+                            epoch=epoch,
+                            it_dataset=it_dataset,
+                            nbr_consumed_batches=idx_stimulus+1,
+                            windowed_accuracy=windowed_accuracy,
+                            window_count=window_count,
+                        )
+                        self.save(path=self.save_path)
                     # //------------------------------------------------------------//
 
                 if logger is not None:
@@ -385,8 +586,23 @@ class ReferentialGame(object):
                 # //------------------------------------------------------------//
                 # //------------------------------------------------------------//
                 # //------------------------------------------------------------//
+            profiler = self.stream_handler.profiler
+            if profiler is not None:
+                if logger is not None:
+                    profiler.log(logger, step=epoch)
+                trace_path = self.save_path if self.save_path is not None else getattr(logger, "path", "./")
+                profiler.dump_chrome_trace(os.path.join(trace_path, "profiling", f"trace_epoch{epoch}.json"))
+                profiler.reset()
+
             if self.save_epoch_interval is not None\
              and epoch % self.save_epoch_interval == 0:
+                self._update_training_state(
+                    epoch=epoch+1,
+                    it_dataset=0,
+                    nbr_consumed_batches=0,
+                    windowed_accuracy=windowed_accuracy,
+                    window_count=window_count,
+                )
                 self.save(path=self.save_path)
 
             # //------------------------------------------------------------//
@@ -397,6 +613,10 @@ class ReferentialGame(object):
         # //------------------------------------------------------------//
         # //------------------------------------------------------------// 
         
+        # Make sure that every checkpoint and visualization has reached the disk:
+        self.checkpointer.flush()
+        get_background_image_writer().flush()
+
         return
 
 
@@ -0,0 +1,83 @@
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import torch
+import ReferentialGym as RG
+
+from toy_agents import ToySpeaker, ToyListener, obs_shape, vocab_size, max_sentence_length
+
+def test_inference_server():
+    torch.manual_seed(0)
+    speaker, listener = ToySpeaker(), ToyListener()
+    path = tempfile.mkdtemp()+"/"
+    checkpointer = RG.utils.Checkpointer()
+    speaker.save(path, checkpointer=checkpointer)
+    checkpointer.flush()
+    torch.save(listener, path+"l0.agent")
+
+    # Fresh instances are loaded from the saved modules:
+    server = RG.utils.InferenceServer.from_saved(path, speaker=ToySpeaker(), listener_id="l0", max_batch_size=16, max_latency=0.05)
+    speaker.eval()
+    listener.eval()
+
+    experiences = [torch.rand(n, *obs_shape) for n in [1, 3, 2, 4]]
+    futures = [None]*len(experiences)
+    def describe(idx):
+        futures[idx] = server.describe(experiences[idx])
+    threads = [threading.Thread(target=describe, args=(idx,)) for idx in range(len(experiences))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    for exp, future in zip(experiences, futures):
+        outputs = future.result(timeout=10)
+        with torch.no_grad():
+            expected = speaker(experiences=exp)
+        assert(outputs["sentences_widx"].shape == (exp.shape[0], max_sentence_length, 1))
+        assert(torch.equal(outputs["sentences_widx"], expected["sentences_widx"]))
+        assert(len(outputs["sentences_logits"]) == exp.shape[0])
+
+        decision = server.decide(exp, outputs["sentences_one_hot"]).result(timeout=10)["decision"]
+        with torch.no_grad():
+            expected_decision = listener(sentences=expected["sentences_one_hot"], experiences=exp)["decision"]
+        assert(torch.allclose(decision, expected_decision, atol=1e-6))
+
+    server.close()
+
+def test_inference_server_malformed_requests():
+    speaker, listener = ToySpeaker(), ToyListener()
+    server = RG.utils.InferenceServer(speaker=speaker, listener=listener, max_latency=0.01)
+
+    for experiences, sentences in [
+        (torch.tensor(1.0), None),
+        (torch.rand(2, *obs_shape), torch.rand(3, max_sentence_length, vocab_size)),
+        (torch.rand(2, *obs_shape), torch.rand(2)),
+    ]:
+        try:
+            if sentences is None:
+                server.describe(experiences)
+            else:
+                server.decide(experiences, sentences)
+            assert(False)
+        except ValueError:
+            pass
+
+    # Requests that bypass the validation only fail on their own:
+    bad_future = Future()
+    server.queue.put(("speaker", torch.tensor(1.0), None, bad_future))
+    try:
+        bad_future.result(timeout=10)
+        assert(False)
+    except IndexError:
+        pass
+    assert(server.thread.is_alive())
+
+    experiences = torch.rand(3, *obs_shape)
+    outputs = server.describe(experiences).result(timeout=10)
+    assert(outputs["sentences_widx"].shape == (3, max_sentence_length, 1))
+    server.close()
+
+
+if __name__ == "__main__":
+    test_inference_server()
+    test_inference_server_malformed_requests()
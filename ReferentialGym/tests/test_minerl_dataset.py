@@ -0,0 +1,50 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+import cv2
+import ReferentialGym as RG
+
+def make_trajectory(traj_dir, traj_len, nbr_leading_frames=2, img_size=16):
+    '''
+    Writes a synthetic trajectory, laid out as MineRL's data, whose i-th state
+    is a uniform frame of intensity 10*i, preceded by :param nbr_leading_frames: frames.
+    '''
+    os.makedirs(traj_dir, exist_ok=True)
+    nbr_frames = nbr_leading_frames+traj_len+1
+    writer = cv2.VideoWriter(os.path.join(traj_dir, 'recording.mp4'), cv2.VideoWriter_fourcc(*'mp4v'), 20, (img_size, img_size))
+    for frame_idx in range(nbr_frames):
+        writer.write(np.full((img_size, img_size, 3), 10*(frame_idx-nbr_leading_frames)%250, dtype=np.uint8))
+    writer.release()
+    np.savez(os.path.join(traj_dir, 'rendered.npz'), reward=np.zeros(traj_len))
+    with open(os.path.join(traj_dir, 'metadata.json'), 'w') as f:
+        json.dump({'true_video_frame_count':nbr_frames}, f)
+
+def test_minerl_dataset():
+    root = tempfile.mkdtemp()
+    exp = 'MineRLTreechop-v0'
+    for idx in range(4):
+        make_trajectory(os.path.join(root, exp, f'traj{idx}'), traj_len=12+idx)
+
+    kwargs = {'nbr_distractors':{'train':1, 'test':1}, 'nbr_stimulus':1}
+    dataset = RG.datasets.MineRLDataset(kwargs=kwargs, root=root, train=True, experiments=[exp], skip_interval=4, window_cache_size=2)
+    # Training trajectories are the odd ones: traj1 (13 states) and traj3 (15 states).
+    assert(dataset.getNbrClasses() == 2)
+    assert(len(dataset) == 3+3)
+
+    for idx in range(len(dataset)):
+        idx_in_exptraj, exptraj = dataset.dataset[idx]
+        imgs = dataset._decode_window(exptraj, idx_in_exptraj)
+        assert(len(imgs) == 4)
+        expected = 10*np.arange(idx_in_exptraj*4, (idx_in_exptraj+1)*4)
+        # The codec is lossy:
+        assert(np.abs(np.array([img.mean() for img in imgs])-expected).max() < 4)
+        assert(len(dataset.window_cache) <= 2)
+
+    img, target = dataset._get(0)
+    assert(img.size == (16, 16) and target == dataset.exptraj2int[dataset.dataset[0][1]])
+
+
+if __name__ == "__main__":
+    test_minerl_dataset()
@@ -0,0 +1,29 @@
+import time
+
+from ReferentialGym.modules import ObverterDatasamplingModule
+
+class ToyDataset(object):
+    def __init__(self):
+        self.mode = "train"
+        self.nbr_distractors = {"train":1, "test":1}
+
+def test_obverter_prefetch_nbr_distractors_change():
+    module = ObverterDatasamplingModule(id="obverter_sampling", config={"batch_size":4, "prefetch_size":2})
+    # Each batch records the number of distractors it has been sampled with:
+    module._make_batch = lambda dataset, *rngs: dataset.nbr_distractors[dataset.mode]
+    dataset = ToyDataset()
+
+    assert(module._get_prefetched_batch(dataset) == 1)
+    # Let the producer fill the queue with batches sampled with the previous value:
+    while not module.prefetch_queue.full():
+        time.sleep(0.01)
+    dataset.nbr_distractors["train"] = 3
+    for _ in range(2*module.prefetch_size):
+        assert(module._get_prefetched_batch(dataset) == 3)
+
+    module._stop_producer()
+    assert(module.producer is None)
+
+
+if __name__ == "__main__":
+    test_obverter_prefetch_nbr_distractors_change()
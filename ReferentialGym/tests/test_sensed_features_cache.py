@@ -0,0 +1,40 @@
+import torch
+
+from toy_agents import ToySpeaker, obs_shape
+
+def test_sensed_features_cache():
+    speaker = ToySpeaker()
+    speaker.eval()
+    experiences = torch.rand(4, *obs_shape)
+
+    # Communication rounds of the same dialogue reuse the features:
+    speaker(experiences=experiences, sentences=None, multi_round=True)
+    speaker(experiences=experiences, sentences=None, multi_round=True)
+    assert(speaker.nbr_sense_calls == 1)
+    assert(speaker.sensed_features is not None)
+
+    # In-place modifications of the experiences invalidate them:
+    experiences.mul_(0.5)
+    speaker(experiences=experiences, sentences=None, multi_round=True)
+    assert(speaker.nbr_sense_calls == 2)
+
+    # The end of the dialogue clears them, along with the recurrent states:
+    speaker(experiences=experiences, sentences=None, multi_round=False)
+    assert(speaker.nbr_sense_calls == 2)
+    assert(speaker.sensed_features is None)
+    speaker(experiences=experiences, sentences=None, multi_round=True)
+    assert(speaker.nbr_sense_calls == 3)
+    speaker._reset_rnn_states()
+    assert(speaker.sensed_features is None)
+
+    # Inference tensors are not cached:
+    with torch.inference_mode():
+        inference_experiences = torch.rand(4, *obs_shape)
+        speaker(experiences=inference_experiences, sentences=None, multi_round=True)
+        speaker(experiences=inference_experiences, sentences=None, multi_round=True)
+    assert(speaker.nbr_sense_calls == 5)
+    assert(speaker.sensed_features is None)
+
+
+if __name__ == "__main__":
+    test_sensed_features_cache()
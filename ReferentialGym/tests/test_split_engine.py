@@ -0,0 +1,165 @@
+import tempfile
+
+import numpy as np
+from ReferentialGym.datasets.split_engine import combinatorial_split_indices, cached_split
+
+def reference_single_object_split(latents_classes, latent_dims, counter_test_threshold, train):
+    '''
+    Per-index loop of the 3DShapesPyBullet dataset, prior to the split engine.
+    '''
+    indices = []
+    test_latents_mask = np.zeros_like(latents_classes)
+    for idx, latent_class in enumerate(latents_classes):
+        effective_test_threshold = counter_test_threshold
+        counter_test = {}
+        skip_it = False
+        for dim_name, dim_dict in latent_dims.items():
+            dim_class = latent_class[dim_dict['position']]
+            quotient = (dim_class+1)//dim_dict['divider']
+            remainder = (dim_class+1)%dim_dict['divider']
+            if remainder!=dim_dict['remainder_use']:
+                skip_it = True
+                break
+
+            if dim_dict['primitive']:
+                ordinal = quotient
+                if ordinal > dim_dict['nbr_fillers']:
+                    effective_test_threshold -= 1
+
+            if 'test_set_divider' in dim_dict and quotient%dim_dict['test_set_divider']==0:
+                counter_test[dim_name] = 1
+            elif 'test_set_size_sample_from_end' in dim_dict:
+                max_quotient = dim_dict['size']//dim_dict['divider']
+                if quotient > max_quotient-dim_dict['test_set_size_sample_from_end']:
+                    counter_test[dim_name] = 1
+            elif 'test_set_size_sample_from_start' in dim_dict:
+                if quotient <= dim_dict['test_set_size_sample_from_start']:
+                    counter_test[dim_name] = 1
+
+            if dim_name in counter_test:
+                test_latents_mask[idx, dim_dict['position']] = 1
+
+        if skip_it: continue
+        if (len(counter_test) >= effective_test_threshold) != train:
+            indices.append(idx)
+    return indices, test_latents_mask
+
+def reference_multi_object_split(latents_classes, latent_dims, counter_test_threshold, train, nb_objects):
+    '''
+    Per-index loop of the SpatialQueriesOnObjectTuples dataset, prior to the split engine.
+    '''
+    indices = []
+    for idx, lc in enumerate(latents_classes):
+        latent_class = lc.reshape((nb_objects,-1)).astype(int)
+        # (nb_objects, nbr_latent_dims)
+        effective_test_threshold = counter_test_threshold
+        counter_test = np.zeros((nb_objects,1))
+        # (nb_objects, 1)
+        skip_it = False
+        for dim_name, dim_dict in latent_dims.items():
+            dim_class = latent_class[:,dim_dict['position']]
+            quotient = (dim_class+1)//dim_dict['divider']
+            remainder = (dim_class+1)%dim_dict['divider']
+            # (nb_objects,)
+            if any(remainder!=0):
+                skip_it = True
+                break
+
+            if dim_dict['primitive']:
+                ordinal = quotient
+                if any(ordinal > dim_dict['nbr_fillers']):
+                    effective_test_threshold -= 1
+            elif dim_dict['image_wise_primitive']:
+                ordinal = quotient
+                how_many_IWP_values_per_object = (ordinal > dim_dict['nbr_fillers'])
+                if how_many_IWP_values_per_object.sum() >= 2:
+                    effective_test_threshold -= 1
+
+            if 'test_set_divider' in dim_dict: test1 = (quotient%dim_dict['test_set_divider']==0)
+            if 'test_set_divider' in dim_dict and any(test1):
+                counter_test = np.concatenate([counter_test, test1.reshape((-1,1))], axis=1)
+            elif 'test_set_size_sample_from_end' in dim_dict:
+                max_quotient = dim_dict['size']//dim_dict['divider']
+                test2 = (quotient > max_quotient-dim_dict['test_set_size_sample_from_end'])
+                if any(test2):
+                    counter_test = np.concatenate([counter_test, test2.reshape((-1,1))], axis=1)
+            elif 'test_set_size_sample_from_start' in dim_dict:
+                test3 = quotient <= dim_dict['test_set_size_sample_from_start']
+                if any(test3):
+                    counter_test = np.concatenate([counter_test, test3.reshape((-1,1))], axis=1)
+
+        if skip_it: continue
+        if any(counter_test.sum(-1) >= effective_test_threshold) != train:
+            indices.append(idx)
+    return indices
+
+def check_split(latents_classes, latent_dims, counter_test_threshold, nb_objects=1):
+    train_indices, test_latents_mask = combinatorial_split_indices(latents_classes, latent_dims, counter_test_threshold, train=True, nb_objects=nb_objects)
+    test_indices, _ = combinatorial_split_indices(latents_classes, latent_dims, counter_test_threshold, train=False, nb_objects=nb_objects)
+    assert(test_latents_mask.shape == latents_classes.shape)
+    assert(len(set(train_indices) & set(test_indices)) == 0)
+    assert(len(train_indices) > 0 and len(test_indices) > 0)
+
+    if nb_objects == 1:
+        reference_train_indices, reference_mask = reference_single_object_split(latents_classes, latent_dims, counter_test_threshold, True)
+        reference_test_indices, _ = reference_single_object_split(latents_classes, latent_dims, counter_test_threshold, False)
+        assert(np.array_equal(test_latents_mask, reference_mask))
+    else:
+        reference_train_indices = reference_multi_object_split(latents_classes, latent_dims, counter_test_threshold, True, nb_objects)
+        reference_test_indices = reference_multi_object_split(latents_classes, latent_dims, counter_test_threshold, False, nb_objects)
+    assert(list(train_indices) == reference_train_indices)
+    assert(list(test_indices) == reference_test_indices)
+
+def test_combinatorial_split():
+    rng = np.random.RandomState(0)
+    latents_classes = np.stack([rng.randint(0, 8, size=1000) for _ in range(4)], axis=1)
+    latent_dims = {
+        f"dim{position}":{
+            'position':position,
+            'size':8,
+            'divider':divider,
+            'remainder_use':remainder_use,
+            'primitive':position==2,
+            'nbr_fillers':1,
+        }
+        for position, (divider, remainder_use) in enumerate([(1, 0), (2, 0), (1, 0), (2, 1)])
+    }
+    latent_dims['dim0']['test_set_divider'] = 2
+    latent_dims['dim1']['test_set_size_sample_from_end'] = 1
+    latent_dims['dim2']['test_set_divider'] = 4
+    latent_dims['dim3']['test_set_size_sample_from_start'] = 1
+
+    for counter_test_threshold in [1, 2, 3]:
+        check_split(latents_classes, latent_dims, counter_test_threshold)
+
+def test_multi_object_combinatorial_split():
+    rng = np.random.RandomState(1)
+    for nb_objects in [2, 3]:
+        # (color, shape, X, Y) for each object:
+        latents_classes = np.concatenate([
+            np.stack([rng.randint(0, size, size=2000) for size in [nb_objects, 5, 6, 6]], axis=1)
+            for _ in range(nb_objects)
+        ], axis=1)
+        latent_dims = {
+            'Y':{'size':6, 'position':3, 'divider':1, 'primitive':False, 'image_wise_primitive':False, 'nbr_fillers':0, 'test_set_divider':3},
+            'X':{'size':6, 'position':2, 'divider':2, 'primitive':False, 'image_wise_primitive':True, 'nbr_fillers':1, 'test_set_size_sample_from_end':1},
+            'Shape':{'size':5, 'position':1, 'divider':1, 'primitive':True, 'image_wise_primitive':False, 'nbr_fillers':2, 'test_set_size_sample_from_start':2},
+        }
+        for counter_test_threshold in [2, 3]:
+            check_split(latents_classes, latent_dims, counter_test_threshold, nb_objects=nb_objects)
+
+def test_cached_split():
+    latents_classes = np.arange(12).reshape(4,3)
+    cache_dir = tempfile.mkdtemp()
+    split = cached_split(cache_dir, {"train":True}, latents_classes, lambda: {"indices":np.arange(2)})
+    # The second call must be served from the on-disk cache:
+    cached = cached_split(cache_dir, {"train":True}, latents_classes, lambda: {"indices":np.arange(3)})
+    assert(np.array_equal(split["indices"], cached["indices"]))
+    other = cached_split(cache_dir, {"train":False}, latents_classes, lambda: {"indices":np.arange(3)})
+    assert(len(other["indices"]) == 3)
+
+
+if __name__ == "__main__":
+    test_combinatorial_split()
+    test_multi_object_combinatorial_split()
+    test_cached_split()
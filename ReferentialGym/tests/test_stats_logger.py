@@ -0,0 +1,16 @@
+import sys
+import tempfile
+
+# Importing the submodule first must not shadow the class exported by the utils package:
+import ReferentialGym.utils.statsLogger.statsLogger
+from ReferentialGym.utils import statsLogger
+
+def test_stats_logger_export():
+    assert(isinstance(statsLogger, type))
+    logger = statsLogger(path=tempfile.mkdtemp())
+    assert(statsLogger is sys.modules["ReferentialGym.utils.statsLogger.statsLogger"].statsLogger)
+    logger.close()
+
+
+if __name__ == "__main__":
+    test_stats_logger_export()
@@ -0,0 +1,45 @@
+import numpy as np
+import ReferentialGym as RG
+
+def test_streaming_summary():
+    rng = np.random.RandomState(0)
+    values = rng.normal(size=(100, 1000))
+
+    summary = RG.utils.StreamingSummary(k=256, seed=0)
+    for batch in values:
+        summary.update(batch)
+
+    values = values.reshape(-1)
+    assert(len(summary) == len(values))
+    assert(np.isclose(summary.get_mean(), values.mean()))
+    assert(np.isclose(summary.get_std(), values.std()))
+    assert(summary.min == values.min() and summary.max == values.max())
+    
+    q1, median, q3 = summary.get_quantile([0.25, 0.5, 0.75])
+    exact_q1, exact_median, exact_q3 = np.percentile(values, q=[25, 50, 75])
+    # Rank errors of the sketch are of the order of 1%:
+    for q, exact_q in zip([q1, median, q3], [exact_q1, exact_median, exact_q3]):
+        rank = (values <= q).mean()
+        exact_rank = (values <= exact_q).mean()
+        assert(abs(rank-exact_rank) < 0.02)
+
+def test_streaming_summary_merge():
+    rng = np.random.RandomState(1)
+    values = rng.uniform(size=20000)
+
+    summaries = [RG.utils.StreamingSummary(k=128, seed=seed) for seed in range(4)]
+    for summary, chunk in zip(summaries, np.split(values, 4)):
+        summary.update(chunk)
+    merged = summaries[0]
+    for summary in summaries[1:]:
+        merged.merge(summary)
+
+    assert(len(merged) == len(values))
+    assert(np.isclose(merged.get_mean(), values.mean()))
+    assert(np.isclose(merged.get_std(), values.std()))
+    assert(abs((values <= merged.get_quantile(0.5)).mean()-0.5) < 0.02)
+
+
+if __name__ == "__main__":
+    test_streaming_summary()
+    test_streaming_summary_merge()
@@ -0,0 +1,60 @@
+import math
+
+import torch
+from ReferentialGym.networks.networks import addXYfeatures, addXYRhoThetaFeatures
+
+def reference_xy_grids(sizeX, sizeY):
+    '''
+    Loop-based construction of the coordinate grids, prior to their vectorization.
+    '''
+    stepX = 2.0/sizeX
+    stepY = 2.0/sizeY
+    fx = torch.zeros((1,1,sizeX,1))
+    fy = torch.zeros((1,1,1,sizeY))
+    vx = -1+0.5*stepX
+    for i in range(sizeX):
+        fx[:,:,i,:] = vx
+        vx += stepX
+    vy = -1+0.5*stepY
+    for i in range(sizeY):
+        fy[:,:,:,i] = vy
+        vy += stepY
+    return fx.repeat(1,1,1,sizeY), fy.repeat(1,1,sizeX,1)
+
+def reference_xy_rho_theta(sizeX, sizeY):
+    sizeRho = math.sqrt((sizeX/2)**2+(sizeY/2)**2)
+    fx, fy = reference_xy_grids(sizeX, sizeY)
+    fxy = fx.transpose(-1,-2)
+    fyx = -fy.transpose(-1,-2)
+    fRho = (fxy**2+fyx**2).sqrt()/sizeRho
+    fTheta = torch.atan2(fyx, fxy)/math.pi
+    return torch.cat([fxy, fyx, fRho, fTheta], dim=1)
+
+def test_xy_features():
+    layer = addXYfeatures()
+    # The grids are rebuilt when the spatial shape changes:
+    for sizeX, sizeY in [(5,5), (7,3), (16,16)]:
+        x = torch.rand(2, 3, sizeX, sizeY)
+        out, outX, outY = layer(x, outputFsizes=True)
+        assert((outX, outY) == (sizeX, sizeY))
+        assert(torch.equal(out[:,:3], x))
+        # Numerically equivalent, up to the float rounding of the accumulated steps of the loops:
+        reference = torch.cat(reference_xy_grids(sizeX, sizeY), dim=1).expand(2,-1,-1,-1)
+        assert(torch.allclose(out[:,3:], reference, rtol=0.0, atol=1e-6))
+    # The grids are not part of the state_dict:
+    assert(len(layer.state_dict()) == 0)
+
+def test_xy_rho_theta_features():
+    layer = addXYRhoThetaFeatures()
+    for size in [5, 8, 16]:
+        x = torch.rand(2, 3, size, size)
+        out = layer(x)
+        assert(torch.equal(out[:,:3], x))
+        reference = reference_xy_rho_theta(size, size).expand(2,-1,-1,-1)
+        assert(torch.allclose(out[:,3:], reference, rtol=0.0, atol=1e-6))
+    assert(len(layer.state_dict()) == 0)
+
+
+if __name__ == "__main__":
+    test_xy_features()
+    test_xy_rho_theta_features()
@@ -0,0 +1,43 @@
+'''
+Minimal speaker and listener agents, made of linear layers, shared by the agent-level tests.
+'''
+import torch.nn as nn
+import ReferentialGym as RG
+
+kwargs = {
+    "with_weight_maxl1_loss":False,
+    "graphtype":"straight_through_gumbel_softmax",
+}
+obs_shape = [2, 1, 3, 4, 4]
+vocab_size = 5
+max_sentence_length = 3
+
+class ToySpeaker(RG.agents.Speaker):
+    def __init__(self, agent_id="s0"):
+        super(ToySpeaker, self).__init__(obs_shape=obs_shape, vocab_size=vocab_size, max_sentence_length=max_sentence_length, agent_id=agent_id, kwargs=kwargs)
+        self.fc = nn.Linear(3*4*4, max_sentence_length*vocab_size)
+        self.nbr_sense_calls = 0
+
+    def _sense(self, experiences, sentences=None):
+        self.nbr_sense_calls += 1
+        return experiences[:,0].reshape(experiences.shape[0], -1)
+
+    def _utter(self, features, sentences=None):
+        logits = self.fc(features).reshape(-1, max_sentence_length, vocab_size)
+        widx = logits.argmax(dim=-1, keepdim=True)
+        one_hot = nn.functional.one_hot(widx.squeeze(-1), num_classes=vocab_size).float()
+        return widx, list(logits), one_hot, features
+
+class ToyListener(RG.agents.DiscriminativeListener):
+    def __init__(self, agent_id="l0"):
+        super(ToyListener, self).__init__(obs_shape=obs_shape, vocab_size=vocab_size, max_sentence_length=max_sentence_length, agent_id=agent_id, kwargs=kwargs)
+        self.use_sentences_one_hot_vectors = True
+        self.fc_exp = nn.Linear(3*4*4, 8)
+        self.fc_sent = nn.Linear(vocab_size, 8)
+
+    def _sense(self, experiences, sentences=None):
+        return self.fc_exp(experiences.reshape(*experiences.shape[:2], -1))
+
+    def _reason(self, sentences, features):
+        message = self.fc_sent(sentences).sum(dim=1, keepdim=True)
+        return (features*message).sum(dim=-1), None
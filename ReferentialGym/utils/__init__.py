@@ -1,5 +1,11 @@
 from .utils import gumbel_softmax, StraightThroughGumbelSoftmaxLayer 
-from .utils import cardinality, query_vae_latent_space
+from .utils import cardinality, query_vae_latent_space, batched_to_host
+from .utils import BackgroundImageWriter, get_background_image_writer
 from .utils import PositionalEncoding
+from .streaming_summary import QuantileSketch, StreamingSummary
+# Rebinds the name of the subpackage to the class (tensorboardX is light once torch is imported):
 from .statsLogger import statsLogger
-from .streamHandler import StreamHandler
+from .streamHandler import StreamHandler, StreamProfiler
+from .checkpointer import Checkpointer, mark_updated
+from .inferenceServer import InferenceServer, load_agent
+
@@ -0,0 +1,154 @@
+from typing import Dict, List
+
+import os
+import io
+import pickle
+import queue
+import threading
+
+import torch
+import torch.nn as nn
+
+
+def mark_updated(tensors:List[torch.Tensor]):
+    """
+    Increments the update counter of each of :param tensors:, which must be
+    called after every optimizer step: fused optimizer kernels modify the
+    parameters without incrementing their version counter.
+    """
+    for t in tensors:
+        t._checkpointer_update_count = getattr(t, "_checkpointer_update_count", 0)+1
+
+
+class Checkpointer(object):
+    def __init__(self, verbose=False):
+        """
+        Asynchronous checkpoint writer.
+
+        The training thread only snapshots the `state_dict`s to CPU memory,
+        while the serialization and the disk writes are handled by a background
+        thread. Each write is atomic: the file is written under a temporary name
+        and then renamed over the target.
+        Modules whose parameters and buffers have not been modified since their
+        last checkpoint are skipped.
+
+        :param verbose: boolean defining whether to print the writes/skips.
+        """
+        self.verbose = verbose
+        # filepath --> fingerprint of the parameters/buffers at the last checkpoint:
+        self.fingerprints = {}
+        self._start()
+
+    def _start(self):
+        self.queue = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __getstate__(self):
+        # The thread and the queue cannot be pickled/deepcopied:
+        self.flush()
+        return {"verbose":self.verbose, "fingerprints":dict(self.fingerprints)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            filepath, data = job
+            try:
+                self._atomic_write(filepath, data)
+                if self.verbose:
+                    print(f"Checkpointer: {filepath} written.")
+            except Exception as e:
+                print(f"Exception caught while trying to write checkpoint {filepath}: {e}")
+                self.errors.append((filepath, e))
+            self.queue.task_done()
+
+    def _atomic_write(self, filepath, data):
+        dirname = os.path.dirname(filepath)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        tmp_filepath = filepath+".tmp"
+        with open(tmp_filepath, 'wb') as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                torch.save(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, filepath)
+
+    def fingerprint(self, module:nn.Module):
+        """
+        Cheap, sync-free, identification of the state of a module:
+        every in-place modification of a tensor through autograd-visible operations
+        (e.g. load_state_dict, running statistics update) increments its version counter,
+        while optimizer steps increment its update counter, cf. `mark_updated`.
+        """
+        return tuple(
+            (name, t.data_ptr(), t._version, getattr(t, "_checkpointer_update_count", 0))
+            for name, t in list(module.named_parameters())+list(module.named_buffers())
+        )
+
+    def has_changed(self, module:nn.Module, filepath:str):
+        return self.fingerprints.get(filepath, None) != self.fingerprint(module)
+
+    def save_state_dict(self,
+                        module:nn.Module,
+                        filepath:str,
+                        force:bool=False):
+        """
+        Snapshots the `state_dict` of :param module: to CPU memory
+        and schedules its writing at :param filepath:.
+
+        :param module: nn.Module whose `state_dict` is saved.
+        :param filepath: str path of the file to write.
+        :param force: boolean defining whether to write even if the module has not changed.
+        :returns: boolean stating whether a write has been scheduled.
+        """
+        fingerprint = self.fingerprint(module)
+        if not force and self.fingerprints.get(filepath, None) == fingerprint:
+            if self.verbose:
+                print(f"Checkpointer: {filepath} unchanged, skipping.")
+            return False
+
+        state_dict = {
+            k: v.detach().to('cpu', copy=True) if isinstance(v, torch.Tensor) else v
+            for k,v in module.state_dict().items()
+        }
+        self.fingerprints[filepath] = fingerprint
+        self.queue.put((filepath, state_dict))
+        return True
+
+    def save_object(self, obj:object, filepath:str, use_torch:bool=False):
+        """
+        Serializes :param obj: on the calling thread, so that later modifications
+        of the object do not leak into the checkpoint, and schedules its writing.
+
+        :param use_torch: boolean defining whether to serialize with `torch.save`
+                          (e.g. optimizer states) rather than `pickle`.
+        """
+        if use_torch:
+            buffer = io.BytesIO()
+            torch.save(obj, buffer)
+            data = buffer.getvalue()
+        else:
+            data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self.queue.put((filepath, data))
+
+    def flush(self):
+        """
+        Blocks until every scheduled write has been performed.
+        """
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1 @@
+from .Checkpointer import Checkpointer, mark_updated
\ No newline at end of file
@@ -0,0 +1,299 @@
+from typing import Dict, List
+
+import os
+import time
+import inspect
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+import torch.nn as nn
+
+
+# `torch.inference_mode` and the `weights_only` argument of `torch.load`
+# are only available from torch 1.9 and 1.13, respectively:
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+_torch_load_kwargs = {"weights_only":False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+
+
+def load_agent(path:str, agent:nn.Module=None, agent_id:str=None) -> nn.Module:
+    """
+    Loads a trained agent from the folder :param path: where a `ReferentialGame` saved its modules.
+
+    The checkpoints are written in the background by the `Checkpointer`:
+    when loading from a folder that is still being written to, e.g. from
+    the training process itself, `Checkpointer.flush` must be called first,
+    otherwise an earlier checkpoint (or none) may be loaded.
+
+    :param agent: None, or agent instance (with the same architecture) into which the
+                  `<agent.id>.state_dict` checkpoint is loaded.
+    :param agent_id: str ID of the agent, used when :param agent: is None, to load
+                     the whole pickled agent from `<agent_id>.agent` (or legacy `<agent_id>.pth`).
+    :returns: the loaded agent.
+    """
+    if agent is not None:
+        agent_id = agent.id
+        extensions = [".state_dict"]
+    else:
+        extensions = [".agent", ".pth"]
+
+    for ext in extensions:
+        filepath = os.path.join(path, agent_id+ext)
+        if not os.path.exists(filepath):  continue
+        if agent is not None:
+            agent.load_state_dict(torch.load(filepath, map_location="cpu"))
+            return agent
+        return torch.load(filepath, map_location="cpu", **_torch_load_kwargs)
+    raise FileNotFoundError(f"No checkpoint of agent {agent_id} found in {path}.")
+
+
+class InferenceServer(object):
+    def __init__(self,
+                 speaker:nn.Module=None,
+                 listener:nn.Module=None,
+                 max_batch_size:int=64,
+                 max_latency:float=0.005,
+                 graphtype:str="straight_through_gumbel_softmax",
+                 tau0:float=0.2,
+                 output_device:str="cpu"):
+        """
+        In-process, dynamically-batched, inference server for trained agents.
+
+        Requests are queued from any thread and handled by a background thread,
+        which batches together the concurrent requests of the same kind and shapes
+        into a single forward pass of the agent, under `torch.inference_mode`.
+        The agents are called directly, rather than through their `compute` method,
+        so that no hook, loss or logging is involved.
+
+        :param speaker: None or trained speaker agent that answers `describe` requests.
+        :param listener: None or trained listener agent that answers `decide` requests.
+        :param max_batch_size: int maximal number of stimuli per forward pass.
+        :param max_latency: float maximal time, in seconds, that a request waits
+                            for other requests to be batched with.
+        :param output_device: None or device to which the outputs are moved.
+        """
+        self.agents = {"speaker":speaker, "listener":listener}
+        for agent in self.agents.values():
+            if agent is not None:   agent.eval()
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.graphtype = graphtype
+        self.tau0 = tau0
+        self.output_device = output_device
+        self._start()
+
+    @classmethod
+    def from_saved(cls,
+                   path:str,
+                   speaker:nn.Module=None,
+                   listener:nn.Module=None,
+                   speaker_id:str=None,
+                   listener_id:str=None,
+                   **kwargs):
+        """
+        Loads the speaker and listener agents saved in :param path:,
+        either into the provided instances, or from their pickled agents,
+        and serves them. Cf. `load_agent` regarding checkpoints that are
+        still being written in the background.
+        """
+        if speaker is not None or speaker_id is not None:
+            speaker = load_agent(path, agent=speaker, agent_id=speaker_id)
+        if listener is not None or listener_id is not None:
+            listener = load_agent(path, agent=listener, agent_id=listener_id)
+        return cls(speaker=speaker, listener=listener, **kwargs)
+
+    def _start(self):
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def describe(self, experiences:torch.Tensor) -> Future:
+        """
+        :param experiences: Tensor of shape `(nbr_requests, *speaker.obs_shape)`.
+        :returns: Future of the Dict of the speaker's outputs, e.g. `'sentences_widx'`
+                  of shape `(nbr_requests, max_sentence_length, 1)`.
+        """
+        return self._submit("speaker", experiences=experiences, sentences=None)
+
+    def decide(self, experiences:torch.Tensor, sentences:torch.Tensor) -> Future:
+        """
+        :param experiences: Tensor of shape `(nbr_requests, *listener.obs_shape)`.
+        :param sentences: Tensor of shape `(nbr_requests, sentence_length, *)`, in the format
+                          expected by the listener, i.e. the `'sentences_one_hot'` output of
+                          `describe` if `listener.use_sentences_one_hot_vectors`,
+                          or its `'sentences_widx'` output otherwise.
+        :returns: Future of the Dict of the listener's outputs, e.g. `'decision'`
+                  logits of shape `(nbr_requests, nbr_stimuli, ...)`.
+        """
+        return self._submit("listener", experiences=experiences, sentences=sentences)
+
+    def _submit(self, role, experiences, sentences):
+        if self.agents[role] is None:
+            raise ValueError(f"No {role} is served.")
+        # Malformed requests are rejected here, rather than failing a whole batch:
+        if not isinstance(experiences, torch.Tensor) or experiences.dim() == 0:
+            raise ValueError("The experiences must be a batched Tensor.")
+        if sentences is not None:
+            if not isinstance(sentences, torch.Tensor) or sentences.dim() < 2:
+                raise ValueError("The sentences must be a Tensor of shape (nbr_requests, sentence_length, *).")
+            if sentences.shape[0] != experiences.shape[0]:
+                raise ValueError(f"The experiences and the sentences differ in batch size: {experiences.shape[0]} vs {sentences.shape[0]}.")
+        if self.closed:
+            raise RuntimeError("The inference server is closed.")
+        future = Future()
+        self.queue.put((role, experiences, sentences, future))
+        return future
+
+    def close(self):
+        """
+        Answers the pending requests and stops the background thread.
+        """
+        if self.closed:  return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        pending = []
+        while True:
+            if len(pending) == 0:
+                request = self.queue.get()
+                if request is None: break
+                self._add_pending(pending, request)
+                if len(pending) == 0:   continue
+
+            # Gathers the concurrent requests, until the batch is full or the latency budget is spent:
+            stop = False
+            deadline = time.time()+self.max_latency
+            while sum(self._request_size(r) for r in pending) < self.max_batch_size:
+                timeout = deadline-time.time()
+                try:
+                    request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                self._add_pending(pending, request)
+
+            batch, pending = self._next_batch(pending)
+            self._process(batch)
+
+            if stop:
+                while len(pending):
+                    batch, pending = self._next_batch(pending)
+                    self._process(batch)
+                break
+
+    def _add_pending(self, pending, request):
+        try:
+            self._batch_key(request)
+            self._request_size(request)
+        except Exception as e:
+            # Only the malformed request fails, the server keeps serving the others:
+            request[3].set_exception(e)
+            return
+        pending.append(request)
+
+    def _request_size(self, request):
+        return request[1].shape[0]
+
+    def _batch_key(self, request):
+        role, experiences, sentences, _ = request
+        sentences_key = None
+        if sentences is not None:
+            # Sentences of different lengths are padded together:
+            sentences_key = (sentences.dtype, tuple(sentences.shape[2:]))
+        return (role, tuple(experiences.shape[1:]), sentences_key)
+
+    def _next_batch(self, pending):
+        """
+        :returns:
+            - the requests (of the same kind and shapes as the oldest one) to batch together,
+            - the remaining requests.
+        """
+        key = None
+        batch, remaining = [], []
+        batch_size = 0
+        for request in pending:
+            try:
+                request_key = self._batch_key(request)
+                request_size = self._request_size(request)
+            except Exception as e:
+                # e.g. tensors resized in-place after their submission:
+                request[3].set_exception(e)
+                continue
+            if key is None:
+                key = request_key
+            if request_key == key\
+                and (len(batch) == 0 or batch_size+request_size <= self.max_batch_size):
+                batch.append(request)
+                batch_size += request_size
+            else:
+                remaining.append(request)
+        return batch, remaining
+
+    def _process(self, batch):
+        if len(batch) == 0:  return
+        futures = [r[3] for r in batch]
+        try:
+            outputs = self._forward(batch)
+        except Exception as e:
+            for future in futures: future.set_exception(e)
+            return
+        for future, output in zip(futures, outputs):
+            future.set_result(output)
+
+    def _forward(self, batch) -> List[Dict[str,object]]:
+        role = batch[0][0]
+        agent = self.agents[role]
+        device = next(agent.parameters()).device
+        sizes = [r[1].shape[0] for r in batch]
+
+        experiences = torch.cat([r[1] for r in batch], dim=0).to(device)
+        sentences = None
+        if batch[0][2] is not None:
+            sentences = [r[2] for r in batch]
+            max_length = max(s.shape[1] for s in sentences)
+            # One-hot sentences are padded with zeros, and indices with the STOP token, as the agents do:
+            padding_value = 0.0 if sentences[0].is_floating_point() else agent.vocab_stop_idx
+            sentences = [
+                torch.cat([s, s.new_full((s.shape[0], max_length-s.shape[1], *s.shape[2:]), padding_value)], dim=1)
+                if s.shape[1] < max_length else s
+                for s in sentences
+            ]
+            sentences = torch.cat(sentences, dim=0).to(device)
+
+        with inference_mode():
+            outputs = agent(experiences=experiences,
+                            sentences=sentences,
+                            multi_round=False,
+                            graphtype=self.graphtype,
+                            tau0=self.tau0)
+        # Nothing is logged at inference:
+        agent.log_dict = {}
+
+        split_outputs = [dict() for _ in batch]
+        batch_size = sum(sizes)
+        for key, value in outputs.items():
+            if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size:
+                if self.output_device is not None:  value = value.to(self.output_device)
+                values = value.split(sizes, dim=0)
+            elif isinstance(value, list) and len(value) == batch_size:
+                if self.output_device is not None:
+                    value = [v.to(self.output_device) if isinstance(v, torch.Tensor) else v for v in value]
+                offsets = [sum(sizes[:idx]) for idx in range(len(sizes)+1)]
+                values = [value[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            else:
+                continue
+            for split_output, v in zip(split_outputs, values):
+                split_output[key] = v
+        return split_outputs
@@ -0,0 +1 @@
+from .InferenceServer import InferenceServer, load_agent
@@ -41,6 +41,22 @@ class statsLogger(SummaryWriter):
         self.dumpIdx += 1
         self.data = [dict() if idx!=(len(self.data)-1) else d for idx, d in enumerate(self.data)]
 
+    def state_dict(self):
+        """
+        Returns the step counters of the logger, e.g. to resume a run.
+        """
+        return {
+            "dumpIdx":self.dumpIdx,
+            "counterDumpPeriod":self.counterDumpPeriod,
+            "nbr_epoch_entries":len(self.data),
+        }
+
+    def load_state_dict(self, state_dict):
+        self.dumpIdx = state_dict["dumpIdx"]
+        self.counterDumpPeriod = state_dict["counterDumpPeriod"]
+        while len(self.data) < state_dict["nbr_epoch_entries"]:
+            self.data.append(dict())
+
     def switch_epoch(self,):
         """
         Separate the data recording in epoch-based entries.
@@ -2,9 +2,27 @@ from typing import Dict, List
 
 import copy
 
+from .StreamProfiler import StreamProfiler
+
 class StreamHandler(object):
     def __init__(self):
         self.placeholders = {}
+        self.profiler = None
+
+    def enable_profiling(self, profiler:StreamProfiler=None):
+        '''
+        Opts in to the recording of per-module statistics (timings, memory, calls)
+        in :meth:`serve`.
+
+        :param profiler: None or StreamProfiler to use. If None, a default one is created.
+        '''
+        if profiler is None:
+            profiler = StreamProfiler()
+        self.profiler = profiler
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
 
     def register(self, placeholder_id:str):
         self.update(placeholder_id=placeholder_id, stream_data={})
@@ -51,8 +69,15 @@ class StreamHandler(object):
         
         return
 
-    def serve(self, pipeline:List[object]):
+    def serve(self, pipeline:List[object], pipeline_id:str=None):
+        '''
+        :param pipeline: List of module ids to compute in order.
+        :param pipeline_id: None or str id of the pipeline, only used for profiling purposes.
+        '''
+        profiler = self.profiler
         for module_id in pipeline:
+            if profiler is not None:
+                token = profiler.start()
             module = self[f"modules:{module_id}:ref"]
             module_input_stream_dict = self._serve_module(module)    
             module_output_stream_dict = module.compute(input_streams_dict=module_input_stream_dict)
@@ -61,6 +86,8 @@ class StreamHandler(object):
                     self.update(stream_id, stream_data)
                 else:
                     self.update(f"modules:{module_id}:{stream_id}", stream_data)
+            if profiler is not None:
+                profiler.stop(module_id=module_id, token=token, pipeline_id=pipeline_id)
 
     def _serve_module(self, module:object):
         module_input_stream_ids = module.get_input_stream_ids()
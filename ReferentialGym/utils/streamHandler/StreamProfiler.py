@@ -0,0 +1,106 @@
+from typing import Dict, List
+
+import os
+import json
+import time
+import threading
+
+import torch
+
+
+class StreamProfiler(object):
+    def __init__(self, synchronize_cuda=True, max_trace_events=100000):
+        """
+        Records, for each module served by a `StreamHandler`, the wall time,
+        the CPU time, the peak allocated (CUDA) memory and the number of calls.
+        The statistics are aggregated until `reset` is called, e.g. every epoch,
+        and can be exported to a (tensorboardX-like) logger and to a Chrome-trace
+        JSON file (to be opened with chrome://tracing or Perfetto).
+
+        :param synchronize_cuda: boolean defining whether to synchronize CUDA before/after
+                                 each module so that the timings account for the kernels
+                                 that the module launched. Ignored if CUDA is not available.
+        :param max_trace_events: int defining the maximal number of trace events recorded
+                                 between two resets, so that the memory footprint is bounded.
+        """
+        self.use_cuda = torch.cuda.is_available()
+        self.synchronize_cuda = synchronize_cuda and self.use_cuda
+        self.max_trace_events = max_trace_events
+        self.origin = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        # module_id --> Dict of aggregated statistics:
+        self.stats = {}
+        self.trace_events = []
+
+    def start(self):
+        if self.synchronize_cuda:
+            torch.cuda.synchronize()
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+        return time.perf_counter(), time.thread_time()
+
+    def stop(self, module_id:str, token:object, pipeline_id:str=None):
+        if self.synchronize_cuda:
+            torch.cuda.synchronize()
+        end_wall_time, end_cpu_time = time.perf_counter(), time.thread_time()
+        start_wall_time, start_cpu_time = token
+        wall_time = end_wall_time-start_wall_time
+        cpu_time = end_cpu_time-start_cpu_time
+        peak_memory = torch.cuda.max_memory_allocated() if self.use_cuda else 0
+
+        if module_id not in self.stats:
+            self.stats[module_id] = {
+                "calls":0,
+                "wall_time":0.0,
+                "cpu_time":0.0,
+                "max_wall_time":0.0,
+                "peak_memory":0,
+            }
+        stats = self.stats[module_id]
+        stats["calls"] += 1
+        stats["wall_time"] += wall_time
+        stats["cpu_time"] += cpu_time
+        stats["max_wall_time"] = max(stats["max_wall_time"], wall_time)
+        stats["peak_memory"] = max(stats["peak_memory"], peak_memory)
+
+        if len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append({
+                "name":module_id,
+                "cat":pipeline_id if pipeline_id is not None else "pipeline",
+                "ph":"X",
+                "ts":(start_wall_time-self.origin)*1e6,
+                "dur":wall_time*1e6,
+                "pid":os.getpid(),
+                "tid":threading.get_ident(),
+                "args":{"cpu_time_us":cpu_time*1e6, "peak_memory":peak_memory},
+            })
+
+    def summary(self) -> Dict[str,Dict[str,float]]:
+        """
+        :returns: Dict of module ids and their aggregated statistics,
+                  sorted by decreasing total wall time.
+        """
+        summary = {}
+        for module_id, stats in sorted(self.stats.items(), key=lambda kv: -kv[1]["wall_time"]):
+            summary[module_id] = dict(stats)
+            summary[module_id]["mean_wall_time"] = stats["wall_time"]/stats["calls"]
+        return summary
+
+    def log(self, logger:object, step:int, prefix:str="Profiling"):
+        for module_id, stats in self.summary().items():
+            logger.add_scalar(f"{prefix}/{module_id}/WallTime", stats["wall_time"], step)
+            logger.add_scalar(f"{prefix}/{module_id}/MeanWallTime", stats["mean_wall_time"], step)
+            logger.add_scalar(f"{prefix}/{module_id}/MaxWallTime", stats["max_wall_time"], step)
+            logger.add_scalar(f"{prefix}/{module_id}/CPUTime", stats["cpu_time"], step)
+            logger.add_scalar(f"{prefix}/{module_id}/Calls", stats["calls"], step)
+            if self.use_cuda:
+                logger.add_scalar(f"{prefix}/{module_id}/PeakMemory", stats["peak_memory"], step)
+
+    def dump_chrome_trace(self, filepath:str):
+        dirname = os.path.dirname(filepath)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        with open(filepath, 'w') as f:
+            json.dump({"traceEvents":self.trace_events, "displayTimeUnit":"ms"}, f)
@@ -1 +1,2 @@
-from .StreamHandler import StreamHandler
\ No newline at end of file
+from .StreamHandler import StreamHandler
+from .StreamProfiler import StreamProfiler
\ No newline at end of file
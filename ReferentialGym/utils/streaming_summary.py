@@ -0,0 +1,153 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    def __init__(self, k=256, seed=None):
+        """
+        Mergeable streaming quantile sketch (KLL-like).
+        Values are accumulated in a hierarchy of compactors: when the compactor
+        at level `l` holds more than `k` values, it is sorted and every other
+        value, with a random offset, is promoted to level `l+1`, where each value
+        accounts for `2**(l+1)` original values. The memory is thus in
+        `O(k*log(n/k))` and the rank error in `O(1/k)`.
+
+        :param k: int defining the capacity of each compactor.
+        :param seed: None or int seed of the random offsets.
+        """
+        self.k = k
+        self.rng = np.random.RandomState(seed)
+        self.compactors = [np.empty(0)]
+
+    def update(self, values):
+        """
+        :param values: numpy array of values (NaNs are expected to have been filtered out).
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        for level, compactor in enumerate(other.compactors):
+            if level == len(self.compactors):
+                self.compactors.append(np.empty(0))
+            self.compactors[level] = np.concatenate([self.compactors[level], compactor])
+        self._compress()
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self.compactors):
+            compactor = self.compactors[level]
+            if len(compactor) > self.k:
+                if level+1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+                compactor = np.sort(compactor)
+                leftover = compactor[len(compactor)-len(compactor)%2:]
+                compactor = compactor[:len(compactor)-len(compactor)%2]
+                offset = self.rng.randint(2)
+                self.compactors[level+1] = np.concatenate([self.compactors[level+1], compactor[offset::2]])
+                self.compactors[level] = leftover
+            level += 1
+
+    def __len__(self):
+        return int(sum(len(c)*2**level for level, c in enumerate(self.compactors)))
+
+    def quantile(self, q):
+        """
+        :param q: float or array of floats in [0,1].
+        :returns: approximate quantile(s) of the values seen so far, or NaN if there are none.
+        """
+        values = np.concatenate(self.compactors)
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        weights = np.concatenate([
+            np.full(len(c), 2**level, dtype=np.float64)
+            for level, c in enumerate(self.compactors)
+        ])
+        order = np.argsort(values, kind="stable")
+        values = values[order]
+        cumweights = np.cumsum(weights[order])
+        ranks = np.asarray(q)*cumweights[-1]
+        indices = np.clip(np.searchsorted(cumweights, ranks, side="left"), 0, len(values)-1)
+        return values[indices]
+
+
+class StreamingSummary(object):
+    def __init__(self, k=256, seed=None):
+        """
+        Constant-memory, mergeable, summary of a stream of values:
+        count, mean, variance, min/max, and quantiles via a `QuantileSketch`.
+        NaN values are counted separately: they make the mean/std NaN,
+        like `numpy.mean`, but are ignored by the quantiles, like `numpy.nanpercentile`.
+
+        :param k: int defining the capacity of the compactors of the quantile sketch.
+        :param seed: None or int seed of the quantile sketch.
+        """
+        self.count = 0
+        self.nan_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.last = None
+        self.sketch = QuantileSketch(k=k, seed=seed)
+
+    def _combine(self, count, mean, m2):
+        # Chan et al.'s parallel update of the mean and the sum of squared deviations:
+        total = self.count+count
+        delta = mean-self.mean
+        self.mean += delta*count/total
+        self.m2 += m2+delta**2*self.count*count/total
+        self.count = total
+
+    def update(self, values):
+        """
+        :param values: scalar or numpy array of values.
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        self.last = values[-1]
+        nan_mask = np.isnan(values)
+        nbr_nans = int(nan_mask.sum())
+        if nbr_nans:
+            self.nan_count += nbr_nans
+            values = values[~nan_mask]
+            if len(values) == 0:
+                return
+        batch_mean = values.mean()
+        self._combine(
+            count=len(values),
+            mean=batch_mean,
+            m2=((values-batch_mean)**2).sum(),
+        )
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sketch.update(values)
+
+    def merge(self, other):
+        if other.count:
+            self._combine(count=other.count, mean=other.mean, m2=other.m2)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.sketch.merge(other.sketch)
+        self.nan_count += other.nan_count
+        if other.last is not None:
+            self.last = other.last
+        return self
+
+    def __len__(self):
+        return self.count+self.nan_count
+
+    def get_mean(self):
+        if self.nan_count or not self.count:
+            return np.nan
+        return self.mean
+
+    def get_std(self):
+        if self.nan_count or not self.count:
+            return np.nan
+        return np.sqrt(self.m2/self.count)
+
+    def get_quantile(self, q):
+        return self.sketch.quantile(q)
@@ -5,10 +5,11 @@ import torch.nn as nn
 import torchvision
 import numpy as np 
 from numpy import linalg as LA
-from scipy.stats import spearmanr
 from tqdm import tqdm 
 
 import itertools
+import queue
+import threading
 from concurrent.futures import ProcessPoolExecutor
 
 eps = 1e-8
@@ -103,6 +104,32 @@ class StraightThroughGumbelSoftmaxLayer(nn.Module):
 
 
 
+def batched_to_host(tensors):
+  """
+  Copies a list of tensors to the host with one transfer per device,
+  instead of one (synchronizing) transfer per tensor.
+
+  :param tensors: List of torch.Tensor, of any shapes and devices.
+  :returns: List of numpy arrays (as float values if the tensors of the same
+            device did not share a dtype), in the same order and shapes.
+  """
+  outputs = [None]*len(tensors)
+  device2indices = {}
+  for idx, t in enumerate(tensors):
+    device2indices.setdefault(t.device, []).append(idx)
+
+  for device, indices in device2indices.items():
+    group = [tensors[idx].detach() for idx in indices]
+    dtypes = set(t.dtype for t in group)
+    dtype = group[0].dtype if len(dtypes)==1 else torch.float64
+    flat = torch.cat([t.reshape(-1).to(dtype) for t in group], dim=0).cpu().numpy()
+    offset = 0
+    for idx, t in zip(indices, group):
+      outputs[idx] = flat[offset:offset+t.numel()].reshape(t.shape)
+      offset += t.numel()
+  return outputs
+
+
 def cardinality(data):
     if isinstance(data[0], np.ndarray):
         data_array = np.concatenate([np.expand_dims(d, 0) for d in data], axis=0)
@@ -180,53 +207,80 @@ def compute_topographic_similarity_parallel(sentences,features,comprange=100, ma
         for c in idx1_cossims: 
             cossims.append(c)
     
+    from scipy.stats import spearmanr
     rho, p = spearmanr(levs, cossims)
     return -rho, p, levs, cossims
 
-def query_vae_latent_space(omodel, sample, path, test=False, full=True, idxoffset=None, suffix='', use_cuda=False):
-  if use_cuda:
-    model = omodel.cuda()
-  else:
-    model = omodel.cpu()
+class BackgroundImageWriter(object):
+  def __init__(self, max_queue_size=8):
+    """
+    Encodes and writes images (PNG files and/or TensorBoard images) on a background thread.
+    The queue is bounded: when it is full, new jobs are dropped rather than stalling the caller.
 
-  z_dim = model.get_feature_shape()
-  img_depth=model.input_shape[0]
-  img_dim = model.input_shape[1]
-  
-  fixed_x = sample.view(-1, img_depth, img_dim, img_dim)
-  if use_cuda:  
-    fixed_x = fixed_x.cuda()
-  else:
-    fixed_x = fixed_x.cpu()
+    :param max_queue_size: int defining the maximal number of pending jobs.
+    """
+    self.queue = queue.Queue(maxsize=max_queue_size)
+    self.nbr_dropped_jobs = 0
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
 
-  # variations over the latent variable :
-  sigma_mean = 3.0*torch.ones((z_dim)) #args.queryVAR*torch.ones((z_dim))
-  z, mu, log_sig_sq  = model.encodeZ(fixed_x)
-  mu_mean = mu.cpu().data[0]#.unsqueeze(0)
-  #print(z,mu_mean,sigma_mean)
-  
-  # Save generated variable images :
-  nbr_steps = 8 #args.querySTEPS
-  gen_images = list()
-
-  if (z_dim <= 50) or full:
-    for latent in range(z_dim):
-      var_z0 = torch.zeros((nbr_steps, z_dim), requires_grad=False)
-      val = mu_mean[latent]-sigma_mean[latent]
-      step = 2.0*sigma_mean[latent]/nbr_steps
-      for i in range(nbr_steps) :
-        var_z0[i] = mu_mean
-        var_z0[i][latent] = val
-        val += step
-
-      if use_cuda: var_z0 = var_z0.cuda()
-
-      gen_images_latent = model.decode(var_z0)
-      npfx = gen_images_latent.cpu().data 
-      
-      gen_images.append(gen_images_latent)
-    
-    gen_images = torch.cat(gen_images, dim=0)
+  def submit(self, fn, *args, **kwargs):
+    """
+    :returns: boolean stating whether the job has been queued or dropped.
+    """
+    try:
+      self.queue.put_nowait((fn, args, kwargs))
+    except queue.Full:
+      self.nbr_dropped_jobs += 1
+      return False
+    return True
+
+  def _run(self):
+    while True:
+      fn, args, kwargs = self.queue.get()
+      try:
+        fn(*args, **kwargs)
+      except Exception as e:
+        print(f"Exception caught while trying to write images in the background: {e}")
+      self.queue.task_done()
+
+  def flush(self):
+    self.queue.join()
+
+_background_image_writer = None
+
+def get_background_image_writer():
+  global _background_image_writer
+  if _background_image_writer is None:
+    _background_image_writer = BackgroundImageWriter()
+  return _background_image_writer
+
+
+def _resize_spatial_maps(maps, imgw):
+  resize = torchvision.transforms.Compose( [torchvision.transforms.ToPILImage(), 
+    torchvision.transforms.Resize(imgw),
+    torchvision.transforms.ToTensor()])
+  return torch.cat([ resize(maps[i]).unsqueeze(0) for i in range(maps.size(0))], dim=0)
+
+def _write_vae_latent_space_images(gen_images,
+                                   nbr_steps,
+                                   orimg,
+                                   reconst_images,
+                                   attention_weights,
+                                   attention_reconstructions,
+                                   path,
+                                   test,
+                                   idxoffset,
+                                   suffix,
+                                   logger=None,
+                                   global_step=None):
+  """
+  Post-processing and writing part of `query_vae_latent_space`, which only
+  operates on CPU tensors, and is therefore run by the background writer.
+  """
+  tag_prefix = "VAE/test" if test else "VAE/train"
+
+  if gen_images is not None:
     grid_gen_images = torchvision.utils.make_grid(gen_images, nrow=nbr_steps)
 
     save_path = os.path.join(path, 'generated_images/')
@@ -235,25 +289,23 @@ def query_vae_latent_space(omodel, sample, path, test=False, full=True, idxoffse
     os.makedirs(save_path, exist_ok=True)
     save_path += 'query{}{}.png'.format(idxoffset, suffix)
     torchvision.utils.save_image(gen_images, save_path )
-    
-  model_outputs = model(fixed_x)
-  reconst_images = model_outputs[0]
-  
-  npfx = reconst_images.cpu().data
-  orimg = fixed_x.cpu().data
-  ri = torch.cat( [orimg, npfx], dim=2)
+    if logger is not None:
+      logger.add_image(f"{tag_prefix}/{suffix}/LatentTraversals", grid_gen_images, global_step)
+
+  ri = torch.cat( [orimg, reconst_images], dim=2)
   save_path = os.path.join(path, 'reconstructed_images/')
   if test :
     save_path = os.path.join(save_path, 'test/')
   os.makedirs(save_path, exist_ok=True)
   query_save_path = save_path + 'query{}{}.png'.format(idxoffset, suffix)
   torchvision.utils.save_image(ri,query_save_path )
+  if logger is not None:
+    logger.add_image(f"{tag_prefix}/{suffix}/Reconstructions", torchvision.utils.make_grid(ri), global_step)
 
-  if hasattr(model.encoder, 'attention_weights'):
-    attention_weights = model.encoder.attention_weights
+  if attention_weights is not None:
     seq_len = len(attention_weights)
     if isinstance(attention_weights, list):
-      attention = torch.cat([ attention[0].unsqueeze(0) for attention in attention_weights], dim=0).cpu().data.transpose(1,3).unsqueeze(2)
+      attention = torch.cat([ attention[0].unsqueeze(0) for attention in attention_weights], dim=0).transpose(1,3).unsqueeze(2)
     else:
       attention = attention_weights
     # seq_len x nbr_slots x 1 x spatialDim x spatialDim 
@@ -261,35 +313,34 @@ def query_vae_latent_space(omodel, sample, path, test=False, full=True, idxoffse
     # rescale between [0.25, 1.0]:
     attention = 0.75*attention + 0.25
     nbr_slot = attention.size(1)
+    fixed_x = orimg
     if seq_len != orimg.size(0):
-      orimg = fixed_x[0].cpu().data.unsqueeze(0).repeat(seq_len*nbr_slot, 1, 1, 1)
+      orimg = fixed_x[0].unsqueeze(0).repeat(seq_len*nbr_slot, 1, 1, 1)
     else:
-      orimg = fixed_x.cpu().data.unsqueeze(0).repeat(nbr_slot, 1, 1, 1, 1)
+      orimg = fixed_x.unsqueeze(0).repeat(nbr_slot, 1, 1, 1, 1)
       orimg = orimg.transpose(1,0).contiguous().view((-1, *fixed_x.size()[1:]))
     # seq_len x 3 x img_w x img_h 
 
     # resize: if needs be:
     imgw = orimg.size(-1)
     if imgw != spatialDim:
-      resize = torchvision.transforms.Compose( [torchvision.transforms.ToPILImage(), 
-        torchvision.transforms.Resize(imgw),
-        torchvision.transforms.ToTensor()])
       attention = attention.contiguous().view(seq_len*nbr_slot, 1, spatialDim, spatialDim)
-      attention = torch.cat([ resize(attention[i]).unsqueeze(0) for i in range(seq_len*nbr_slot)], dim=0)
+      attention = _resize_spatial_maps(attention, imgw)
     attention = attention.contiguous().view(seq_len*nbr_slot, 1, imgw, imgw)
     # seq_len*nbr_slot x 1 x imgw x imgw 
-    attention = attention.contiguous().repeat(1,3,1,1).cpu().data
+    attention = attention.contiguous().repeat(1,3,1,1)
 
     att_img = attention * orimg
     grid_att_img = torchvision.utils.make_grid(att_img, nrow=nbr_slot)
     att_save_path = save_path+'att{}{}.png'.format(idxoffset, suffix)
     torchvision.utils.save_image(grid_att_img, att_save_path)
+    if logger is not None:
+      logger.add_image(f"{tag_prefix}/{suffix}/Attention", grid_att_img, global_step)
 
-  if hasattr(model.encoder, 'attention_reconstructions'):
-    attention_reconstructions = model.encoder.attention_reconstructions
-    seq_len = len(attention_weights)
-    if isinstance(attention_weights, list):
-      recs = torch.cat([ attention[0].unsqueeze(0) for attention in attention_reconstructions], dim=0).cpu().data.transpose(1,3).unsqueeze(2)
+  if attention_reconstructions is not None:
+    seq_len = len(attention_reconstructions)
+    if isinstance(attention_reconstructions, list):
+      recs = torch.cat([ attention[0].unsqueeze(0) for attention in attention_reconstructions], dim=0).transpose(1,3).unsqueeze(2)
     else:
       recs = attention_reconstructions
     # seq_len x nbr_slots x 3 x spatialDim x spatialDim 
@@ -298,11 +349,8 @@ def query_vae_latent_space(omodel, sample, path, test=False, full=True, idxoffse
     
     imgw = orimg.size(-1)
     if imgw != spatialDim:
-      resize = torchvision.transforms.Compose( [torchvision.transforms.ToPILImage(), 
-        torchvision.transforms.Resize(imgw),
-        torchvision.transforms.ToTensor()])
       recs = recs.contiguous().view(seq_len*nbr_slot, 1, spatialDim, spatialDim)
-      recs = torch.cat([ resize(recs[i]).unsqueeze(0) for i in range(seq_len*nbr_slot)], dim=0)
+      recs = _resize_spatial_maps(recs, imgw)
     recs = recs.contiguous().view(seq_len*nbr_slot, -1, imgw, imgw)
     # seq_len*nbr_slot x 3 x imgw x imgw 
     recs = recs.contiguous()
@@ -310,6 +358,101 @@ def query_vae_latent_space(omodel, sample, path, test=False, full=True, idxoffse
     grid_recs = torchvision.utils.make_grid(recs, nrow=nbr_slot)
     recs_save_path = save_path+'recs{}{}.png'.format(idxoffset, suffix)
     torchvision.utils.save_image(grid_recs, recs_save_path)
+    if logger is not None:
+      logger.add_image(f"{tag_prefix}/{suffix}/AttentionReconstructions", grid_recs, global_step)
+
+def _to_cpu(data):
+  if data is None:
+    return None
+  if isinstance(data, list):
+    return [_to_cpu(d) for d in data]
+  if isinstance(data, tuple):
+    return tuple(_to_cpu(d) for d in data)
+  return data.detach().cpu()
+
+def query_vae_latent_space(omodel, 
+                           sample, 
+                           path, 
+                           test=False, 
+                           full=True, 
+                           idxoffset=None, 
+                           suffix='', 
+                           use_cuda=False, 
+                           logger=None,
+                           global_step=None,
+                           blocking=False):
+  """
+  Decodes latent traversals and reconstructions of :param sample: on the calling thread,
+  and hands the resulting CPU tensors to the background image writer, which encodes and 
+  writes them as PNG files (and TensorBoard images if :param logger: is not None).
+  If the writer is lagging behind, the visualization is dropped instead of stalling the caller.
+
+  :param logger: None or SummaryWriter-like object to which the images are added.
+  :param global_step: None or int step at which the images are added to the :param logger:.
+  :param blocking: boolean defining whether to write the images on the calling thread.
+  """
+  if use_cuda:
+    model = omodel.cuda()
+  else:
+    model = omodel.cpu()
+
+  z_dim = model.get_feature_shape()
+  img_depth=model.input_shape[0]
+  img_dim = model.input_shape[1]
+  
+  fixed_x = sample.view(-1, img_depth, img_dim, img_dim)
+  if use_cuda:  
+    fixed_x = fixed_x.cuda()
+  else:
+    fixed_x = fixed_x.cpu()
+
+  # Save generated variable images :
+  nbr_steps = 8 #args.querySTEPS
+  
+  with torch.no_grad():
+    # variations over the latent variable :
+    sigma_mean = 3.0 #args.queryVAR
+    z, mu, log_sig_sq  = model.encodeZ(fixed_x)
+    mu_mean = mu[0].detach()
+
+    gen_images = None
+    if (z_dim <= 50) or full:
+      gen_images = list()
+      traversal = (-sigma_mean+(2.0*sigma_mean/nbr_steps)*torch.arange(nbr_steps, dtype=mu_mean.dtype)).to(mu_mean.device)
+      for latent in range(z_dim):
+        var_z0 = mu_mean.unsqueeze(0).repeat(nbr_steps, 1)
+        var_z0[:,latent] += traversal
+        gen_images.append(model.decode(var_z0).cpu())
+      gen_images = torch.cat(gen_images, dim=0)
+      
+    model_outputs = model(fixed_x)
+    reconst_images = model_outputs[0].cpu()
+
+  attention_weights = None
+  if hasattr(model.encoder, 'attention_weights'):
+    attention_weights = _to_cpu(model.encoder.attention_weights)
+  attention_reconstructions = None
+  if hasattr(model.encoder, 'attention_reconstructions'):
+    attention_reconstructions = _to_cpu(model.encoder.attention_reconstructions)
+
+  job_kwargs = dict(
+    gen_images=gen_images,
+    nbr_steps=nbr_steps,
+    orimg=fixed_x.cpu(),
+    reconst_images=reconst_images,
+    attention_weights=attention_weights,
+    attention_reconstructions=attention_reconstructions,
+    path=path,
+    test=test,
+    idxoffset=idxoffset,
+    suffix=suffix,
+    logger=logger,
+    global_step=global_step,
+  )
+  if blocking:
+    _write_vae_latent_space_images(**job_kwargs)
+  else:
+    get_background_image_writer().submit(_write_vae_latent_space_images, **job_kwargs)
 
 
 """